@@ -1,5 +1,8 @@
 # ruff: noqa: I001, PLC0414
 
+import importlib
+from typing import TYPE_CHECKING
+
 # Utilities
 from ._utils import (
     config_exists as config_exists,
@@ -12,14 +15,22 @@ from ._utils import (
     run_script as run_script,
 )
 
-# Core functions
-from ._build import build as build
-from ._core import (
-    clean as clean,
-    create_project as create_project,
-    dist as dist,
-    run as run,
-)
+# Core functions (imported on first use to keep startup fast)
+if TYPE_CHECKING:
+    from ._build import (
+        build as build,
+        prune as prune,
+        watch as watch,
+    )
+    from ._pack import (
+        pack as pack,
+    )
+    from ._core import (
+        clean as clean,
+        create_project as create_project,
+        dist as dist,
+        run as run,
+    )
 
 # Exceptions
 from .exceptions import (
@@ -29,3 +40,27 @@ from .exceptions import (
     NoConfigError as NoConfigError,
     PManError as PManError,
 )
+
+
+_LAZY_ATTRS = {
+    'build': '._build',
+    'prune': '._build',
+    'watch': '._build',
+    'pack': '._pack',
+    'clean': '._core',
+    'create_project': '._core',
+    'dist': '._core',
+    'run': '._core',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
@@ -1,69 +1,161 @@
-import collections
 import concurrent.futures
 import contextlib
 import dataclasses
 import fnmatch
-import itertools
-import json
 import os
 import pprint
+import re
 import signal
 import sys
+import threading
 import time
 
-from rich import (
-    live,
-    print,  # noqa
-    progress,
-    table,
-)
+from rich import print  # noqa
 
 from . import plugins
+from ._builddb import get_config_fingerprint, open_builddb
+from ._cache import (
+    ArtifactCache,
+    RemoteCacheError,
+    load_variant,
+    open_artifact_cache,
+    open_remote_cache,
+)
+from ._jobserver import JobServer, get_client, is_jobserver_supported
+from ._pack import pack
+from ._profile import DEFAULT_PROFILE_PATH, BuildProfiler
+from ._progress import REFRESH_RATE, get_progress_reporter
+from ._scheduler import Job, JobScheduler, break_cycles, make_batches
+from ._stamp import clear_build_stamp, get_source_stamp, write_build_stamp
 from ._utils import (
+    call_hooks,
     disallow_frozen,
     ensure_config,
     get_abs_path,
     get_rel_path,
-    run_hooks,
 )
-from .plugins.common import ConverterResult
+from ._watch import get_watcher
+from .exceptions import BuildError
 
+DEFAULT_BYTES_PER_SECOND = 10 * 1024 * 1024
+MIN_JOB_COST = 0.001
 
-def gather_files(srcdir, include_patterns, exclude_patterns, *, verbose=False):
-    found_assets = []
-    for root, _dirs, files in os.walk(srcdir):
-        for asset in files:
-            src = os.path.join(root, asset)
-            asset_path = src.replace(srcdir, '')
-            include_asset = False
-
-            for pattern in include_patterns:
-                if fnmatch.fnmatch(asset_path, pattern) or fnmatch.fnmatch(asset, pattern):
-                    include_asset = True
-                    break
+# How converters are run:
+#  thread: in a thread pool in the build process (for I/O-bound converters)
+#  process: in a pool of worker processes (for CPU-bound converters)
+#  subprocess: in a thread pool in the build process, one thread per CPU,
+#    for converters that spend their time waiting on external tools
+EXECUTORS = ('thread', 'process', 'subprocess')
+DEFAULT_EXECUTOR = 'process'
 
-            if not include_asset:
-                continue
+# Batches are filled up to this estimated cost (in seconds) before being
+# split across workers, so the overhead of a job does not dwarf its work
+MIN_BATCH_COSTS = {
+    'thread': 0.01,
+    'process': 0.05,
+    'subprocess': 0.5,
+}
 
-            ignore_pattern = None
-            for pattern in exclude_patterns:
-                if fnmatch.fnmatch(asset_path, pattern) or fnmatch.fnmatch(asset, pattern):
-                    ignore_pattern = pattern
-                    break
-            if ignore_pattern is not None:
-                if verbose:
-                    print(
-                        f'Skip building file {asset_path} that '
-                        f'matched ignore pattern {ignore_pattern}'
-                    )
-                continue
 
-            found_assets.append(src)
+class PatternMatcher:
+    '''Match names against a list of fnmatch patterns using one compiled regex'''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._regex = None
+        if self.patterns:
+            self._regex = re.compile('|'.join(
+                f'(?P<p{idx}>{fnmatch.translate(os.path.normcase(pattern))})'
+                for idx, pattern in enumerate(self.patterns)
+            ))
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def match(self, *names):
+        '''Return the index of the first pattern matching any of names, or None'''
+        if self._regex is None:
+            return None
+
+        for name in names:
+            match = self._regex.match(os.path.normcase(name))
+            if match:
+                return int(match.lastgroup[1:])
+        return None
+
+
+def get_dir_patterns(exclude_patterns):
+    '''Find patterns that exclude everything under a directory (e.g., "foo/*")
+
+    Returns the directory part of those patterns so whole directories can be
+    skipped while scanning.
+    '''
+    return [
+        pattern.rstrip('*')[:-1]
+        for pattern in exclude_patterns
+        if pattern.endswith('*') and pattern.rstrip('*').endswith('/')
+    ]
+
+
+def scan_tree(srcdir, prune_matchers=()):
+    '''Walk srcdir once, yielding (path, relpath, name, stat) for each file
+
+    Directories are not descended into if their path relative to srcdir
+    matches every matcher in prune_matchers.
+    '''
+    stack = [(srcdir, '')]
+    while stack:
+        dirpath, relprefix = stack.pop()
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                relpath = relprefix + entry.name
+                if entry.is_dir():
+                    if entry.is_symlink():
+                        continue
+                    if prune_matchers and all(
+                        matcher.match(relpath) is not None
+                        for matcher in prune_matchers
+                    ):
+                        continue
+                    stack.append((entry.path, relpath + os.sep))
+                elif entry.is_file():
+                    yield entry.path, relpath, entry.name, entry.stat()
+
+
+def gather_files(srcdir, include_patterns, exclude_patterns, *, verbose=False, stats=None):
+    include_matcher = PatternMatcher(include_patterns)
+    exclude_matcher = PatternMatcher(exclude_patterns)
+    prune_matcher = PatternMatcher(get_dir_patterns(exclude_patterns))
+
+    found_assets = []
+    for src, asset_path, asset, stat in scan_tree(srcdir, [prune_matcher]):
+        if include_matcher.match(asset_path, asset) is None:
+            continue
+
+        ignore_idx = exclude_matcher.match(asset_path, asset)
+        if ignore_idx is not None:
+            if verbose:
+                print(
+                    f'Skip building file {asset_path} that '
+                    f'matched ignore pattern {exclude_patterns[ignore_idx]}'
+                )
+            continue
+
+        found_assets.append(src)
+        if stats is not None:
+            stats[src] = stat
 
     return found_assets
 
 
-def generate_auto_streams(config, converters):
+def get_converter_config(config, confkey):
+    converter_config = config.plugins.get(confkey, {})
+    if dataclasses.is_dataclass(converter_config):
+        converter_config = dataclasses.asdict(converter_config)
+    return dict(converter_config)
+
+
+def generate_auto_streams(config, converters, *, stats=None, files=None):
     verbose = config['general']['verbose']
     srcdir = get_abs_path(config, config['build']['asset_dir'])
     ignore_patterns = config['build']['ignore_patterns']
@@ -71,15 +163,6 @@ def generate_auto_streams(config, converters):
     if verbose:
         print(f'Ignoring file patterns: {ignore_patterns}')
 
-    # Gather files (skipping ignored files)
-    found_assets = gather_files(srcdir, '*', ignore_patterns, verbose=verbose)
-
-    # Group assets by extensions
-    ext_asset_map = collections.defaultdict(list)
-    for asset in found_assets:
-        ext = '.' + asset.split('.', 1)[1]
-        ext_asset_map[ext].append(asset)
-
     # Find converters for extensions
     ext_converter_map = {
         ext: converter
@@ -87,53 +170,60 @@ def generate_auto_streams(config, converters):
         for ext in converter.supported_extensions
     }
     copyfile_converter = plugins.get_converters(['copyfile'])[0]
-    streams = collections.defaultdict(list)
-    for ext, assets in ext_asset_map.items():
-        converter = ext_converter_map.get(ext, copyfile_converter)
-        streams[converter].extend(assets)
 
     # Build streams for each converter (including overrides)
-    streams_with_overrides = []
-    for converter, files in streams.items():
-        confkey = getattr(converter.plugin, 'CONFIG_KEY', converter.name)
-        converter_config = config.plugins.get(confkey, {})
-        remaining_files = set(files)
-
-        for override in converter_config.get('overrides', []):
-            override_files = {
-                i for i in files
-                if (
-                    fnmatch.fnmatch(i, override['pattern'])
-                    or fnmatch.fnmatch(os.path.basename(i), override['pattern'])
-                )
-            }
+    stream_map = {}
+    override_map = {}
+    def get_stream(converter, asset):
+        if converter not in override_map:
+            confkey = getattr(converter.plugin, 'CONFIG_KEY', converter.name)
+            converter_config = get_converter_config(config, confkey)
+            overrides = converter_config.get('overrides') or []
+            override_map[converter] = (
+                PatternMatcher([i['pattern'] for i in overrides]),
+                [converter_config | i for i in overrides],
+                converter_config,
+            )
+        matcher, override_configs, converter_config = override_map[converter]
 
-            if not files:
-                continue
+        override_idx = matcher.match(asset, os.path.basename(asset))
+        key = (converter, override_idx)
+        if key not in stream_map:
+            if override_idx is None:
+                stream_map[key] = [converter, [], converter_config]
+            else:
+                stream_map[key] = [converter, [], override_configs[override_idx]]
+                if verbose:
+                    print(
+                        f'{converter.name}: Using the following override\n'
+                        f'{pprint.pformat(stream_map[key][2])}'
+                    )
+        return stream_map[key]
 
-            streams_with_overrides.append([
-                converter,
-                override_files,
-                converter_config | override
-            ])
+    # Gather files (skipping ignored files) and group them by extension
+    ignore_matcher = PatternMatcher(ignore_patterns)
+    if files is None:
+        files = scan_tree(srcdir, [PatternMatcher(get_dir_patterns(ignore_patterns))])
+    for asset, asset_path, name, stat in files:
+        ignore_idx = ignore_matcher.match(asset_path, name)
+        if ignore_idx is not None:
             if verbose:
                 print(
-                    f'{converter.name}: Using the following override\n'
-                    f'{pprint.pformat(streams_with_overrides[-1])}'
+                    f'Skip building file {asset_path} that '
+                    f'matched ignore pattern {ignore_patterns[ignore_idx]}'
                 )
-            remaining_files -= override_files
+            continue
 
-        if remaining_files:
-            streams_with_overrides.append([
-                converter,
-                remaining_files,
-                converter_config
-            ])
+        ext = '.' + name.split('.', 1)[1] if '.' in name else ''
+        converter = ext_converter_map.get(ext, copyfile_converter)
+        get_stream(converter, asset)[1].append(asset)
+        if stats is not None:
+            stats[asset] = stat
 
-    return streams_with_overrides
+    return list(stream_map.values())
 
 
-def generate_explicit_streams(config, converters):
+def generate_explicit_streams(config, converters, *, stats=None, files=None):
     verbose = config['general']['verbose']
     srcdir = get_abs_path(config, config['build']['asset_dir'])
 
@@ -143,13 +233,8 @@ def generate_explicit_streams(config, converters):
     }
 
     streams = []
+    matchers = []
     for stream_configs in config['build']['streams']:
-        found_assets = gather_files(
-            srcdir,
-            stream_configs.get('include_patterns', []),
-            stream_configs.get('exclude_patterns', []),
-            verbose=verbose
-        )
         plugin_name = stream_configs['plugin']
         converter = converter_map.get(plugin_name)
         if not converter:
@@ -159,175 +244,950 @@ def generate_explicit_streams(config, converters):
             )
         streams.append([
             converter,
-            found_assets,
-            config.plugins.get(plugin_name, {}) | stream_configs.get('options', {})
+            [],
+            get_converter_config(config, plugin_name) | stream_configs.get('options', {})
         ])
+        exclude_patterns = stream_configs.get('exclude_patterns', [])
+        matchers.append((
+            PatternMatcher(stream_configs.get('include_patterns', [])),
+            PatternMatcher(exclude_patterns),
+            PatternMatcher(get_dir_patterns(exclude_patterns)),
+        ))
+
+    # A directory can only be skipped if every stream excludes it
+    prune_matchers = [i[2] for i in matchers]
+    if not all(prune_matchers):
+        prune_matchers = []
+
+    if files is None:
+        files = scan_tree(srcdir, prune_matchers)
+    for asset, asset_path, name, stat in files:
+        for stream, (include_matcher, exclude_matcher, _) in zip(streams, matchers):
+            if include_matcher.match(asset_path, name) is None:
+                continue
+
+            exclude_idx = exclude_matcher.match(asset_path, name)
+            if exclude_idx is not None:
+                if verbose:
+                    print(
+                        f'Skip building file {asset_path} that '
+                        f'matched ignore pattern {exclude_matcher.patterns[exclude_idx]}'
+                    )
+                continue
+
+            stream[1].append(asset)
+            if stats is not None:
+                stats[asset] = stat
 
     return streams
 
 
-@ensure_config
-@disallow_frozen
-@run_hooks
-def build(config=None):
-    verbose = config['general']['verbose']
-    builddb_path = os.path.join(
-        config['internal']['projectdir'],
-        '.pman_builddb'
-    )
-    show_all_jobs = config['build']['show_all_jobs']
-    converters = plugins.get_converters(config['general']['plugins'])
+def run_converter(
+    function, config, converter_config, srcdir, dstdir, assets,
+    jobserver=None, pools=(),
+):
+    '''Run a converter function
 
-    stime = time.perf_counter()
-    print('Starting build')
+    If jobserver (the path of a JobServer) is given, a token is held from
+    each of pools while the converter runs. Returns the results along with
+    the (wall clock) start and end times and the PID and thread ID the
+    converter ran in.
+    '''
+    with get_client(jobserver).job(pools) if jobserver else contextlib.nullcontext():
+        started = time.time()
+        results = function(config, converter_config, srcdir, dstdir, assets)
+        finished = time.time()
+    return results or [], started, finished, os.getpid(), threading.get_native_id()
 
-    builddb = []
-    try:
-        if os.path.exists(builddb_path):
-            with open(builddb_path, encoding='utf8') as builddb_file:
-                builddb = [
-                    ConverterResult(**i)
-                    for i in json.load(builddb_file)
-                ]
-    except json.decoder.JSONDecodeError:
-        pass
 
-    builddb = {
-        result.output_file: result
-        for result in builddb
-    }
+def stat_files(srcdir, paths):
+    '''Stat paths, producing the same entries as scan_tree() for those that exist'''
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        relpath = os.path.relpath(path, srcdir)
+        if relpath.startswith(os.pardir) or not os.path.isfile(path):
+            continue
+        yield path, relpath, os.path.basename(path), stat
 
-    srcdir = get_abs_path(config, config['build']['asset_dir'])
-    dstdir = get_abs_path(config, config['build']['export_dir'])
 
-    if verbose:
-        print(f'Read assets from: {srcdir}')
-        print(f'Export them to: {dstdir}')
+class Builder:
+    '''Convert assets from the asset directory into the export directory
 
+    The builddb, artifact caches, and converter pools are kept alive between
+    calls to build() so repeated (e.g., watch mode) builds do not pay for
+    them again. Converters pick the kind of pool they run in (see
+    EXECUTORS), and the pools run side by side. If a
+    BuildProfiler is given, build phases and jobs are recorded with it.
+    '''
 
-    if not os.path.exists(dstdir):
-        print(f'Creating asset export directory at {dstdir}')
-        os.makedirs(dstdir)
+    def __init__(self, config, profiler=None):
+        self.config = config
+        self.verbose = config['general']['verbose']
+        self.show_all_jobs = config['build']['show_all_jobs']
+        self.converters = plugins.get_converters(config['general']['plugins'])
+        self.srcdir = get_abs_path(config, config['build']['asset_dir'])
+        self.dstdir = get_abs_path(config, config['build']['export_dir'])
+        self.builddb = open_builddb(config, self.srcdir)
+        self.cache = open_artifact_cache(config)
+        self.remote_cache = open_remote_cache(config)
+        self.profiler = profiler
+        self.pools = {}
+        self.jobserver = None
+        self.saved_environ = {}
 
+    def __enter__(self):
+        return self
 
-    if not os.path.exists(srcdir) or not os.path.isdir(srcdir):
-        print(f'warning: could not find asset directory: {srcdir}')
-        return
+    def __exit__(self, *exc):
+        self.close()
 
-    if config['build']['streams']:
-        streams = generate_explicit_streams(config, converters)
-    else:
-        streams = generate_auto_streams(config, converters)
+    def close(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+        self.pools.clear()
+        self.close_jobserver()
+        self.builddb.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.remote_cache is not None:
+            self.remote_cache.close()
 
-    # Process assets
-    def skip_build(converter, asset):
-        if converter.output_extension:
-            dst = asset.split('.', 1)[0] + converter.output_extension
+    def kill(self):
+        '''Stop all pools, killing worker processes
+
+        Converters running in threads cannot be interrupted, but jobs that
+        have not started yet are cancelled.
+        '''
+        process_pool = self.pools.get('process')
+        if process_pool is not None:
+            for pid in process_pool._processes: # noqa
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(pid, signal.SIGKILL)
+        shutdown_args = {
+            'wait': False
+        }
+        if sys.version_info >= (3, 9):
+            shutdown_args['cancel_futures'] = True
+        for pool in self.pools.values():
+            pool.shutdown(**shutdown_args)
+        self.pools.clear()
+
+        # Tokens held by killed workers are lost, so start over with a new jobserver
+        self.close_jobserver()
+
+    def get_pool(self, executor=DEFAULT_EXECUTOR):
+        if executor not in self.pools:
+            workers = self.get_worker_count()
+            if executor == 'process':
+                if sys.platform == 'win32':
+                    # ProcessPoolExecutor rejects more than 61 workers on Windows
+                    workers = min(workers, 61)
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+                # Start the workers right away: forking them while converter
+                # threads are running could leave locks held in the children
+                pool.submit(int).result()
+            elif executor == 'subprocess':
+                pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix='pman-subprocess',
+                )
+            else:
+                # I/O-bound work benefits from more threads than CPUs
+                pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(32, workers + 4),
+                    thread_name_prefix='pman-thread',
+                )
+            self.pools[executor] = pool
+        return self.pools[executor]
+
+    def get_jobserver(self):
+        '''Return the JobServer that bounds how many jobs (and their tools) run at once
+
+        Child processes find it through environment variables. Returns None
+        on platforms without named pipes.
+        '''
+        if self.jobserver is None and is_jobserver_supported():
+            limits = self.config['build']['converter_jobs']
+            for name in limits.keys() - {i.name for i in self.converters}:
+                print(f'warning: converter_jobs has a limit for unknown converter {name}')
+            self.jobserver = JobServer(self.get_worker_count(), limits=limits)
+            for key, value in self.jobserver.get_environ().items():
+                self.saved_environ[key] = os.environ.get(key)
+                os.environ[key] = value
+        return self.jobserver
+
+    def close_jobserver(self):
+        if self.jobserver is None:
+            return
+        for key, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        self.saved_environ.clear()
+        self.jobserver.close()
+        self.jobserver = None
+
+    def get_executor(self, converter, converter_config):
+        '''Return the kind of pool the jobs of a converter run in
+
+        Plugins declare this with an EXECUTOR attribute, or a
+        get_executor(converter_config) method if it depends on their options.
+        '''
+        plugin = converter.plugin
+        if hasattr(plugin, 'get_executor'):
+            executor = plugin.get_executor(converter_config)
         else:
-            dst = asset
-        dst = dst.replace(srcdir, dstdir)
-        builddb_key = os.path.relpath(dst, dstdir)
-        deps = [asset]
-        if builddb_key in builddb:
-            deps += [
-                os.path.join(config['build']['asset_dir'], dep)
-                for dep in builddb[builddb_key].dependencies
-            ]
-        skip = (
-            os.path.exists(dst)
-            and all(os.stat(i).st_mtime <= os.stat(dst).st_mtime for i in deps)
-        )
+            executor = getattr(plugin, 'EXECUTOR', DEFAULT_EXECUTOR)
+        if executor not in EXECUTORS:
+            raise BuildError(
+                f'{converter.name}: unknown executor {executor!r} '
+                f'(expected one of {", ".join(EXECUTORS)})'
+            )
+        return executor
+
+    def span(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.span(name)
+
+    def find_dependents(self, assets):
+        '''Expand assets (absolute paths) with every asset that depends on them'''
+        found = set(assets)
+        pending = list(found)
+        while pending:
+            key = os.path.relpath(pending.pop(), self.srcdir)
+            for dependent in self.builddb.get_dependents(key):
+                path = os.path.join(self.srcdir, dependent)
+                if path not in found:
+                    found.add(path)
+                    pending.append(path)
+        return found
+
+    def skip_build(self, converter, asset, stat=None, config_hash=''):
+        config = self.config
+        builddb = self.builddb
+        dst = self.get_output_path(converter, asset)
+        builddb_key = os.path.relpath(dst, self.dstdir)
+        if not os.path.exists(dst):
+            return False
+
+        result = builddb.get(builddb_key)
+        if result is not None and result.config_hash and result.config_hash != config_hash:
+            if self.verbose:
+                print(f'Converter options changed for: {get_rel_path(config, dst)}')
+            return False
+
+        if result is not None and result.hashes:
+            skip = builddb.is_up_to_date(
+                builddb_key,
+                os.path.relpath(asset, self.srcdir),
+                stat,
+            )
+            # Entry from before config fingerprints were recorded
+            backfill = skip and not result.config_hash
+        else:
+            # No content hashes recorded yet, fall back to comparing mtimes
+            deps = [asset]
+            if result is not None:
+                deps += [
+                    os.path.join(config['build']['asset_dir'], dep)
+                    for dep in result.dependencies
+                ]
+            skip = all(os.stat(i).st_mtime <= os.stat(dst).st_mtime for i in deps)
+            backfill = skip and result is not None
+        if backfill:
+            # Record hashes (and the config fingerprint) so later checks are exact
+            result.config_hash = config_hash
+            builddb.add_result(result, builddb.snapshot_hashes(
+                builddb_key,
+                os.path.relpath(asset, self.srcdir),
+                stat,
+            ))
         if skip:
-            if verbose:
+            if self.verbose:
                 print(f'Skip building up-to-date file: {get_rel_path(config, dst)}')
             return True
         return False
 
-    max_workers = config['build']['jobs']
-    if max_workers <= 0:
-        max_workers = None
-    pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
-    jobs = []
-    for converter, stream_assets, converter_config in streams:
+    def build(self, assets=None):
+        '''Convert out-of-date assets
+
+        If assets (absolute paths) is given, only those assets and the assets
+        that depend on them are checked instead of scanning the whole asset
+        directory.
+        '''
+        config = self.config
+        verbose = self.verbose
+        srcdir = self.srcdir
+        dstdir = self.dstdir
+
+        if verbose:
+            print(f'Read assets from: {srcdir}')
+            print(f'Export them to: {dstdir}')
+
+        if not os.path.exists(dstdir):
+            print(f'Creating asset export directory at {dstdir}')
+            os.makedirs(dstdir)
+
+        if not os.path.exists(srcdir) or not os.path.isdir(srcdir):
+            print(f'warning: could not find asset directory: {srcdir}')
+            return
+
+        stats = {}
+        with self.span('scan assets'):
+            if assets is not None:
+                assets = self.find_dependents(assets)
+            streams = self.get_streams(assets, stats)
+
+        if config['build']['prune']:
+            with self.span('prune outputs'):
+                self.remove_outputs(self.find_stale_outputs(streams, assets))
+
+        # Process assets
+        jobs = []
+        with self.span('check assets'):
+            for converter, stream_assets, converter_config in streams:
+                jobs.extend(self.make_jobs(converter, stream_assets, converter_config, stats))
+
+            # Start the longest jobs first so they do not end up as stragglers
+            jobs.sort(key=lambda job: job.cost, reverse=True)
+
+            self.link_jobs(jobs)
+
+        # Do not hold on to the builddb while jobs run
+        self.builddb.commit()
+
+        try:
+            with self.span('run jobs'):
+                self.run_jobs(jobs)
+        except KeyboardInterrupt:
+            self.kill()
+            raise
+        finally:
+            if assets is None:
+                self.builddb.save()
+            elif jobs:
+                # Leave cleaning up the stats of unused files to full builds
+                self.builddb.save(prune_stats=False)
+            else:
+                # Nothing was built, so keep checks for a few assets cheap
+                self.builddb.commit()
+            if self.cache is not None and (assets is None or jobs):
+                self.cache.trim()
+
+    def get_streams(self, assets=None, stats=None):
+        '''Group assets into (converter, assets, converter config) streams
+
+        If assets (absolute paths) is None, the whole asset directory is scanned.
+        '''
+        files = None
+        if assets is not None:
+            files = list(stat_files(self.srcdir, assets))
+
+        if self.config['build']['streams']:
+            return generate_explicit_streams(
+                self.config,
+                self.converters,
+                stats=stats,
+                files=files,
+            )
+        return generate_auto_streams(
+            self.config,
+            self.converters,
+            stats=stats,
+            files=files,
+        )
+
+    def find_stale_outputs(self, streams, assets=None):
+        '''Return builddb output files (relative to dstdir) that no stream asset produces
+
+        Outputs whose input was deleted, renamed, or is now ignored are
+        stale. If assets (absolute paths) is given, only the outputs built from
+        those assets are checked.
+        '''
+        live = {
+            os.path.relpath(self.get_output_path(converter, asset), self.dstdir)
+            for converter, stream_assets, _ in streams
+            for asset in stream_assets
+        }
+        if assets is None:
+            candidates = self.builddb.output_files()
+        else:
+            candidates = [
+                output_file
+                for asset in assets
+                for output_file in self.builddb.output_files(
+                    os.path.relpath(asset, self.srcdir)
+                )
+            ]
+        return sorted(set(candidates) - live)
+
+    def remove_outputs(self, outputs):
+        '''Delete output files (relative to dstdir) and their builddb entries'''
+        dstdir = os.path.normpath(self.dstdir)
+        for output_file in outputs:
+            path = os.path.join(self.dstdir, output_file)
+            if self.verbose:
+                print(f'Removing stale output: {get_rel_path(self.config, path)}')
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            self.builddb.remove(output_file)
+
+            # Clean up directories that only held stale outputs
+            dirpath = os.path.dirname(os.path.normpath(path))
+            while dirpath.startswith(dstdir + os.sep):
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    break
+                dirpath = os.path.dirname(dirpath)
+
+    def get_config_hash(self, converter, converter_config):
+        '''Fingerprint the options of a converter, including settings outside its section
+
+        Plugins list settings from the rest of the config that change their
+        output with a get_fingerprint_data(config) method, and options that
+        do not change their output with FINGERPRINT_IGNORED_KEYS.
+        '''
+        plugin = converter.plugin
+        extra = None
+        if hasattr(plugin, 'get_fingerprint_data'):
+            extra = plugin.get_fingerprint_data(self.config)
+        return get_config_fingerprint(
+            converter.name,
+            converter_config,
+            extra,
+            getattr(plugin, 'FINGERPRINT_IGNORED_KEYS', ()),
+        )
+
+    def make_jobs(self, converter, stream_assets, converter_config, stats):
+        '''Create jobs for the assets of a stream that are out-of-date'''
+        config = self.config
+        config_hash = self.get_config_hash(converter, converter_config)
         assets = [
             asset
             for asset in stream_assets
-            if not skip_build(converter, asset)
+            if not self.skip_build(converter, asset, stats.get(asset), config_hash)
         ]
-
+        assets = self.restore_cached(converter, config_hash, assets, stats)
         if not assets:
-            continue
+            return []
 
+        # Hash the inputs now, so changes made while the converter runs are
+        # not recorded as built
+        hashed_at = time.time_ns()
+        hashes = {}
+        for asset in assets:
+            hashes.update(self.builddb.snapshot_hashes(
+                os.path.relpath(self.get_output_path(converter, asset), self.dstdir),
+                os.path.relpath(asset, self.srcdir),
+                stats.get(asset),
+            ))
+
+        costs = self.estimate_costs(converter, assets, stats)
         max_batch = getattr(converter.plugin, 'BATCH_SIZE', 1)
-        chunk_it = iter(assets)
-        while chunk := tuple(itertools.islice(chunk_it, max_batch)):
-            jobstr = f'{converter.name}: {", ".join(get_rel_path(config, i) for i in chunk)}'
-            fut = pool.submit(converter.function, config, converter_config, srcdir, dstdir, chunk)
-            jobs.append((jobstr, fut))
-
-
-    # Display progress
-    job_progress = progress.Progress(
-        '[progress.description]{task.description}',
-        progress.SpinnerColumn(
-            finished_text='[progress.percentage]:heavy_check_mark:'
-        ),
-    )
-    show_all = verbose or show_all_jobs
-    taskids = []
-    for jobstr, fut in jobs:
-        taskid = job_progress.add_task(jobstr, total=None, visible=verbose)
-        taskids.append((taskid, fut))
-
-    overall_progress = progress.Progress(
-        '[progress.description]{task.description}',
-        progress.BarColumn(),
-        progress.MofNCompleteColumn(),
-    )
-    overall_task = overall_progress.add_task(
-        "All jobs",
-        total=len(taskids),
-    )
-
-    progress_table = table.Table.grid()
-    progress_table.add_row(job_progress)
-    progress_table.add_row(overall_progress)
-
-    def update_progress():
-        for taskid, fut in taskids:
-            job_progress.update(
-                taskid,
-                completed=1 if fut.done() else 0,
-                total=1 if fut.running() or fut.done() else None,
-                visible=fut.running() or show_all
+        executor = self.get_executor(converter, converter_config)
+        batches = make_batches(
+            assets,
+            costs,
+            max_batch,
+            self.get_worker_count(),
+            min_cost=MIN_BATCH_COSTS[executor],
+        )
+        return [
+            Job(
+                converter=converter,
+                converter_config=converter_config,
+                assets=batch,
+                costs=tuple(costs[i] for i in batch),
+                description=(
+                    f'{converter.name}: {", ".join(get_rel_path(config, i) for i in batch)}'
+                ),
+                executor=executor,
+                hashes=hashes,
+                hashed_at=hashed_at,
+            )
+            for batch in batches
+        ]
+
+    def is_cacheable(self, converter):
+        '''Whether outputs of converter go in the artifact caches
+
+        Plugins that are cheaper to re-run than to cache (e.g., copying
+        files) opt out with CACHEABLE = False.
+        '''
+        return getattr(converter.plugin, 'CACHEABLE', True)
+
+    def restore_cached(self, converter, config_hash, assets, stats):
+        '''Copy outputs from the artifact caches, returning the assets that were not cached
+
+        The local cache is checked first. Assets missing from it are then
+        looked up in the remote cache with a single batched query and
+        downloaded concurrently.
+        '''
+        if not self.is_cacheable(converter):
+            return assets
+        if self.cache is None and self.remote_cache is None:
+            return assets
+
+        keys = {}
+        for asset in assets:
+            input_file = os.path.relpath(asset, self.srcdir)
+            input_hash = self.builddb.get_hash(input_file, stats.get(asset))
+            if input_hash is not None:
+                keys[asset] = ArtifactCache.make_key(config_hash, input_file, input_hash)
+
+        restored = set()
+        if self.cache is not None:
+            for asset, key in keys.items():
+                cached = self.cache.get(key, self.builddb.get_hash)
+                if cached is None:
+                    continue
+                objid, results = cached
+                try:
+                    self.cache.restore(objid, results, self.dstdir)
+                except OSError:
+                    continue
+                for result in results:
+                    result.config_hash = config_hash
+                    self.builddb.add_result(result)
+                restored.add(asset)
+
+        if self.remote_cache is not None:
+            missing = {
+                asset: key
+                for asset, key in keys.items()
+                if asset not in restored
+            }
+            with contextlib.suppress(RemoteCacheError):
+                restored |= self.restore_remote(config_hash, missing)
+
+        if self.verbose:
+            for asset in sorted(restored):
+                print(f'Restored from cache: {get_rel_path(self.config, asset)}')
+        return [asset for asset in assets if asset not in restored]
+
+    def restore_remote(self, config_hash, keys):
+        '''Download the outputs for keys (a dict of asset to cache key) from the remote cache'''
+        if not keys:
+            return set()
+
+        remote = self.remote_cache
+        variants = remote.get_variants(keys.values())
+
+        # Variants come from another machine, so malformed ones are skipped
+        matches = {}
+        for asset, key in keys.items():
+            input_file = os.path.relpath(asset, self.srcdir)
+            for data in variants.get(key, []):
+                variant = load_variant(data)
+                if variant is None:
+                    continue
+                _, dependencies, results = variant
+                if any(result.input_file != input_file for result in results):
+                    continue
+                if all(
+                    self.builddb.get_hash(dep) == value
+                    for dep, value in dependencies.items()
+                ):
+                    matches[asset] = (key, variant)
+                    break
+
+        downloaded = remote.download_objects({
+            asset: (
+                objid,
+                [os.path.join(self.dstdir, i.output_file) for i in results],
+            )
+            for asset, (_, (objid, _, results)) in matches.items()
+        })
+        for asset in downloaded:
+            key, (_, dependencies, results) = matches[asset]
+            for result in results:
+                result.config_hash = config_hash
+                self.builddb.add_result(result)
+            if self.cache is not None:
+                self.cache.put(key, dependencies, results, self.dstdir)
+        if self.cache is not None:
+            self.cache.save()
+        return downloaded
+
+    def store_cached(self, job, results, config_hash):
+        '''Add the outputs of a finished job to the artifact caches'''
+        if not self.is_cacheable(job.converter):
+            return
+
+        by_input = {}
+        for result in results:
+            by_input.setdefault(result.input_file, []).append(result)
+
+        for input_file, input_results in by_input.items():
+            if any(None in result.hashes.values() for result in input_results):
+                # An input changed (or vanished) during the build
+                continue
+            dependencies = {
+                key: value
+                for result in input_results
+                for key, value in result.hashes.items()
+                if key != input_file
+            }
+            key = ArtifactCache.make_key(
+                config_hash,
+                input_file,
+                input_results[0].hashes.get(input_file),
+            )
+            if self.cache is not None:
+                self.cache.put(key, dependencies, input_results, self.dstdir)
+            if self.remote_cache is not None:
+                self.remote_cache.put(key, dependencies, input_results, self.dstdir)
+        if self.cache is not None:
+            self.cache.save()
+
+    def get_worker_count(self):
+        workers = self.config['build']['jobs']
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        return workers
+
+    def estimate_costs(self, converter, assets, stats):
+        '''Estimate how long (in seconds) converting each asset will take
+
+        Durations recorded in the builddb are used where available. Other
+        assets are estimated from their size, using the rate seen for the
+        assets with history, or DEFAULT_BYTES_PER_SECOND without any.
+        '''
+        costs = {}
+        sizes = {}
+        known_duration = 0
+        known_size = 0
+        for asset in assets:
+            stat = stats.get(asset)
+            sizes[asset] = stat.st_size if stat is not None else os.path.getsize(asset)
+            dst = self.get_output_path(converter, asset)
+            result = self.builddb.get(os.path.relpath(dst, self.dstdir))
+            if result is not None and result.duration > 0:
+                costs[asset] = result.duration
+                known_duration += result.duration
+                known_size += sizes[asset]
+
+        if known_duration and known_size:
+            seconds_per_byte = known_duration / known_size
+        else:
+            seconds_per_byte = 1 / DEFAULT_BYTES_PER_SECOND
+        for asset in assets:
+            if asset not in costs:
+                costs[asset] = max(sizes[asset] * seconds_per_byte, MIN_JOB_COST)
+        return costs
+
+    def get_output_path(self, converter, asset):
+        if converter.output_extension:
+            dst = asset.split('.', 1)[0] + converter.output_extension
+        else:
+            dst = asset
+        return dst.replace(self.srcdir, self.dstdir)
+
+    def link_jobs(self, jobs):
+        '''Make jobs wait for jobs that build the dependencies recorded in the builddb'''
+        asset_jobs = {
+            asset: job
+            for job in jobs
+            for asset in job.assets
+        }
+        for job in jobs:
+            for asset in job.assets:
+                dst = self.get_output_path(job.converter, asset)
+                result = self.builddb.get(os.path.relpath(dst, self.dstdir))
+                if result is None:
+                    continue
+                for dep in result.dependencies:
+                    prerequisite = asset_jobs.get(os.path.join(self.srcdir, dep))
+                    if prerequisite is not None:
+                        job.add_prerequisite(prerequisite)
+
+        for job in break_cycles(jobs):
+            print(f'warning: ignoring dependency cycle for job {job.description}')
+
+    def submit_job(self, job):
+        if self.profiler is not None:
+            self.profiler.job_submitted(
+                job,
+                job.converter.name,
+                [os.path.relpath(i, self.srcdir) for i in job.assets],
             )
-        overall_progress.update(
-            overall_task,
-            completed=len(jobs) - len(unfinished)
+        jobserver = self.get_jobserver()
+        jobserver_path = None
+        pools = ()
+        if jobserver is not None:
+            jobserver_path = jobserver.path
+            # I/O-bound jobs are only held back by per-converter limits
+            pools = jobserver.client().get_pools(
+                job.converter.name,
+                use_global=job.executor != 'thread',
+            )
+        return self.get_pool(job.executor).submit(
+            run_converter,
+            job.converter.function,
+            self.config,
+            job.converter_config,
+            self.srcdir,
+            self.dstdir,
+            job.assets,
+            jobserver_path,
+            pools,
         )
 
-    try:
-        if len(jobs) > 0:
-            with live.Live(progress_table):
-                while unfinished := [x for x in taskids if not x[1].done()]:
-                    update_progress()
-                update_progress()
-        pool.shutdown(wait=True)
-        for _, fut in jobs:
-            for result in fut.result():
-                builddb[result.output_file] = result
-    except KeyboardInterrupt:
-        for pid in pool._processes: # noqa
-            with contextlib.suppress(ProcessLookupError):
-                os.kill(pid, signal.SIGKILL)
-        shutdown_args = {
-            'wait': False
+    def record_results(self, job, results, duration):
+        '''Add results to the builddb, splitting duration between them by estimated cost'''
+        asset_costs = {
+            os.path.relpath(asset, self.srcdir): cost
+            for asset, cost in zip(job.assets, job.costs)
         }
-        if sys.version_info >= (3, 9):
-            shutdown_args['cancel_futures'] = True
-        pool.shutdown(**shutdown_args)
-        raise
+        total_cost = sum(asset_costs.get(i.input_file, 0) for i in results)
+        config_hash = self.get_config_hash(job.converter, job.converter_config)
+        for result in results:
+            result.config_hash = config_hash
+            if total_cost > 0:
+                result.duration = duration * asset_costs.get(result.input_file, 0) / total_cost
+            else:
+                result.duration = duration / len(results)
+            self.builddb.add_result(result, job.hashes, job.hashed_at)
+            if self.profiler is not None:
+                self.profiler.asset_built(job.converter.name, result.input_file, result.duration)
+        if self.cache is not None or self.remote_cache is not None:
+            self.store_cached(job, results, config_hash)
+        self.builddb.commit()
+
+    def run_jobs(self, jobs):
+        '''Run jobs as their prerequisites finish, recording results as they complete
+
+        Jobs that depend on a failed job are skipped. If any job fails, the
+        first error is raised once all other jobs are done.
+        '''
+        if not jobs:
+            return
+
+        # Worker processes inherit the jobserver environment when they are started
+        self.get_jobserver()
+        if any(job.executor == 'process' for job in jobs):
+            self.get_pool('process')
+
+        scheduler = JobScheduler(jobs, self.submit_job)
+        errors = []
+        show_all = self.verbose or self.show_all_jobs
+        with get_progress_reporter(len(jobs), show_all=show_all) as reporter:
+            scheduler.start()
+            while scheduler.remaining:
+                for job in scheduler.poll_started():
+                    reporter.job_started(job, job.description)
+
+                for job in scheduler.wait(1 / REFRESH_RATE):
+                    error = job.future.exception()
+                    if error is None:
+                        results, started, finished, pid, tid = job.future.result()
+                        if self.profiler is not None:
+                            self.profiler.job_finished(job, started, finished, pid, tid)
+                        self.record_results(job, results, finished - started)
+                        scheduler.finish(job)
+                        reporter.job_finished(job, job.description)
+                        continue
+
+                    errors.append(error)
+                    if self.profiler is not None:
+                        self.profiler.job_failed(job, error)
+                    reporter.job_finished(job, job.description, error=error)
+                    skip_error = BuildError(f'skipped because {job.description} failed')
+                    for skipped in scheduler.fail(job):
+                        reporter.job_finished(skipped, skipped.description, error=skip_error)
+
+        if errors:
+            raise errors[0]
+
+
+class OnDemandBuilder:
+    '''Build assets as the application asks for their outputs
+
+    Instead of converting everything up-front, ensure_built() maps a
+    requested output file back to the asset(s) that could produce it and
+    builds only those (and the assets they depend on). The Builder is kept
+    open, so requests after the first are cheap. Requests may come from any
+    thread, but are handled one at a time.
+    '''
+
+    def __init__(self, config):
+        self.builder = Builder(config)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.builder.close()
+
+    def find_assets(self, output_file):
+        '''Return the assets (absolute paths) that could build output_file
+
+        output_file is relative to the export directory. The builddb is
+        checked first, otherwise sources are guessed from the converters'
+        extensions (e.g., foo.bam could come from foo.blend or foo.egg).
+        '''
+        builder = self.builder
+        result = builder.builddb.get(output_file)
+        if result is not None:
+            asset = os.path.join(builder.srcdir, result.input_file)
+            if os.path.isfile(asset):
+                return [asset]
+
+        stem, sep, ext = output_file.partition('.')
+        candidates = [output_file]
+        for converter in builder.converters:
+            if converter.output_extension and sep + ext == converter.output_extension:
+                candidates.extend(stem + i for i in converter.supported_extensions)
+        return [
+            path
+            for path in (os.path.join(builder.srcdir, i) for i in candidates)
+            if os.path.isfile(path)
+        ]
+
+    def get_dependencies(self, assets):
+        '''Return the recorded dependencies (absolute paths) of the outputs of assets'''
+        builder = self.builder
+        dependencies = set()
+        for asset in assets:
+            for output_file in builder.builddb.output_files(os.path.relpath(asset, builder.srcdir)):
+                result = builder.builddb.get(output_file)
+                if result is not None:
+                    dependencies.update(
+                        os.path.join(builder.srcdir, i)
+                        for i in result.dependencies
+                    )
+        return dependencies - set(assets)
+
+    def ensure_built(self, output_file):
+        '''Build output_file (relative to the export directory) if it is missing or stale
+
+        Returns False if no asset produces output_file.
+        '''
+        with self.lock:
+            assets = self.find_assets(os.path.normpath(output_file))
+            if not assets:
+                return False
+
+            self.builder.build(assets)
+
+            # Dependencies are only known once an asset has been built
+            dependencies = self.get_dependencies(assets)
+            if dependencies:
+                self.builder.build(dependencies)
+            return True
+
+
+@ensure_config
+@disallow_frozen
+def build(config=None, *, profile=None):
+    '''Build the project
+
+    If profile is given, per-job timings are written to it as a Chrome trace
+    (True uses DEFAULT_PROFILE_PATH) and the slowest assets are summarized.
+    '''
+    profiler = BuildProfiler() if profile else None
+    try:
+        call_hooks(config, 'pre_build', profiler)
+        stime = time.perf_counter()
+        print('Starting build')
+
+        # Snapshot the sources before building so changes made during the
+        # build invalidate the stamp
+        source_stamp = get_source_stamp(config)
+        clear_build_stamp(config)
+        with Builder(config, profiler) as builder:
+            builder.build()
+        if config['build']['pack']:
+            with profiler.span('pack assets') if profiler else contextlib.nullcontext():
+                pack(config)
+        write_build_stamp(config, source_stamp)
+
+        print(f':stopwatch: Build took [json.number]{time.perf_counter() - stime:.2f}s')
+        call_hooks(config, 'post_build', profiler)
+    finally:
+        if profiler is not None:
+            if profile is True:
+                profile = DEFAULT_PROFILE_PATH
+            profiler.write_trace(profile)
+            profiler.print_summary()
+            print(f'Wrote build profile to {profile}')
+
+
+@ensure_config
+@disallow_frozen
+def prune(config=None, *, dry_run=False):
+    '''Remove built outputs whose assets no longer exist (or are now ignored)
+
+    Builds do this automatically unless build.prune is disabled. With
+    dry_run, the stale outputs are only listed. Returns the stale outputs
+    (relative to the export directory).
+    '''
+    with Builder(config) as builder:
+        if not os.path.isdir(builder.srcdir):
+            return []
+        stale = builder.find_stale_outputs(builder.get_streams())
+        if dry_run:
+            for output_file in stale:
+                path = os.path.join(builder.dstdir, output_file)
+                print(f'Would remove {get_rel_path(config, path)}')
+            print(f'{len(stale)} stale outputs')
+        else:
+            builder.remove_outputs(stale)
+            builder.builddb.save()
+            print(f'Removed {len(stale)} stale outputs')
+    return stale
+
+
+@ensure_config
+@disallow_frozen
+def watch(config=None, *, debounce=0.1):
+    '''Build the project and then rebuild changed assets until interrupted
+
+    Failed builds are reported and do not stop watching, so fixing the
+    broken asset (or changing any other) triggers the next rebuild.
+    '''
+    def run_build(builder, changes=None):
+        call_hooks(config, 'pre_build')
+        builder.build(changes)
+        if config['build']['pack']:
+            pack(config)
+        call_hooks(config, 'post_build')
+
+    with Builder(config) as builder:
+        stime = time.perf_counter()
+        print('Starting build')
+        try:
+            run_build(builder)
+        except Exception as exc: # noqa: BLE001
+            print(f'[red]Build failed[/red]: {exc!r}')
+        else:
+            print(f':stopwatch: Build took [json.number]{time.perf_counter() - stime:.2f}s')
+
+        if not os.path.isdir(builder.srcdir):
+            return
 
-    with open(builddb_path, 'w', encoding='utf8') as builddb_file:
-        json.dump([dataclasses.asdict(i) for i in builddb.values()], builddb_file)
-    print(f':stopwatch: Build took [json.number]{time.perf_counter() - stime:.2f}s')
+        with get_watcher(builder.srcdir) as watcher:
+            print(f'Watching {builder.srcdir} for changes ({watcher.name}), press Ctrl+C to stop')
+            while True:
+                changes = watcher.wait_for_changes(debounce)
+                stime = time.perf_counter()
+                if changes is None:
+                    print('Too many changes, rebuilding everything')
+                elif builder.verbose:
+                    print(f'Changed files: {sorted(changes)}')
+                try:
+                    run_build(builder, changes)
+                except Exception as exc: # noqa: BLE001
+                    print(f'[red]Rebuild failed[/red]: {exc!r}')
+                    continue
+                print(f':stopwatch: Rebuild took [json.number]{time.perf_counter() - stime:.2f}s')
@@ -0,0 +1,451 @@
+import contextlib
+import dataclasses
+import hashlib
+import json
+import os
+import sqlite3
+
+from .exceptions import ConfigError
+from .plugins.common import ConverterResult
+
+HASH_CHUNK_SIZE = 1 << 20
+SQLITE_HEADER = b'SQLite format 3\x00'
+FINGERPRINT_IGNORED_KEYS = frozenset(('overrides', 'pattern'))
+
+
+def stat_signature(stat):
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as fileobj:
+        while chunk := fileobj.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_config_fingerprint(converter_name, converter_config, extra=None, ignored_keys=()):
+    '''Hash the converter options that affect its output
+
+    Override lists and patterns only decide which options an asset uses, so
+    they are left out, as are ignored_keys (options that only control how
+    the converter runs). extra holds other settings the output depends on.
+    '''
+    options = {
+        key: value
+        for key, value in converter_config.items()
+        if key not in FINGERPRINT_IGNORED_KEYS and key not in ignored_keys
+    }
+    fingerprint = [converter_name, options]
+    if extra:
+        fingerprint.append(extra)
+    data = json.dumps(fingerprint, sort_keys=True, default=str)
+    return hashlib.blake2b(data.encode(), digest_size=20).hexdigest()
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, 'rb') as dbfile:
+            return dbfile.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except FileNotFoundError:
+        return False
+
+
+class BuildDB:
+    '''Record of converter results and the content hashes of their inputs
+
+    Content hashes are cached against a (size, mtime, inode) signature so a
+    file is only re-hashed when its stat signature changes. Subclasses
+    provide the storage for results and the stat cache.
+    '''
+
+    def __init__(self, path, srcdir):
+        self.path = path
+        self.srcdir = srcdir
+
+    def load(self):
+        pass
+
+    def save(self, *, prune_stats=True):
+        '''Write all changes, dropping cached stats of files no result uses if prune_stats'''
+
+    def commit(self):
+        '''Make changes so far visible to other processes without a full save()'''
+
+    def close(self):
+        pass
+
+    def get(self, output_file, default=None):
+        raise NotImplementedError
+
+    def put(self, result):
+        raise NotImplementedError
+
+    def output_files(self, input_file=None):
+        '''Return the recorded output files, optionally only those built from input_file'''
+        raise NotImplementedError
+
+    def remove(self, output_file):
+        raise NotImplementedError
+
+    def get_dependents(self, key):
+        '''Return the input files of results that list key as a dependency
+
+        key itself is never included, even if one of its results lists it.
+        '''
+        raise NotImplementedError
+
+    def get_stat(self, key):
+        raise NotImplementedError
+
+    def put_stat(self, key, value):
+        raise NotImplementedError
+
+    def __contains__(self, output_file):
+        return self.get(output_file) is not None
+
+    def __getitem__(self, output_file):
+        result = self.get(output_file)
+        if result is None:
+            raise KeyError(output_file)
+        return result
+
+    def add_result(self, result, hashes=None, hashed_at=0):
+        '''Record result along with the content hashes of its inputs
+
+        hashes should be taken before the converter ran (see
+        snapshot_hashes()), so a file changed during the conversion is not
+        recorded with its new content. Inputs missing from hashes (e.g.,
+        newly found dependencies) are hashed now, unless they were modified
+        after hashed_at (in nanoseconds), in which case no hash is recorded
+        and the result is never considered up-to-date.
+        '''
+        hashes = hashes or {}
+        result.hashes = {}
+        for key in (result.input_file, *result.dependencies):
+            if key in hashes:
+                result.hashes[key] = hashes[key]
+                continue
+            path = os.path.join(self.srcdir, key)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                result.hashes[key] = None
+                continue
+            if hashed_at and stat.st_mtime_ns >= hashed_at:
+                result.hashes[key] = None
+            else:
+                result.hashes[key] = self.get_hash(key, stat)
+        self.put(result)
+
+    def snapshot_hashes(self, output_file, input_file, input_stat=None):
+        '''Hash input_file and the recorded dependencies of output_file ahead of a build'''
+        hashes = {input_file: self.get_hash(input_file, input_stat)}
+        result = self.get(output_file)
+        if result is not None:
+            for key in result.dependencies:
+                hashes[key] = self.get_hash(key)
+        return hashes
+
+    def get_hash(self, key, stat=None):
+        '''Return the content hash of the asset at key (relative to srcdir)
+
+        Returns None if the file does not exist.
+        '''
+        path = os.path.join(self.srcdir, key)
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+
+        signature = stat_signature(stat)
+        cached = self.get_stat(key)
+        if cached is not None and cached[:-1] == signature:
+            return cached[-1]
+
+        try:
+            digest = hash_file(path)
+        except FileNotFoundError:
+            return None
+        self.put_stat(key, (*signature, digest))
+        return digest
+
+    def is_up_to_date(self, output_file, input_file, input_stat=None):
+        '''Check if the inputs recorded for output_file are unchanged
+
+        input_file and the recorded dependencies are relative to srcdir.
+        Entries without recorded hashes are never considered up-to-date.
+        '''
+        result = self.get(output_file)
+        if result is None or not result.hashes:
+            return False
+
+        if self.get_hash(input_file, input_stat) != result.hashes.get(input_file):
+            return False
+        return all(
+            key in result.hashes
+            and self.get_hash(key) == result.hashes[key]
+            for key in result.dependencies
+        )
+
+
+class JSONBuildDB(BuildDB):
+    '''Build database stored as a single JSON file that is rewritten on save'''
+
+    VERSION = 1
+
+    def __init__(self, path, srcdir):
+        super().__init__(path, srcdir)
+        self.results = {}
+        self.stats = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, encoding='utf8') as builddb_file:
+                data = json.load(builddb_file)
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            return
+
+        if isinstance(data, list):
+            # Builddb from before content hashes were tracked
+            data = {'results': data}
+
+        self.results = {
+            result.output_file: result
+            for result in (
+                ConverterResult(**i)
+                for i in data.get('results', [])
+            )
+        }
+        self.stats = {
+            key: tuple(value)
+            for key, value in data.get('stats', {}).items()
+        }
+
+    def save(self, *, prune_stats=True):
+        # Pruning is cheap here, since the whole file is rewritten anyway
+        referenced = {
+            key
+            for result in self.results.values()
+            for key in result.hashes
+        }
+        data = {
+            'version': self.VERSION,
+            'results': [dataclasses.asdict(i) for i in self.results.values()],
+            'stats': {
+                key: value
+                for key, value in self.stats.items()
+                if key in referenced
+            },
+        }
+        with open(self.path, 'w', encoding='utf8') as builddb_file:
+            json.dump(data, builddb_file)
+
+    def get(self, output_file, default=None):
+        return self.results.get(output_file, default)
+
+    def put(self, result):
+        self.results[result.output_file] = result
+
+    def output_files(self, input_file=None):
+        if input_file is None:
+            return list(self.results)
+        return [
+            result.output_file
+            for result in self.results.values()
+            if result.input_file == input_file
+        ]
+
+    def remove(self, output_file):
+        self.results.pop(output_file, None)
+
+    def get_dependents(self, key):
+        return {
+            result.input_file
+            for result in self.results.values()
+            if key in result.dependencies and result.input_file != key
+        }
+
+    def get_stat(self, key):
+        return self.stats.get(key)
+
+    def put_stat(self, key, value):
+        self.stats[key] = value
+
+
+class SQLiteBuildDB(BuildDB):
+    '''Build database stored in an indexed SQLite file
+
+    Results are looked up by output path on demand. Writes are committed
+    by commit() (e.g., after each job) and save(), and the database uses
+    write-ahead logging, so other pman processes can use it while a build
+    runs. A JSON builddb found at the same path is migrated on load.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS results (
+            output_file TEXT PRIMARY KEY,
+            input_file TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_input_file ON results (input_file);
+        CREATE TABLE IF NOT EXISTS inputs (
+            output_file TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (output_file, path)
+        );
+        CREATE INDEX IF NOT EXISTS inputs_path ON inputs (path);
+        CREATE TABLE IF NOT EXISTS stats (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            digest TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, path, srcdir):
+        super().__init__(path, srcdir)
+        self.conn = None
+        self.cache = {}
+
+    def load(self):
+        legacy_db = None
+        if os.path.exists(self.path) and not is_sqlite_file(self.path):
+            legacy_db = JSONBuildDB(self.path, self.srcdir)
+            legacy_db.load()
+            os.unlink(self.path)
+
+        try:
+            self.conn = self._connect()
+        except sqlite3.DatabaseError:
+            # Corrupt database, start over
+            os.unlink(self.path)
+            self.conn = self._connect()
+
+        if legacy_db is not None:
+            for result in legacy_db.results.values():
+                self.put(result)
+            for key, value in legacy_db.stats.items():
+                self.put_stat(key, value)
+            self.save()
+
+    def _connect(self):
+        # Wait for other processes to finish their writes instead of failing
+        # Callers using the builddb from several threads must serialize access
+        # (see OnDemandBuilder)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    def save(self, *, prune_stats=True):
+        if prune_stats:
+            # Scans every stat, so builds of a few assets skip this
+            self.conn.execute(
+                'DELETE FROM stats WHERE path NOT IN (SELECT path FROM inputs)'
+            )
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, output_file, default=None):
+        with contextlib.suppress(KeyError):
+            return self.cache[output_file]
+
+        row = self.conn.execute(
+            'SELECT data FROM results WHERE output_file = ?',
+            (output_file,)
+        ).fetchone()
+        if row is None:
+            return default
+        result = ConverterResult(**json.loads(row[0]))
+        self.cache[output_file] = result
+        return result
+
+    def put(self, result):
+        self.cache[result.output_file] = result
+        self.conn.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+            (result.output_file, result.input_file, json.dumps(dataclasses.asdict(result)))
+        )
+        self.conn.execute(
+            'DELETE FROM inputs WHERE output_file = ?',
+            (result.output_file,)
+        )
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO inputs VALUES (?, ?)',
+            [
+                (result.output_file, path)
+                for path in (result.input_file, *result.dependencies)
+            ]
+        )
+
+    def output_files(self, input_file=None):
+        if input_file is None:
+            rows = self.conn.execute('SELECT output_file FROM results')
+        else:
+            rows = self.conn.execute(
+                'SELECT output_file FROM results WHERE input_file = ?',
+                (input_file,)
+            )
+        return [row[0] for row in rows]
+
+    def remove(self, output_file):
+        self.cache.pop(output_file, None)
+        self.conn.execute('DELETE FROM results WHERE output_file = ?', (output_file,))
+        self.conn.execute('DELETE FROM inputs WHERE output_file = ?', (output_file,))
+
+    def get_dependents(self, key):
+        return {
+            row[0]
+            for row in self.conn.execute(
+                'SELECT results.input_file FROM inputs'
+                ' JOIN results USING (output_file)'
+                ' WHERE inputs.path = ? AND results.input_file != ?',
+                (key, key)
+            )
+        }
+
+    def get_stat(self, key):
+        row = self.conn.execute(
+            'SELECT size, mtime_ns, ino, digest FROM stats WHERE path = ?',
+            (key,)
+        ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put_stat(self, key, value):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?)',
+            (key, *value)
+        )
+
+
+BACKENDS = {
+    'sqlite': SQLiteBuildDB,
+    'json': JSONBuildDB,
+}
+
+
+def open_builddb(config, srcdir):
+    builddb_path = os.path.join(
+        config['internal']['projectdir'],
+        '.pman_builddb'
+    )
+    backend = config['build']['builddb_backend']
+    if backend not in BACKENDS:
+        raise ConfigError(f'Unknown builddb backend: {backend}')
+    builddb = BACKENDS[backend](builddb_path, srcdir)
+    builddb.load()
+    return builddb
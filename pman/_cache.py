@@ -0,0 +1,446 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import http.client
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+from rich import print  # noqa
+
+from ._copy import copy_file
+from ._utils import get_default_cache_dir
+from .plugins.common import ConverterResult
+
+CACHE_VERSION = 2
+TRIM_RATIO = 0.9
+REMOTE_JOBS = 8
+REMOTE_BATCH_SIZE = 1000
+
+OBJECT_ID_RE = re.compile(r'[0-9a-f]{40}')
+
+
+def get_stored_result(result):
+    '''Return the parts of a ConverterResult that are kept in the cache'''
+    return {
+        'input_file': result.input_file,
+        'output_file': result.output_file,
+        'dependencies': result.dependencies,
+        'duration': result.duration,
+    }
+
+
+def is_relative_path(path):
+    '''Whether path is a relative path that stays inside the directory it is relative to'''
+    if not isinstance(path, str) or not path or os.path.isabs(path):
+        return False
+    path = os.path.normpath(path)
+    return path != os.curdir and path.split(os.sep, 1)[0] != os.pardir
+
+
+def load_stored_result(data):
+    '''Return the ConverterResult stored by get_stored_result() (None if data is invalid)'''
+    if not isinstance(data, dict):
+        return None
+    input_file = data.get('input_file')
+    output_file = data.get('output_file')
+    dependencies = data.get('dependencies', [])
+    duration = data.get('duration', 0.0)
+    if (
+        not is_relative_path(input_file)
+        or not is_relative_path(output_file)
+        or not isinstance(dependencies, list)
+        or not all(is_relative_path(i) for i in dependencies)
+        or not isinstance(duration, (int, float))
+        or isinstance(duration, bool)
+    ):
+        return None
+    return ConverterResult(
+        input_file=os.path.normpath(input_file),
+        output_file=os.path.normpath(output_file),
+        dependencies=[os.path.normpath(i) for i in dependencies],
+        duration=float(duration),
+    )
+
+
+def load_variant(variant):
+    '''Validate a variant sent by a remote cache
+
+    Returns (object id, dependency hashes, results), or None if the variant
+    is malformed, e.g., if it has paths outside of the asset or export
+    directories.
+    '''
+    if not isinstance(variant, dict):
+        return None
+    objid = variant.get('object')
+    dependencies = variant.get('dependencies')
+    results = variant.get('results')
+    if (
+        not isinstance(objid, str)
+        or not OBJECT_ID_RE.fullmatch(objid)
+        or not isinstance(dependencies, dict)
+        or not all(
+            is_relative_path(key) and isinstance(value, str)
+            for key, value in dependencies.items()
+        )
+        or not isinstance(results, list)
+        or not results
+    ):
+        return None
+    results = [load_stored_result(i) for i in results]
+    if None in results:
+        return None
+    dependencies = {
+        os.path.normpath(key): value
+        for key, value in dependencies.items()
+    }
+    return objid, dependencies, results
+
+
+class ArtifactCache:
+    '''Content-addressed store of converter outputs shared by all projects
+
+    Entries are keyed by the converter config fingerprint, and the path and
+    content hash of the input. Since dependencies are only known after a
+    conversion, each key can have several variants that are told apart by
+    the content hashes of their dependencies (much like ccache manifests).
+    Outputs are copied into the store, and the least recently used objects
+    are evicted once the store grows past max_size bytes. Index updates are
+    kept in a transaction until save() is called.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS objects (
+            id TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL,
+            results TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+        CREATE TABLE IF NOT EXISTS variants (
+            key TEXT NOT NULL,
+            dependencies TEXT NOT NULL,
+            object TEXT NOT NULL,
+            PRIMARY KEY (key, dependencies)
+        );
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.objdir = os.path.join(path, 'objects')
+        self.known_dirs = set()
+        os.makedirs(self.objdir, exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(path, 'index.sqlite'),
+            timeout=30,
+            check_same_thread=False,
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+
+    def save(self):
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    @staticmethod
+    def make_key(config_hash, input_file, input_hash):
+        data = json.dumps([CACHE_VERSION, config_hash, input_file, input_hash])
+        return hashlib.blake2b(data.encode(), digest_size=20).hexdigest()
+
+    @staticmethod
+    def make_object_id(key, dependencies):
+        dependencies = json.dumps(dependencies, sort_keys=True)
+        return hashlib.blake2b(
+            f'{key}:{dependencies}'.encode(),
+            digest_size=20
+        ).hexdigest()
+
+    def get_object_path(self, objid, idx):
+        return os.path.join(self.objdir, objid[:2], f'{objid}-{idx}')
+
+    def get(self, key, get_hash):
+        '''Look up the cached results for key
+
+        get_hash is called with the path of each recorded dependency and must
+        return its current content hash. Returns the object ID and its results
+        (as stored by put()), or None.
+        '''
+        rows = self.conn.execute(
+            'SELECT dependencies, id, results FROM variants'
+            ' JOIN objects ON objects.id = variants.object'
+            ' WHERE key = ?',
+            (key,)
+        ).fetchall()
+        for dependencies, objid, results in rows:
+            if all(get_hash(dep) == value for dep, value in json.loads(dependencies).items()):
+                self.conn.execute(
+                    'UPDATE objects SET last_used = ? WHERE id = ?',
+                    (time.time(), objid)
+                )
+                return objid, [ConverterResult(**i) for i in json.loads(results)]
+        return None
+
+    def put(self, key, dependencies, results, dstdir):
+        '''Store the outputs of results (relative to dstdir) under key
+
+        dependencies maps each dependency of the results to its content hash.
+        '''
+        objid = self.make_object_id(key, dependencies)
+        shard = os.path.join(self.objdir, objid[:2])
+        if shard not in self.known_dirs:
+            os.makedirs(shard, exist_ok=True)
+            self.known_dirs.add(shard)
+
+        size = 0
+        for idx, result in enumerate(results):
+            objpath = self.get_object_path(objid, idx)
+            # Write to a temporary file first so other processes never see a
+            # partially written object
+            tmppath = f'{objpath}.{os.getpid()}.tmp'
+            try:
+                copy_file(os.path.join(dstdir, result.output_file), tmppath)
+                size += os.path.getsize(tmppath)
+                os.replace(tmppath, objpath)
+            except OSError:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmppath)
+                return
+
+        stored = [get_stored_result(i) for i in results]
+        self.conn.execute(
+            'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)',
+            (objid, size, time.time(), json.dumps(stored))
+        )
+        self.conn.execute(
+            'INSERT OR REPLACE INTO variants VALUES (?, ?, ?)',
+            (key, json.dumps(dependencies, sort_keys=True), objid)
+        )
+
+    def restore(self, objid, results, dstdir):
+        '''Copy the outputs of a cached object into dstdir'''
+        for idx, result in enumerate(results):
+            dst = os.path.join(dstdir, result.output_file)
+            dstparent = os.path.dirname(dst)
+            if dstparent not in self.known_dirs:
+                os.makedirs(dstparent, exist_ok=True)
+                self.known_dirs.add(dstparent)
+            copy_file(self.get_object_path(objid, idx), dst)
+
+    def get_size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+    def trim(self):
+        '''Evict least recently used objects until the cache fits in max_size'''
+        if self.max_size <= 0:
+            return
+
+        self.save()
+        size = self.get_size()
+        if size <= self.max_size:
+            return
+
+        target = self.max_size * TRIM_RATIO
+        evicted = []
+        for objid, objsize, results in self.conn.execute(
+            'SELECT id, size, results FROM objects ORDER BY last_used'
+        ).fetchall():
+            if size <= target:
+                break
+            evicted.append((objid, len(json.loads(results))))
+            size -= objsize
+
+        objids = [(objid,) for objid, _ in evicted]
+        with self.conn:
+            self.conn.executemany('DELETE FROM objects WHERE id = ?', objids)
+            self.conn.executemany('DELETE FROM variants WHERE object = ?', objids)
+        for objid, count in evicted:
+            for idx in range(count):
+                with contextlib.suppress(OSError):
+                    os.unlink(self.get_object_path(objid, idx))
+
+
+def open_artifact_cache(config):
+    '''Open the artifact cache configured for the project, or return None if it is disabled'''
+    buildconf = config['build']
+    if not buildconf['cache']:
+        return None
+
+    cachedir = buildconf['cache_dir'] or get_default_cache_dir()
+    with contextlib.suppress(OSError, sqlite3.Error):
+        return ArtifactCache(
+            os.path.expanduser(cachedir),
+            buildconf['cache_max_size'] * 1024 * 1024,
+        )
+
+    print(f'warning: could not open artifact cache at {cachedir}, building without it')
+    return None
+
+
+class RemoteCacheError(Exception):
+    pass
+
+
+class RemoteCache:
+    '''Client for a remote artifact cache served over HTTP
+
+    See pman.cache_server for the protocol. Entries use the same keys and
+    object IDs as ArtifactCache. Requests are spread over a pool of threads
+    (each with its own keep-alive connection), and uploads run in the
+    background until close() is called. Once a request fails, the remote
+    cache is not used for the rest of the session.
+    '''
+
+    def __init__(self, url, *, upload=True, jobs=REMOTE_JOBS):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.url = url
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.upload = upload
+        self.failed = False
+        self.local = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self.uploads = []
+
+    def close(self):
+        self.wait_for_uploads()
+        self.executor.shutdown()
+
+    def wait_for_uploads(self):
+        uploads, self.uploads = self.uploads, []
+        for future in uploads:
+            with contextlib.suppress(RemoteCacheError, OSError):
+                future.result()
+
+    def request(self, method, path, body=None):
+        '''Send a request, returning the response status and body'''
+        if self.failed:
+            raise RemoteCacheError('remote cache disabled after an earlier error')
+
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            if conn is None:
+                conn = self.local.conn = self.connection_class(self.netloc, timeout=30)
+            try:
+                conn.request(method, f'{self.prefix}{path}', body=body)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException) as exc:
+                # Kept-alive connections may have been closed by the server,
+                # so retry once on a new connection
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    self.failed = True
+                    print(f'warning: remote cache at {self.url} failed, disabling it: {exc}')
+                    raise RemoteCacheError(str(exc)) from exc
+        return None
+
+    def check_status(self, status, method, path):
+        if status >= 400 and status != 404:
+            self.failed = True
+            print(f'warning: remote cache at {self.url} returned {status} for {method} {path}')
+            raise RemoteCacheError(f'HTTP {status}')
+
+    def get_variants(self, keys):
+        '''Look up keys in batches, returning a dict of each stored key to its variants'''
+        keys = list(keys)
+        found = {}
+        for idx in range(0, len(keys), REMOTE_BATCH_SIZE):
+            status, data = self.request(
+                'POST',
+                '/ac',
+                json.dumps(keys[idx:idx + REMOTE_BATCH_SIZE]).encode(),
+            )
+            self.check_status(status, 'POST', '/ac')
+            if status != 200:
+                continue
+            try:
+                variants = json.loads(data)
+            except ValueError as exc:
+                raise RemoteCacheError(f'invalid response: {exc}') from exc
+            if not isinstance(variants, dict):
+                raise RemoteCacheError('invalid response: expected an object')
+            found.update(
+                (key, value)
+                for key, value in variants.items()
+                if isinstance(value, list)
+            )
+        return found
+
+    def download_object(self, objid, paths):
+        '''Download the output files of an object to paths, returning if all were found'''
+        for idx, path in enumerate(paths):
+            status, data = self.request('GET', f'/cas/{objid}-{idx}')
+            self.check_status(status, 'GET', f'/cas/{objid}-{idx}')
+            if status != 200:
+                return False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmppath = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmppath, 'wb') as outfile:
+                outfile.write(data)
+            os.replace(tmppath, path)
+        return True
+
+    def download_objects(self, objects):
+        '''Download objects concurrently
+
+        objects maps a name to an (object ID, output paths) pair. Returns the
+        names of the objects that were downloaded.
+        '''
+        futures = {
+            self.executor.submit(self.download_object, objid, paths): name
+            for name, (objid, paths) in objects.items()
+        }
+        downloaded = set()
+        for future in concurrent.futures.as_completed(futures):
+            with contextlib.suppress(RemoteCacheError, OSError):
+                if future.result():
+                    downloaded.add(futures[future])
+        return downloaded
+
+    def _upload(self, key, dependencies, results, dstdir):
+        objid = ArtifactCache.make_object_id(key, dependencies)
+        for idx, result in enumerate(results):
+            with open(os.path.join(dstdir, result.output_file), 'rb') as outfile:
+                data = outfile.read()
+            status, _ = self.request('PUT', f'/cas/{objid}-{idx}', data)
+            self.check_status(status, 'PUT', f'/cas/{objid}-{idx}')
+
+        variant = {
+            'dependencies': dependencies,
+            'object': objid,
+            'results': [get_stored_result(i) for i in results],
+        }
+        status, _ = self.request('PUT', f'/ac/{key}', json.dumps(variant).encode())
+        self.check_status(status, 'PUT', f'/ac/{key}')
+
+    def put(self, key, dependencies, results, dstdir):
+        '''Upload the outputs of results (relative to dstdir) in the background'''
+        if not self.upload or self.failed:
+            return
+        self.uploads.append(self.executor.submit(self._upload, key, dependencies, results, dstdir))
+
+
+def open_remote_cache(config):
+    '''Return a client for the configured remote artifact cache, or None if there is none'''
+    buildconf = config['build']
+    if not buildconf['remote_cache']:
+        return None
+    return RemoteCache(
+        buildconf['remote_cache'],
+        upload=buildconf['remote_cache_upload'],
+    )
@@ -0,0 +1,119 @@
+import contextlib
+import errno
+import os
+import shutil
+import sys
+
+COPY_STRATEGIES = ['reflink', 'hardlink', 'copy_file_range', 'copy']
+
+# Hardlinks share the inode (and mtime) with the source, so they are only
+# used when explicitly requested
+AUTO_STRATEGIES = ['reflink', 'copy_file_range', 'copy']
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Errors meaning a strategy does not work for a pair of filesystems
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.ENOSYS,
+    errno.EPERM,
+    errno.EBADF,
+    errno.EMLINK,
+    getattr(errno, 'EOPNOTSUPP', errno.ENOTSUP),
+    errno.ENOTSUP,
+}
+
+# (strategies, source device, destination device) -> index of the first working strategy
+_detected = {}
+
+
+def _reflink(src, dst):
+    if sys.platform != 'linux':
+        raise OSError(errno.ENOTSUP, 'reflinks are only supported on Linux')
+    import fcntl
+
+    with open(src, 'rb') as srcfile, open(dst, 'wb') as dstfile:
+        fcntl.ioctl(dstfile.fileno(), FICLONE, srcfile.fileno())
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _copy_file_range(src, dst):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range() is not available')
+
+    with open(src, 'rb') as srcfile, open(dst, 'wb') as dstfile:
+        remaining = os.fstat(srcfile.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(srcfile.fileno(), dstfile.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def _copy(src, dst):
+    shutil.copyfile(src, dst)
+
+
+_COPY_FUNCS = {
+    'reflink': _reflink,
+    'hardlink': _hardlink,
+    'copy_file_range': _copy_file_range,
+    'copy': _copy,
+}
+
+
+def get_strategies(preferred='auto'):
+    '''Return the strategies to try, in order, for a preferred strategy
+
+    The preferred strategy is tried first, followed by the automatic ones.
+    '''
+    if preferred == 'auto':
+        return AUTO_STRATEGIES
+    if preferred not in COPY_STRATEGIES:
+        raise ValueError(f'unknown copy strategy: {preferred}')
+    return [preferred, *(i for i in AUTO_STRATEGIES if i != preferred)]
+
+
+def _try_copy(func, src, dst):
+    '''Run a copy function, returning False if it is not supported here'''
+    try:
+        func(src, dst)
+    except OSError as exc:
+        if exc.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        with contextlib.suppress(OSError):
+            os.unlink(dst)
+        return False
+    return True
+
+
+def copy_file(src, dst, strategies=AUTO_STRATEGIES):
+    '''Copy src to dst with the first of strategies that works for their filesystems
+
+    The working strategy is remembered per pair of filesystems, so
+    unsupported strategies are only tried once. An existing dst is
+    replaced. Returns the name of the strategy that was used.
+    '''
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(dst)
+
+    key = (
+        tuple(strategies),
+        os.stat(src).st_dev,
+        os.stat(os.path.dirname(dst) or '.').st_dev,
+    )
+    start = _detected.get(key, 0)
+    for idx in range(start, len(strategies)):
+        if _try_copy(_COPY_FUNCS[strategies[idx]], src, dst):
+            _detected[key] = idx
+            return strategies[idx]
+
+    # The plain copy should always work, but raise its error if it does not
+    _copy(src, dst)
+    return 'copy'
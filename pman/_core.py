@@ -2,20 +2,22 @@ import contextlib
 import os
 import shlex
 import shutil
-
-import tomli as toml
+import subprocess
+import time
 
 from . import creationutils
-from ._build import build
 from ._utils import (
     disallow_frozen,
     ensure_config,
     get_abs_path,
     get_config,
     get_config_plugins,
+    get_python_program,
+    get_rel_path,
     run_hooks,
     run_script,
 )
+from .exceptions import BuildError
 
 
 @disallow_frozen
@@ -71,10 +73,90 @@ def run(config=None):
     run_script(config, args, cwd=config['internal']['projectdir'])
 
 
+def _get_setup_cfg_platforms(config):
+    '''Return the build_apps platforms listed in the project's setup.cfg (None if unset)'''
+    import configparser
+
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(get_abs_path(config, 'setup.cfg'), encoding='utf8')
+    except configparser.Error:
+        return None
+    value = parser.get('build_apps', 'platforms', fallback='')
+    platforms = [
+        platform.strip()
+        for line in value.splitlines()
+        for platform in line.split(',')
+        if platform.strip()
+    ]
+    return platforms or None
+
+
+def _dist_platform(pyprog, args, platform, cwd, logpath):
+    stime = time.perf_counter()
+    with open(logpath, 'w') as logfile:
+        returncode = subprocess.call(
+            [pyprog, *args, '-p', platform],
+            cwd=cwd,
+            stdout=logfile,
+            stderr=subprocess.STDOUT,
+        )
+    return returncode, time.perf_counter() - stime
+
+
+def _dist_platforms(config, args, platforms):
+    '''Run a build_apps/bdist_apps process per platform concurrently
+
+    Each process builds into its own build/<platform> directory, installers
+    all end up in dist/. Output is written to a log file per platform.
+    '''
+    projectdir = config['internal']['projectdir']
+    pyprog = get_python_program(config)
+    logdir = get_abs_path(config, 'build')
+    os.makedirs(logdir, exist_ok=True)
+
+    import concurrent.futures
+
+    max_workers = config['dist']['jobs']
+    if max_workers <= 0:
+        max_workers = len(platforms)
+
+    print(f'Building platforms in parallel: {", ".join(platforms)}')
+    stime = time.perf_counter()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for platform in platforms:
+            logpath = os.path.join(logdir, f'pman_dist_{platform}.log')
+            future = pool.submit(_dist_platform, pyprog, args, platform, projectdir, logpath)
+            futures[future] = (platform, logpath)
+
+        for future in concurrent.futures.as_completed(futures):
+            platform, logpath = futures[future]
+            returncode, duration = future.result()
+            if returncode == 0:
+                print(f'{platform}: finished in {duration:.2f}s')
+            else:
+                failed.append(platform)
+                print(
+                    f'{platform}: failed after {duration:.2f}s (exit code {returncode}), '
+                    f'see {get_rel_path(config, logpath)}'
+                )
+
+    print(f'Built {len(platforms)} platforms in {time.perf_counter() - stime:.2f}s')
+    if failed:
+        raise BuildError(f'Failed to build platforms: {", ".join(sorted(failed))}')
+
+
 @ensure_config
 @disallow_frozen
 @run_hooks
 def dist(config=None, build_installers=None, platforms=None):
+    # Only pull in the build machinery for the commands that need it
+    import tomli as toml
+
+    from ._build import build
+
     verbose = config['general']['verbose']
 
     build(config)
@@ -132,11 +214,22 @@ def dist(config=None, build_installers=None, platforms=None):
     else:
         args += ['build_apps']
 
-    if platforms is not None:
-        args += ['-p', f'{",".join(platforms)}']
+    # Platforms listed in pyproject.toml or setup.cfg are built in parallel
+    # (a setup.py can only be read by running it)
+    if platforms is None and setup_py_opts.get('platforms'):
+        platforms = list(setup_py_opts['platforms'])
+    if platforms is None:
+        platforms = _get_setup_cfg_platforms(config)
 
     try:
-        run_script(config, args, cwd=config['internal']['projectdir'])
+        if platforms is not None and len(platforms) > 1:
+            _dist_platforms(config, args, platforms)
+        else:
+            if platforms is not None:
+                args += ['-p', f'{",".join(platforms)}']
+            returncode = run_script(config, args, cwd=config['internal']['projectdir'])
+            if returncode != 0:
+                raise BuildError(f'{" ".join(args)} failed (exit code {returncode})')
     finally:
         if remove_requirements_txt:
             os.remove(requirements_path)
@@ -147,9 +240,16 @@ def dist(config=None, build_installers=None, platforms=None):
 @disallow_frozen
 @run_hooks
 def clean(config=None):
+    from ._pack import clean_packs
+    from ._stamp import clear_build_stamp
+
     export_dir = config['build']['export_dir']
     shutil.rmtree(get_abs_path(config, export_dir), ignore_errors=True)
     shutil.rmtree(get_abs_path(config, 'build'), ignore_errors=True)
     shutil.rmtree(get_abs_path(config, 'dist'), ignore_errors=True)
-    with contextlib.suppress(FileNotFoundError):
-        os.unlink(get_abs_path(config, '.pman_builddb'))
+    # Also remove the write-ahead log of a SQLite builddb
+    for suffix in ('', '-wal', '-shm'):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(get_abs_path(config, '.pman_builddb' + suffix))
+    clear_build_stamp(config)
+    clean_packs(config)
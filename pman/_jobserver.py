@@ -0,0 +1,259 @@
+import contextlib
+import os
+import select
+import shutil
+import tempfile
+import threading
+import weakref
+
+# Passed to child processes so tools started by converters can take part
+JOBSERVER_ENV = 'PMAN_JOBSERVER'
+
+GLOBAL_POOL = 'jobs'
+TOKEN = b'+'
+
+# How often a blocked acquire re-checks whether its job's own token is free
+POLL_INTERVAL = 0.1
+
+_local = threading.local()
+
+# Jobserver path -> JobServerClient, so each process opens the pipes once
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def is_jobserver_supported():
+    return hasattr(os, 'mkfifo')
+
+
+def _remove_jobserver(path, fds, pid):
+    if os.getpid() != pid:
+        # Forked worker processes must leave the pipes to the build process
+        return
+    with _clients_lock:
+        client = _clients.pop(path, None)
+    if client is not None:
+        client.close()
+    for fd in fds:
+        os.close(fd)
+    fds.clear()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class JobServer:
+    '''Hand out tokens that bound how many jobs run at once, like GNU make's jobserver
+
+    Tokens are bytes in named pipes: reading one acquires a token and
+    writing it back releases it, so any process that knows the directory
+    of the pipes can take part. There is a pool of jobs tokens shared by
+    everything, and a pool per entry of limits (e.g., {'blend2bam': 2})
+    for work that should be capped separately. The global pool is
+    compatible with GNU make's fifo jobserver (see get_environ()).
+    '''
+
+    def __init__(self, jobs, limits=None):
+        self.path = tempfile.mkdtemp(prefix='pman-jobserver-')
+        self.limits = {GLOBAL_POOL: jobs, **(limits or {})}
+        self._fds = []
+        # Also clean up jobservers that are never closed (e.g., the one
+        # used to build on demand while an application runs)
+        self._finalizer = weakref.finalize(
+            self, _remove_jobserver, self.path, self._fds, os.getpid()
+        )
+        try:
+            for name, count in self.limits.items():
+                fifopath = os.path.join(self.path, name)
+                os.mkfifo(fifopath)
+                # Keep the pipe open for writing so readers block instead of
+                # seeing EOF when no other process has it open
+                fd = os.open(fifopath, os.O_RDWR)
+                self._fds.append(fd)
+                os.write(fd, TOKEN * max(count, 1))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._finalizer()
+
+    def client(self):
+        return get_client(self.path)
+
+    def get_environ(self):
+        '''Return environment variables pointing child processes at this jobserver'''
+        return {
+            JOBSERVER_ENV: self.path,
+            'MAKEFLAGS': f' -j --jobserver-auth=fifo:{os.path.join(self.path, GLOBAL_POOL)}',
+        }
+
+
+def get_client(path):
+    '''Return the (shared) client for the jobserver at path'''
+    with _clients_lock:
+        if path not in _clients:
+            _clients[path] = JobServerClient(path)
+        return _clients[path]
+
+
+class JobServerClient:
+    '''Acquire and release tokens from a JobServer, possibly in another process
+
+    Use get_client() instead of creating clients directly, since each client
+    keeps the pipes open.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._fds = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+    def has_limit(self, name):
+        return name != GLOBAL_POOL and os.path.exists(os.path.join(self.path, name))
+
+    def _get_fd(self, name):
+        with self._lock:
+            if name not in self._fds:
+                self._fds[name] = os.open(
+                    os.path.join(self.path, name),
+                    os.O_RDWR | os.O_NONBLOCK,
+                )
+            return self._fds[name]
+
+    def try_acquire(self, name=GLOBAL_POOL):
+        '''Take a token from the named pool, returning False if none is free'''
+        try:
+            return os.read(self._get_fd(name), 1) == TOKEN
+        except BlockingIOError:
+            return False
+
+    def acquire(self, name=GLOBAL_POOL, cancel=None):
+        '''Wait for a token from the named pool
+
+        If cancel is given, it is called periodically and waiting stops
+        (returning False) once it returns True.
+        '''
+        fd = self._get_fd(name)
+        while not self.try_acquire(name):
+            if cancel is not None and cancel():
+                return False
+            select.select([fd], [], [], POLL_INTERVAL if cancel is not None else None)
+        return True
+
+    def release(self, name=GLOBAL_POOL):
+        os.write(self._get_fd(name), TOKEN)
+
+    def get_pools(self, converter_name, *, use_global=True):
+        '''Return the pools a job of converter_name takes tokens from
+
+        Limits come before the global pool, so jobs waiting on a limit do
+        not hold on to global tokens.
+        '''
+        pools = []
+        if converter_name and self.has_limit(converter_name):
+            pools.append(converter_name)
+        if use_global:
+            pools.append(GLOBAL_POOL)
+        return pools
+
+    @contextlib.contextmanager
+    def job(self, pools):
+        '''Hold a token from each of pools (see get_pools()) while running a job
+
+        While the job runs, its tokens are available from current_job() in
+        the same thread.
+        '''
+        acquired = []
+        try:
+            for pool in pools:
+                self.acquire(pool)
+                acquired.append(pool)
+            previous = getattr(_local, 'job', None)
+            _local.job = JobTokens(self, pools)
+            try:
+                yield _local.job
+            finally:
+                _local.job = previous
+        finally:
+            for pool in acquired:
+                self.release(pool)
+
+
+class JobTokens:
+    '''The tokens held by a running job
+
+    A job may run several things (e.g., external processes) at once with
+    slot(). The first slot uses the tokens the job already holds, while
+    additional slots have to acquire their own, so a job can always make
+    progress without risking a deadlock.
+    '''
+
+    def __init__(self, client, pools):
+        self.client = client
+        self.pools = pools
+        self._implicit = threading.Lock()
+
+    def _implicit_free(self):
+        return not self._implicit.locked()
+
+    def _acquire_slot(self):
+        '''Wait for a slot, returning the pools tokens were taken from
+
+        None means the job's own tokens were taken instead.
+        '''
+        acquired = []
+        while True:
+            if self._implicit.acquire(blocking=False):
+                for pool in acquired:
+                    self.client.release(pool)
+                return None
+            for pool in self.pools[len(acquired):]:
+                # Stop waiting if the job's own tokens become free first
+                if not self.client.acquire(pool, cancel=self._implicit_free):
+                    break
+                acquired.append(pool)
+            else:
+                return acquired
+
+    @contextlib.contextmanager
+    def slot(self):
+        acquired = self._acquire_slot()
+        try:
+            yield
+        finally:
+            if acquired is None:
+                self._implicit.release()
+            else:
+                for pool in acquired:
+                    self.client.release(pool)
+
+
+class _UnlimitedTokens:
+    '''Stand-in for JobTokens when there is no jobserver'''
+
+    @contextlib.contextmanager
+    def slot(self):
+        yield
+
+
+def current_job():
+    '''Return the JobTokens of the job running in this thread
+
+    Converters that start several processes at once should run each of
+    them in a slot() of this. Outside of a build, slots are unlimited.
+    '''
+    job = getattr(_local, 'job', None)
+    if job is None:
+        return _UnlimitedTokens()
+    return job
@@ -0,0 +1,195 @@
+import contextlib
+import json
+import os
+import shutil
+
+from ._utils import (
+    disallow_frozen,
+    ensure_config,
+    get_abs_path,
+)
+
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+ROOT_ARCHIVE = '__root__'
+ARCHIVE_EXTENSION = '.mf'
+
+# Where packed assets are shipped in deployed applications
+FROZEN_PACK_DIR = 'packed_assets'
+
+
+def get_archive_name(relpath):
+    '''Return the archive a file (relative to the export directory) is packed into
+
+    Files are grouped by their top-level directory, so changing a few files
+    only rewrites the archives that contain them.
+    '''
+    parts = relpath.split('/', 1)
+    if len(parts) == 1:
+        return ROOT_ARCHIVE
+    return parts[0]
+
+
+def scan_exports(exportdir):
+    '''Group the files of exportdir into {archive: {relpath: [size, mtime_ns]}}'''
+    archives = {}
+    for dirpath, _, filenames in os.walk(exportdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, exportdir).replace(os.sep, '/')
+            stat = os.stat(path)
+            archives.setdefault(get_archive_name(relpath), {})[relpath] = [
+                stat.st_size,
+                stat.st_mtime_ns,
+            ]
+    return archives
+
+
+def read_index(packdir):
+    try:
+        with open(os.path.join(packdir, INDEX_NAME), encoding='utf8') as indexfile:
+            index = json.load(indexfile)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def write_index(packdir, index):
+    path = os.path.join(packdir, INDEX_NAME)
+    tmppath = f'{path}.{os.getpid()}.tmp'
+    with open(tmppath, 'w', encoding='utf8') as indexfile:
+        json.dump(index, indexfile, indent=1)
+    os.replace(tmppath, path)
+
+
+def update_archive(exportdir, path, members, old_members, get_compression_level):
+    '''Bring the Multifile at path in line with members, only touching changed files
+
+    If old_members is empty, the archive is rewritten from scratch.
+    '''
+    import panda3d.core as p3d
+
+    multifile = p3d.Multifile()
+    mfpath = p3d.Filename.binary_filename(p3d.Filename.from_os_specific(path))
+    if old_members and os.path.exists(path):
+        opened = multifile.open_read_write(mfpath)
+    else:
+        opened = multifile.open_write(mfpath)
+    if not opened:
+        raise OSError(f'Failed to open {path}')
+
+    try:
+        for relpath in old_members.keys() - members.keys():
+            idx = multifile.find_subfile(relpath)
+            if idx >= 0:
+                multifile.remove_subfile(idx)
+
+        for relpath, signature in members.items():
+            if old_members.get(relpath) == signature:
+                continue
+            srcpath = os.path.join(exportdir, relpath.replace('/', os.sep))
+            multifile.add_subfile(
+                relpath,
+                p3d.Filename.binary_filename(p3d.Filename.from_os_specific(srcpath)),
+                get_compression_level(relpath),
+            )
+
+        if not multifile.flush():
+            raise OSError(f'Failed to write {path}')
+        if multifile.needs_repack():
+            multifile.repack()
+    finally:
+        multifile.close()
+
+
+@ensure_config
+@disallow_frozen
+def pack(config=None):
+    '''Pack the export directory into Multifile archives in the pack directory
+
+    An index of the packed files is stored next to the archives. Archives
+    whose files did not change since the last pack are left alone, and
+    changed archives are updated in place. Returns the names of the
+    archives that were written.
+    '''
+    from ._build import PatternMatcher
+
+    verbose = config['general']['verbose']
+    exportdir = get_abs_path(config, config['build']['export_dir'])
+    packdir = get_abs_path(config, config['build']['pack_dir'])
+    os.makedirs(packdir, exist_ok=True)
+
+    settings = [config['build']['pack_compression'], config['build']['pack_store_patterns']]
+    index = read_index(packdir)
+    old_archives = {}
+    if index is not None and index.get('settings') == settings:
+        old_archives = index['archives']
+    archives = scan_exports(exportdir) if os.path.isdir(exportdir) else {}
+
+    # Invalidate the index while archives are being modified
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(os.path.join(packdir, INDEX_NAME))
+
+    store_matcher = PatternMatcher(config['build']['pack_store_patterns'])
+    compression = config['build']['pack_compression']
+    def get_compression_level(relpath):
+        if store_matcher.match(relpath, relpath.rsplit('/', 1)[-1]) is not None:
+            return 0
+        return compression
+
+    written = []
+    for name, members in sorted(archives.items()):
+        path = os.path.join(packdir, name + ARCHIVE_EXTENSION)
+        old_members = old_archives.get(name, {})
+        if old_members == members and os.path.exists(path):
+            continue
+        if verbose:
+            print(f'Packing {name}{ARCHIVE_EXTENSION}')
+        update_archive(exportdir, path, members, old_members, get_compression_level)
+        written.append(name)
+
+    # Remove archives that no longer have any files (or are not in the index)
+    for filename in os.listdir(packdir):
+        name, ext = os.path.splitext(filename)
+        if ext == ARCHIVE_EXTENSION and name not in archives:
+            os.unlink(os.path.join(packdir, filename))
+
+    write_index(packdir, {
+        'version': INDEX_VERSION,
+        'settings': settings,
+        'archives': archives,
+    })
+    return written
+
+
+def clean_packs(config):
+    shutil.rmtree(get_abs_path(config, config['build']['pack_dir']), ignore_errors=True)
+
+
+def mount_packs(packdir, mount_point):
+    '''Mount the archives listed in the index of packdir at mount_point
+
+    packdir and mount_point are Panda Filenames. Returns the number of
+    mounted archives (0 if there is no index).
+    '''
+    import panda3d.core as p3d
+
+    vfs = p3d.VirtualFileSystem.get_global_ptr()
+    indexdata = vfs.read_file(p3d.Filename(packdir, INDEX_NAME), auto_unwrap=True)
+    if not indexdata:
+        return 0
+    try:
+        index = json.loads(indexdata)
+    except ValueError:
+        return 0
+    if index.get('version') != INDEX_VERSION:
+        return 0
+
+    count = 0
+    for name in sorted(index['archives']):
+        archive = p3d.Filename(packdir, name + ARCHIVE_EXTENSION)
+        if vfs.mount(archive, mount_point, p3d.VirtualFileSystem.MF_read_only):
+            count += 1
+    return count
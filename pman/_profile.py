@@ -0,0 +1,181 @@
+import contextlib
+import dataclasses
+import json
+import os
+import time
+
+from rich import (
+    print,  # noqa
+    table,
+)
+
+DEFAULT_PROFILE_PATH = 'pman_build_profile.json'
+SUMMARY_SIZE = 10
+
+
+@dataclasses.dataclass
+class JobRecord:
+    '''Timing of a single job, in seconds since the epoch'''
+    converter: str
+    assets: list
+    submitted: float
+    started: float = 0.0
+    finished: float = 0.0
+    pid: int = 0
+    tid: int = 0
+    error: str = ''
+
+    @property
+    def queue_wait(self):
+        return max(self.started - self.submitted, 0.0)
+
+    @property
+    def duration(self):
+        return max(self.finished - self.started, 0.0)
+
+
+@dataclasses.dataclass
+class SpanRecord:
+    '''A named span of time spent in the main build process'''
+    name: str
+    category: str
+    started: float
+    finished: float
+
+
+class BuildProfiler:
+    '''Collect timings of build phases, hooks, jobs, and assets
+
+    Wall clock times are used since jobs may run in other processes. The results
+    can be exported as a Chrome trace (viewable in chrome://tracing or
+    Perfetto) and summarized as a table of the slowest assets.
+    '''
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.spans = []
+        self.jobs = {}
+        self.assets = []
+
+    @contextlib.contextmanager
+    def span(self, name, category='build'):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append(SpanRecord(name, category, started, time.time()))
+
+    def job_submitted(self, key, converter, assets):
+        self.jobs[key] = JobRecord(
+            converter=converter,
+            assets=list(assets),
+            submitted=time.time(),
+        )
+
+    def job_finished(self, key, started, finished, pid, tid=0):
+        record = self.jobs[key]
+        record.started = started
+        record.finished = finished
+        record.pid = pid
+        record.tid = tid
+
+    def job_failed(self, key, error):
+        record = self.jobs[key]
+        record.error = repr(error)
+        if not record.finished:
+            record.started = record.finished = time.time()
+
+    def asset_built(self, converter, asset, duration):
+        self.assets.append((duration, converter, asset))
+
+    def get_trace_events(self):
+        def usec(seconds):
+            return round(seconds * 1_000_000)
+
+        events = [
+            {
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': self.pid,
+                'args': {'name': 'pman build'},
+            },
+        ]
+        events.extend(
+            {
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': usec(span.started),
+                'dur': usec(span.finished - span.started),
+                'pid': self.pid,
+                'tid': 0,
+            }
+            for span in self.spans
+        )
+
+        worker_pids = sorted({i.pid for i in self.jobs.values() if i.pid and i.pid != self.pid})
+        events.extend(
+            {
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': pid,
+                'args': {'name': f'worker {pid}'},
+            }
+            for pid in worker_pids
+        )
+        for record in self.jobs.values():
+            args = {
+                'assets': record.assets,
+                'queue_wait_ms': round(record.queue_wait * 1000, 3),
+            }
+            if record.error:
+                args['error'] = record.error
+            events.append({
+                'name': record.converter,
+                'cat': 'job',
+                'ph': 'X',
+                'ts': usec(record.started),
+                'dur': usec(record.duration),
+                'pid': record.pid or self.pid,
+                'tid': record.tid,
+                'args': args,
+            })
+        return events
+
+    def write_trace(self, path):
+        with open(path, 'w', encoding='utf8') as trace_file:
+            json.dump(
+                {
+                    'traceEvents': self.get_trace_events(),
+                    'displayTimeUnit': 'ms',
+                },
+                trace_file,
+            )
+
+    def print_summary(self, count=SUMMARY_SIZE):
+        jobs = self.jobs.values()
+        total_wait = sum(i.queue_wait for i in jobs)
+        total_work = sum(i.duration for i in jobs)
+        workers = len({(i.pid, i.tid) for i in jobs if i.pid})
+        print(
+            f'{len(self.jobs)} jobs on {workers} workers: '
+            f'[json.number]{total_work:.2f}s[/json.number] converting, '
+            f'[json.number]{total_wait:.2f}s[/json.number] waiting in queue'
+        )
+        hook_time = sum(
+            i.finished - i.started
+            for i in self.spans
+            if i.category == 'hook'
+        )
+        if hook_time:
+            print(f'Plugin hooks took [json.number]{hook_time:.2f}s')
+
+        if not self.assets:
+            return
+        summary = table.Table(title=f'Slowest {min(count, len(self.assets))} assets')
+        summary.add_column('Asset')
+        summary.add_column('Converter')
+        summary.add_column('Time', justify='right')
+        for duration, converter, asset in sorted(self.assets, reverse=True)[:count]:
+            summary.add_row(asset, converter, f'{duration:.3f}s')
+        print(summary)
@@ -0,0 +1,108 @@
+import time
+
+import rich
+from rich import (
+    live,
+    print,  # noqa
+    progress,
+    table,
+)
+
+REFRESH_RATE = 10
+
+
+class RichProgressReporter:
+    '''Live progress display for interactive terminals
+
+    Only jobs that are currently running have a row in the display (unless
+    show_all is set), and rich redraws at a fixed rate, so the cost of
+    reporting does not grow with the number of jobs.
+    '''
+
+    def __init__(self, total, *, show_all=False):
+        self.show_all = show_all
+        self.taskids = {}
+
+        self.job_progress = progress.Progress(
+            '[progress.description]{task.description}',
+            progress.SpinnerColumn(
+                finished_text='[progress.percentage]:heavy_check_mark:'
+            ),
+        )
+        self.overall_progress = progress.Progress(
+            '[progress.description]{task.description}',
+            progress.BarColumn(),
+            progress.MofNCompleteColumn(),
+        )
+        self.overall_task = self.overall_progress.add_task(
+            "All jobs",
+            total=total,
+        )
+
+        progress_table = table.Table.grid()
+        progress_table.add_row(self.job_progress)
+        progress_table.add_row(self.overall_progress)
+        self.live = live.Live(progress_table, refresh_per_second=REFRESH_RATE)
+
+    def __enter__(self):
+        self.live.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.live.refresh()
+        return self.live.__exit__(*exc)
+
+    def job_started(self, key, jobstr):
+        self.taskids[key] = self.job_progress.add_task(jobstr, total=None)
+
+    def job_finished(self, key, jobstr, *, error=None):
+        taskid = self.taskids.pop(key, None)
+        if error is not None:
+            self.live.console.print(f'[red]Job failed[/red] {jobstr}: {error!r}')
+        if self.show_all:
+            if taskid is None:
+                taskid = self.job_progress.add_task(jobstr)
+            self.job_progress.update(taskid, total=1, completed=1)
+        elif taskid is not None:
+            self.job_progress.remove_task(taskid)
+        self.overall_progress.advance(self.overall_task)
+
+
+class PlainProgressReporter:
+    '''Line-based progress output for logs (e.g., CI) where live displays do not work'''
+
+    REPORT_INTERVAL = 5.0
+
+    def __init__(self, total, *, show_all=False):
+        self.total = total
+        self.show_all = show_all
+        self.completed = 0
+        self.last_report = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def job_started(self, key, jobstr):
+        pass
+
+    def job_finished(self, _key, jobstr, *, error=None):
+        self.completed += 1
+        now = time.monotonic()
+        if error is not None:
+            print(f'[{self.completed}/{self.total}] Job failed {jobstr}: {error!r}')
+        elif self.show_all:
+            print(f'[{self.completed}/{self.total}] {jobstr}')
+        elif now - self.last_report >= self.REPORT_INTERVAL or self.completed == self.total:
+            print(f'Completed {self.completed}/{self.total} jobs')
+        else:
+            return
+        self.last_report = now
+
+
+def get_progress_reporter(total, *, show_all=False):
+    if rich.get_console().is_terminal:
+        return RichProgressReporter(total, show_all=show_all)
+    return PlainProgressReporter(total, show_all=show_all)
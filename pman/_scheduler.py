@@ -0,0 +1,175 @@
+import collections
+import concurrent.futures
+import dataclasses
+import queue
+from typing import (
+    Any,
+    Optional,
+)
+
+BATCHES_PER_WORKER = 4
+
+
+@dataclasses.dataclass(eq=False)
+class Job:
+    '''A batch of assets to run through a converter'''
+    converter: Any
+    converter_config: dict
+    assets: tuple
+    description: str
+    costs: tuple = ()
+    executor: str = 'process'
+    # Content hashes of the inputs, taken before the job was submitted
+    hashes: dict = dataclasses.field(default_factory=dict)
+    hashed_at: int = 0
+    prerequisites: set = dataclasses.field(default_factory=set)
+    dependents: set = dataclasses.field(default_factory=set)
+    future: Optional[concurrent.futures.Future] = None
+
+    @property
+    def cost(self):
+        return sum(self.costs)
+
+    def add_prerequisite(self, job):
+        if job is self:
+            return
+        self.prerequisites.add(job)
+        job.dependents.add(self)
+
+
+def make_batches(assets, costs, max_size, workers, min_cost=0):
+    '''Group assets into batches of roughly equal cost
+
+    costs maps each asset to its estimated cost. Batches are sized so every
+    worker gets several of them, no batch has more than max_size assets (if
+    max_size is not 0), and the most expensive assets are placed first.
+    Batches are only split below min_cost when they hit max_size, so tiny
+    assets are not run as separate jobs.
+    '''
+    ordered = sorted(assets, key=costs.__getitem__, reverse=True)
+    target = sum(costs[i] for i in assets) / (workers * BATCHES_PER_WORKER)
+
+    batches = []
+    batch = []
+    batch_cost = 0
+    for asset in ordered:
+        cost = costs[asset]
+        full = max_size and len(batch) >= max_size
+        if batch and (full or (batch_cost + cost > target and batch_cost >= min_cost)):
+            batches.append(tuple(batch))
+            batch = []
+            batch_cost = 0
+        batch.append(asset)
+        batch_cost += cost
+    if batch:
+        batches.append(tuple(batch))
+
+    return batches
+
+
+def _peel(jobs, incoming, outgoing):
+    '''Repeatedly remove jobs with no incoming edges from the remaining jobs'''
+    remaining = set(jobs)
+    count = {job: len(getattr(job, incoming) & remaining) for job in remaining}
+    ready = collections.deque(job for job, value in count.items() if value == 0)
+    while ready:
+        job = ready.popleft()
+        remaining.discard(job)
+        for other in getattr(job, outgoing) & remaining:
+            count[other] -= 1
+            if count[other] == 0:
+                ready.append(other)
+    return remaining
+
+
+def break_cycles(jobs):
+    '''Drop dependencies between jobs that are part of a dependency cycle
+
+    Returns the jobs that had dependencies dropped.
+    '''
+    # Jobs left after peeling from both ends are on (or between) cycles
+    cyclic = _peel(jobs, 'prerequisites', 'dependents')
+    cyclic = _peel(cyclic, 'dependents', 'prerequisites')
+    for job in cyclic:
+        for prerequisite in job.prerequisites & cyclic:
+            prerequisite.dependents.discard(job)
+            job.prerequisites.discard(prerequisite)
+    return list(cyclic)
+
+
+class JobScheduler:
+    '''Submit jobs once all of their prerequisites have finished
+
+    submit is called with a Job and must return a Future. Completed jobs are
+    collected with wait() and must then be passed to finish() or fail().
+    '''
+
+    def __init__(self, jobs, submit):
+        self.jobs = jobs
+        self.submit = submit
+        self.remaining = len(jobs)
+        self.done_queue = queue.SimpleQueue()
+        self.not_started = collections.defaultdict(collections.deque)
+        self.cancelled = set()
+
+    def start(self):
+        for job in self.jobs:
+            if not job.prerequisites:
+                self._submit(job)
+
+    def _submit(self, job):
+        job.future = self.submit(job)
+        self.not_started[job.executor].append(job)
+        job.future.add_done_callback(lambda _fut, job=job: self.done_queue.put(job))
+
+    def poll_started(self):
+        '''Return jobs that started running since the last call'''
+        # Pools start jobs in submission order, so only the oldest job of each
+        # executor that has not started yet needs to be checked
+        started = []
+        for not_started in self.not_started.values():
+            while not_started and (
+                not_started[0].future.running()
+                or not_started[0].future.done()
+            ):
+                job = not_started.popleft()
+                if not job.future.done():
+                    started.append(job)
+        return started
+
+    def wait(self, timeout):
+        '''Return jobs that have finished, waiting up to timeout seconds for one'''
+        try:
+            finished = [self.done_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while not self.done_queue.empty():
+            finished.append(self.done_queue.get_nowait())
+        return finished
+
+    def finish(self, job):
+        '''Mark job as successful and submit dependents that are now ready'''
+        self.remaining -= 1
+        for dependent in job.dependents:
+            dependent.prerequisites.discard(job)
+            if not dependent.prerequisites and dependent not in self.cancelled:
+                self._submit(dependent)
+
+    def fail(self, job):
+        '''Mark job as failed and cancel everything downstream of it
+
+        Returns the cancelled jobs.
+        '''
+        self.remaining -= 1
+        cancelled = []
+        pending = list(job.dependents)
+        while pending:
+            dependent = pending.pop()
+            if dependent in self.cancelled or dependent.future is not None:
+                continue
+            self.cancelled.add(dependent)
+            cancelled.append(dependent)
+            pending.extend(dependent.dependents)
+        self.remaining -= len(cancelled)
+        return cancelled
@@ -0,0 +1,101 @@
+import contextlib
+import hashlib
+import json
+import os
+
+from ._utils import get_abs_path
+from .config import Config
+
+STAMP_NAME = '.pman_buildstamp'
+STAMP_VERSION = 1
+
+
+def _get_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_source_stamp(config):
+    '''Hash the (path, size, mtime) of every asset and the project config files
+
+    This only needs to stat files, so it is much cheaper than a build, even
+    one where everything is up-to-date.
+    '''
+    projectdir = config['internal']['projectdir']
+    srcdir = get_abs_path(config, config['build']['asset_dir'])
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([
+        STAMP_VERSION,
+        srcdir,
+        [
+            _get_signature(os.path.join(projectdir, i))
+            for i in Config.PROJECT_CONFIG_NAMES
+        ],
+    ]).encode())
+
+    pending = [srcdir]
+    while pending:
+        dirpath = pending.pop()
+        try:
+            entries = sorted(os.scandir(dirpath), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                continue
+            with contextlib.suppress(OSError):
+                stat = entry.stat()
+                digest.update(f'{entry.path}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def get_output_stamp(config):
+    '''Return the signature of the export directory and builddb
+
+    This catches outputs being cleaned without checking every built file.
+    '''
+    return [
+        _get_signature(get_abs_path(config, config['build']['export_dir'])),
+        _get_signature(get_abs_path(config, '.pman_builddb')),
+    ]
+
+
+def get_stamp_path(config):
+    return get_abs_path(config, STAMP_NAME)
+
+
+def clear_build_stamp(config):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(get_stamp_path(config))
+
+
+def write_build_stamp(config, source_stamp):
+    '''Record a successful build of the sources described by source_stamp
+
+    source_stamp should be taken before the build starts, so changes made
+    while building are picked up by the next check.
+    '''
+    stamp = {
+        'sources': source_stamp,
+        'outputs': get_output_stamp(config),
+    }
+    with contextlib.suppress(OSError), open(get_stamp_path(config), 'w') as stampfile:
+        json.dump(stamp, stampfile)
+
+
+def is_build_current(config):
+    '''Check if nothing changed since the last successful build'''
+    try:
+        with open(get_stamp_path(config)) as stampfile:
+            stamp = json.load(stampfile)
+    except (OSError, ValueError):
+        return False
+
+    return (
+        stamp.get('outputs') == get_output_stamp(config)
+        and stamp.get('sources') == get_source_stamp(config)
+    )
@@ -1,4 +1,6 @@
+import contextlib
 import functools
+import json
 import os
 import shutil
 import subprocess
@@ -25,6 +27,94 @@ def get_rel_path(config, path):
     return os.path.relpath(path, config['internal']['projectdir'])
 
 
+CACHE_DIR_ENV = 'PMAN_CACHE_DIR'
+PYTHON_CACHE_NAME = 'python_programs.json'
+PYTHON_PROBE_SCRIPT = '''
+import json, os, site, sys
+dirs = list(sys.path)
+try:
+    dirs += site.getsitepackages() + [site.getusersitepackages()]
+except AttributeError:
+    pass
+try:
+    import panda3d, panda3d.core, direct
+    found = True
+    dirs.append(os.path.dirname(os.path.dirname(panda3d.__file__)))
+except ImportError:
+    found = False
+dirs = sorted(set(i for i in dirs if i and os.path.isabs(i)))
+print(json.dumps({'found': found, 'dirs': dirs}))
+'''
+
+
+def get_default_cache_dir():
+    cachedir = os.environ.get(CACHE_DIR_ENV)
+    if cachedir:
+        return cachedir
+
+    if sys.platform == 'win32':
+        basedir = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        basedir = os.path.expanduser('~/Library/Caches')
+    else:
+        basedir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(basedir, 'pman')
+
+
+def _get_path_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [path, None, None]
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+def _get_paths_signature(paths):
+    return [_get_path_signature(i) for i in paths]
+
+
+def _probe_python(pyprog, cache):
+    '''Check if pyprog can import Panda3D, using cached results where still valid
+
+    Results are cached against the mtimes of the interpreter and of the
+    directories on its sys.path, which change when packages are installed
+    or removed.
+    '''
+    path = shutil.which(pyprog)
+    if path is None:
+        return False
+
+    realpath = os.path.realpath(path)
+    pythonpath = os.environ.get('PYTHONPATH', '')
+    cached = cache.get(path)
+    if (
+        cached is not None
+        and cached['pythonpath'] == pythonpath
+        and cached['signature'] == _get_paths_signature([realpath, *cached['dirs']])
+    ):
+        return cached['found']
+
+    try:
+        output = subprocess.run(
+            [path, '-c', PYTHON_PROBE_SCRIPT],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=True,
+        ).stdout
+        info = json.loads(output.strip().splitlines()[-1])
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return False
+
+    cache[path] = {
+        'found': info['found'],
+        'dirs': info['dirs'],
+        'pythonpath': pythonpath,
+        'signature': _get_paths_signature([realpath, *info['dirs']]),
+    }
+    return info['found']
+
+
 def get_python_program(config=None):
     python_programs = [
         'ppython',
@@ -38,32 +128,45 @@ def get_python_program(config=None):
         if confpy:
             python_programs.insert(0, confpy)
 
+    cache_path = os.path.join(get_default_cache_dir(), PYTHON_CACHE_NAME)
+    try:
+        with open(cache_path, encoding='utf8') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+    original_cache = json.dumps(cache, sort_keys=True)
+
     # Check to see if there is a version of Python that can import panda3d
+    found = None
     for pyprog in python_programs:
-        args = [
-            pyprog,
-            '-c',
-            'import panda3d.core; import direct',
-        ]
-        try:
-            retcode = subprocess.call(args, stderr=subprocess.DEVNULL)
-        except FileNotFoundError:
-            retcode = 1
+        if _probe_python(pyprog, cache):
+            found = pyprog
+            break
 
-        if retcode == 0:
-            return pyprog
+    if json.dumps(cache, sort_keys=True) != original_cache:
+        with contextlib.suppress(OSError):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf8') as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(tmp_path, cache_path)
+
+    if found is not None:
+        return found
 
     # We couldn't find a python program to run
     raise CouldNotFindPythonError('Could not find a Python version with Panda3D installed')
 
 
 def run_program(_config, args, cwd=None):
-    subprocess.call(args, cwd=cwd)
+    '''Run a program, returning its exit code'''
+    return subprocess.call(args, cwd=cwd)
 
 
 def run_script(config, args, cwd=None):
+    '''Run a Python script with the project's Python, returning its exit code'''
     pyprog = get_python_program(config)
-    run_program(config, [pyprog, *args], cwd=cwd)
+    return run_program(config, [pyprog, *args], cwd=cwd)
 
 
 def get_config_plugins(config, has_attr=None):
@@ -87,8 +190,7 @@ def get_config(startdir=None):
         except CouldNotFindPythonError:
             pass
 
-    plist = get_config_plugins(config)
-    found_plugins = [i.name for i in plist]
+    found_plugins = plugins.get_plugin_names()
     for plugname in config['general']['plugins']:
         if plugname not in found_plugins:
             raise ConfigError(f'Failed to load requested plugin: {plugname}')
@@ -133,19 +235,23 @@ def disallow_frozen(func):
     return wrapper
 
 
+def call_hooks(config, hook_name, profiler=None):
+    for plugin in get_config_plugins(config, hook_name):
+        if profiler is None:
+            getattr(plugin, hook_name)(config)
+            continue
+        with profiler.span(f'{plugin.name}.{hook_name}', 'hook'):
+            getattr(plugin, hook_name)(config)
+
+
 def run_hooks(func):
     prehook_name = f'pre_{func.__name__}'
     posthook_name = f'post_{func.__name__}'
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         config = _config_from_args(args, kwargs)
-        prehooks = get_config_plugins(config, prehook_name)
-        posthooks = get_config_plugins(config, posthook_name)
-
-        for plugin in prehooks:
-            getattr(plugin, prehook_name)(config)
+        call_hooks(config, prehook_name)
         retval = func(*args, **kwargs)
-        for plugin in posthooks:
-            getattr(plugin, posthook_name)(config)
+        call_hooks(config, posthook_name)
         return retval
     return wrapper
@@ -0,0 +1,198 @@
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+INOTIFY_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    '''Detect changed files by periodically re-scanning the directory'''
+
+    name = 'polling'
+
+    def __init__(self, srcdir, interval=0.5):
+        self.srcdir = srcdir
+        self.interval = interval
+        self.snapshot = self._take_snapshot()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for root, _dirs, files in os.walk(self.srcdir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                with contextlib.suppress(OSError):
+                    stat = os.stat(path)
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return snapshot
+
+    def _poll(self):
+        snapshot = self._take_snapshot()
+        changes = {
+            path
+            for path in snapshot.keys() | self.snapshot.keys()
+            if snapshot.get(path) != self.snapshot.get(path)
+        }
+        self.snapshot = snapshot
+        return changes
+
+    def wait_for_changes(self, debounce):
+        '''Block until files change and return the set of changed paths
+
+        Changes are collected until no new changes show up for debounce
+        seconds.
+        '''
+        changes = set()
+        while not changes:
+            time.sleep(self.interval)
+            changes = self._poll()
+
+        while True:
+            time.sleep(debounce)
+            new_changes = self._poll()
+            if not new_changes:
+                break
+            changes |= new_changes
+
+        return changes
+
+
+class InotifyWatcher:
+    '''Detect changed files using inotify (Linux only)
+
+    wait_for_changes() returns None if the kernel event queue overflowed,
+    in which case the caller should assume anything may have changed.
+    '''
+
+    name = 'inotify'
+
+    def __init__(self, srcdir):
+        self.srcdir = srcdir
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        try:
+            self._add_tree(srcdir)
+        except OSError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _add_watch(self, dirpath):
+        wdesc = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), INOTIFY_MASK)
+        if wdesc < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dirpath)
+        self.watches[wdesc] = dirpath
+
+    def _add_tree(self, dirpath):
+        '''Watch dirpath and its sub-directories, returning the files found in them'''
+        self._add_watch(dirpath)
+        found = set()
+        for root, dirs, files in os.walk(dirpath):
+            for dirname in dirs:
+                self._add_watch(os.path.join(root, dirname))
+            found.update(os.path.join(root, i) for i in files)
+        return found
+
+    def _read_events(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return None
+
+        changes = set()
+        with contextlib.suppress(BlockingIOError):
+            while data := os.read(self.fd, 64 * 1024):
+                offset = 0
+                while offset < len(data):
+                    wdesc, mask, _, namelen = INOTIFY_EVENT.unpack_from(data, offset)
+                    offset += INOTIFY_EVENT.size
+                    name = os.fsdecode(data[offset:offset + namelen].rstrip(b'\0'))
+                    offset += namelen
+
+                    if mask & IN_Q_OVERFLOW:
+                        changes.add(None)
+                        continue
+                    if mask & IN_IGNORED:
+                        self.watches.pop(wdesc, None)
+                        continue
+                    dirpath = self.watches.get(wdesc)
+                    if dirpath is None or not name:
+                        continue
+
+                    path = os.path.join(dirpath, name)
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            with contextlib.suppress(OSError):
+                                changes |= self._add_tree(path)
+                    else:
+                        changes.add(path)
+        return changes
+
+    def wait_for_changes(self, debounce):
+        '''Block until files change and return the set of changed paths
+
+        Changes are collected until no new events show up for debounce
+        seconds.
+        '''
+        changes = set()
+        while not changes:
+            changes = self._read_events(None) or set()
+
+        while (new_changes := self._read_events(debounce)) is not None:
+            changes |= new_changes
+
+        if None in changes:
+            return None
+        return changes
+
+
+def get_watcher(srcdir):
+    if sys.platform.startswith('linux'):
+        with contextlib.suppress(OSError, AttributeError, TypeError):
+            return InotifyWatcher(srcdir)
+    return PollingWatcher(srcdir)
@@ -0,0 +1,62 @@
+'''Long-running Blender script used by the blend2bam plugin's persistent workers
+
+Usage: blender --background -P blend2bam_worker.py -- <blend2bam exportgltf.py path>
+
+Requests are read from stdin as one JSON object per line with "settings",
+"src" (.blend) and "dst" (.gltf) keys. A line starting with RESPONSE_PREFIX
+is written to stdout in response to each request. The worker exits when
+stdin is closed.
+'''
+import importlib.util
+import json
+import os
+import sys
+import traceback
+
+import bpy
+
+RESPONSE_PREFIX = '@@pman-blend2bam@@ '
+
+
+def load_exporter(script_path):
+    spec = importlib.util.spec_from_file_location('blend2bam_exportgltf', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def respond(**response):
+    sys.stdout.write(RESPONSE_PREFIX + json.dumps(response) + '\n')
+    sys.stdout.flush()
+
+
+def main():
+    args = sys.argv[sys.argv.index('--') + 1:]
+    exporter = load_exporter(args[0])
+
+    addon_prefs = bpy.context.preferences.addons['io_scene_gltf2'].preferences
+    if addon_prefs is not None and 'allow_embedded_format' in addon_prefs:
+        addon_prefs['allow_embedded_format'] = True
+
+    respond(ok=True, ready=True)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        src = request['src']
+        try:
+            bpy.ops.wm.open_mainfile(filepath=src)
+            dependencies = [
+                os.path.normpath(bpy.path.abspath(lib.filepath))
+                for lib in bpy.data.libraries
+            ]
+            exporter.export_gltf(request['settings'], src, request['dst'])
+        except Exception: # noqa: BLE001
+            traceback.print_exc(file=sys.stderr)
+            respond(ok=False, error=f'Failed to convert {src}')
+        else:
+            respond(ok=True, dependencies=dependencies)
+
+
+main()
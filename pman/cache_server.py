@@ -0,0 +1,200 @@
+'''Reference server for the pman remote artifact cache
+
+The protocol is plain HTTP:
+
+* ``GET /ac/<key>`` returns a JSON list of the variants stored for a cache
+  key, ``PUT /ac/<key>`` adds a variant (a JSON object with ``dependencies``,
+  ``object``, and ``results``) replacing any with the same dependencies
+* ``POST /ac`` with a JSON list of keys returns a JSON object mapping each of
+  those keys that is stored to its variants
+* ``GET /cas/<name>`` and ``PUT /cas/<name>`` download and upload output files
+
+Keys and object IDs are 40 character hex strings.
+'''
+
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import re
+import threading
+
+KEY_RE = re.compile(r'[0-9a-f]{40}')
+BLOB_RE = re.compile(r'[0-9a-f]{40}-[0-9]+')
+MAX_AC_SIZE = 16 * 1024 * 1024
+
+
+class CacheStorage:
+    '''Stores cache entries and output files in a directory'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def get_path(self, kind, name):
+        return os.path.join(self.path, kind, name[:2], name)
+
+    def read(self, kind, name):
+        try:
+            with open(self.get_path(kind, name), 'rb') as datafile:
+                return datafile.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, kind, name, data):
+        path = self.get_path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmppath, 'wb') as datafile:
+            datafile.write(data)
+        os.replace(tmppath, path)
+
+    def add_variant(self, key, variant):
+        with self.lock:
+            variants = json.loads(self.read('ac', key) or b'[]')
+            variants = [
+                i
+                for i in variants
+                if i['dependencies'] != variant['dependencies']
+            ]
+            variants.append(variant)
+            self.write('ac', key, json.dumps(variants).encode())
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pman-cache'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args): # noqa: A002
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_data(self, status, data=b'', content_type='application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def read_body(self, max_size=None):
+        length = int(self.headers.get('Content-Length', 0))
+        if max_size is not None and length > max_size:
+            raise ValueError('request body too large')
+        return self.rfile.read(length)
+
+    def parse_path(self):
+        '''Split the request path into the kind of data and a validated name'''
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'ac' and KEY_RE.fullmatch(parts[1]):
+            return parts
+        if len(parts) == 2 and parts[0] == 'cas' and BLOB_RE.fullmatch(parts[1]):
+            return parts
+        return None, None
+
+    def do_GET(self): # noqa: N802
+        kind, name = self.parse_path()
+        data = self.server.storage.read(kind, name) if kind else None
+        if data is None:
+            self.send_data(404)
+        elif kind == 'ac':
+            self.send_data(200, data, 'application/json')
+        else:
+            self.send_data(200, data)
+
+    def do_PUT(self): # noqa: N802
+        kind, name = self.parse_path()
+        if kind is None:
+            self.read_body()
+            self.send_data(404)
+            return
+
+        try:
+            if kind == 'ac':
+                variant = json.loads(self.read_body(MAX_AC_SIZE))
+                if not isinstance(variant, dict) or not {
+                    'dependencies', 'object', 'results'
+                } <= variant.keys():
+                    raise ValueError('invalid cache entry')
+                self.server.storage.add_variant(name, variant)
+            else:
+                self.server.storage.write(kind, name, self.read_body())
+        except ValueError:
+            self.send_data(400)
+            self.close_connection = True
+            return
+        self.send_data(204)
+
+    def do_POST(self): # noqa: N802
+        if self.path.strip('/') != 'ac':
+            self.read_body()
+            self.send_data(404)
+            return
+
+        try:
+            keys = json.loads(self.read_body(MAX_AC_SIZE))
+        except ValueError:
+            self.send_data(400)
+            self.close_connection = True
+            return
+        found = {}
+        for key in keys:
+            if not isinstance(key, str) or not KEY_RE.fullmatch(key):
+                continue
+            data = self.server.storage.read('ac', key)
+            if data is not None:
+                found[key] = json.loads(data)
+        self.send_data(200, json.dumps(found).encode(), 'application/json')
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, storage_path, *, verbose=False):
+        super().__init__(address, CacheRequestHandler)
+        self.storage = CacheStorage(storage_path)
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a remote artifact cache for pman builds'
+    )
+    parser.add_argument(
+        'directory',
+        help='directory to store cached files in',
+    )
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='address to listen on (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8470,
+        help='port to listen on (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='log requests',
+    )
+
+    args = parser.parse_args()
+
+    server = CacheServer((args.host, args.port), args.directory, verbose=args.verbose)
+    print(f'Serving pman cache from {args.directory} at {server.url}')
+    with contextlib.suppress(KeyboardInterrupt), server:
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
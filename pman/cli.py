@@ -1,5 +1,4 @@
 import argparse
-from importlib.metadata import version
 import subprocess
 import sys
 
@@ -16,8 +15,13 @@ def update(args, config):
     pman.create_project(config['internal']['projectdir'], plugins)
 
 
-def build(_, config):
-    pman.build(config)
+def build(args, config):
+    if args.prune:
+        pman.prune(config, dry_run=True)
+    elif args.watch:
+        pman.watch(config)
+    else:
+        pman.build(config, profile=args.profile)
 
 
 def run(_, config):
@@ -49,14 +53,25 @@ def clean(_, config):
     pman.clean(config)
 
 
+class VersionAction(argparse.Action):
+    '''Print the pman version, only looking it up when requested'''
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, **kwargs):
+        super().__init__(option_strings, dest=dest, default=argparse.SUPPRESS, nargs=0, **kwargs)
+
+    def __call__(self, parser, _namespace, _values, _option_string=None):
+        from importlib.metadata import version
+        parser.exit(message=f'{parser.prog} {version("panda3d-pman")}\n')
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Tool for building and managing Panda3D applications'
     )
     parser.add_argument(
         '--version',
-        action='version',
-        version=f'%(prog)s {version("panda3d-pman")}',
+        action=VersionAction,
+        help="show program's version number and exit",
     )
 
     parser.add_argument(
@@ -102,6 +117,28 @@ def main():
         'build',
         help='Build project',
     )
+    build_mode = build_parser.add_mutually_exclusive_group()
+    build_mode.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help='Keep running and rebuild assets when they change',
+    )
+    build_mode.add_argument(
+        '--profile',
+        action='store',
+        nargs='?',
+        const=True,
+        metavar='FILE',
+        help=(
+            'Record per-job timings as a Chrome trace '
+            '(defaults to pman_build_profile.json) and list the slowest assets'
+        ),
+    )
+    build_mode.add_argument(
+        '--prune',
+        action='store_true',
+        help='List stale outputs that a build would remove, without building',
+    )
     build_parser.set_defaults(func=build)
 
     run_parser = subparsers.add_parser(
@@ -146,10 +183,10 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    if pman.config_exists():
+    try:
         config = pman.get_config()
         config['general']['verbose'] = args.verbose or config['general']['verbose']
-    else:
+    except pman.NoConfigError:
         config = None
     try:
         args.func(args, config)
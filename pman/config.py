@@ -1,3 +1,4 @@
+import copy
 import functools
 import os
 from dataclasses import (
@@ -9,10 +10,9 @@ from dataclasses import (
 from typing import (
     Any,
     ClassVar,
+    Literal,
 )
 
-import tomli as toml
-
 from . import plugins
 from .exceptions import NoConfigError
 
@@ -27,6 +27,39 @@ def _merge_dict(dst: dict, src: dict):
     return dst
 
 
+@functools.lru_cache(maxsize=8)
+def _read_config_files(cfgpaths, _signature):
+    '''Parse and merge config files
+
+    Results are cached in memory for the (path, mtime, size) signature of
+    the files. This only helps long-running processes that load the config
+    repeatedly (e.g., the shim or tests), a one-shot command parses the
+    files once either way.
+    '''
+    import tomli as toml
+
+    confs = []
+    for confpath in cfgpaths:
+        with (open(confpath, 'rb')) as conffile:
+            conf = toml.load(conffile)
+            if 'tool' in conf and 'pman' in conf['tool']:
+                conf = conf['tool']['pman']
+            confs.append(conf)
+
+    return functools.reduce(
+        _merge_dict,
+        [
+            {},
+            *confs,
+            {
+                'internal': {
+                    'projectdir': os.path.dirname(cfgpaths[0]),
+                },
+            },
+        ]
+    )
+
+
 def dataclass_from_dict(dataclass_type, data):
     def value_for_field(field_obj):
         val = data[field_obj.name]
@@ -53,6 +86,62 @@ class ConfigBase:
         return hasattr(self, key)
 
 
+class PluginConfigs(dict):
+    '''Plugin config sections keyed by each plugin's CONFIG_KEY
+
+    Sections are only converted into a plugin's Config dataclass when they
+    are first accessed, so plugins are not imported just to load the config.
+    '''
+
+    FALLBACK_PLUGIN = 'copyfile'
+
+    def __init__(self, plugin_names=(), data=None):
+        super().__init__()
+        self.plugin_names = list(plugin_names)
+        # copyfile is used for any asset no other converter handles
+        if self.FALLBACK_PLUGIN not in self.plugin_names:
+            self.plugin_names.append(self.FALLBACK_PLUGIN)
+        self.data = data or {}
+        self.complete = False
+
+    def _add_plugin_configs(self, plugin_names):
+        for pluginobj in plugins.get_plugins(filter_names=plugin_names):
+            if not hasattr(pluginobj, 'Config') or not hasattr(pluginobj, 'CONFIG_KEY'):
+                continue
+            configkey = pluginobj.CONFIG_KEY
+            if not dict.__contains__(self, configkey):
+                self[configkey] = dataclass_from_dict(
+                    pluginobj.Config,
+                    self.data.get(configkey, {})
+                )
+
+    def _load(self, key):
+        if dict.__contains__(self, key) or self.complete:
+            return
+
+        # Plugins normally use their name as their config key
+        if key in self.plugin_names:
+            self._add_plugin_configs([key])
+            if dict.__contains__(self, key):
+                return
+
+        if self.plugin_names:
+            self._add_plugin_configs(self.plugin_names)
+        self.complete = True
+
+    def __getitem__(self, key):
+        self._load(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._load(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self._load(key)
+        return super().get(key, default)
+
+
 @dataclass
 class GeneralConfig(ConfigBase):
     DEFAULT_PLUGINS: ClassVar[list[str]] = [
@@ -84,6 +173,20 @@ class BuildConfig(ConfigBase):
     ignore_patterns: list[str] = field(default_factory=lambda:['*blend1', '*.blend2'])
     show_all_jobs: bool = False
     jobs: int = 0
+    converter_jobs: dict[str, int] = field(default_factory=dict)
+    builddb_backend: Literal['sqlite', 'json'] = 'sqlite'
+    prune: bool = True
+    cache: bool = True
+    cache_dir: str = ''
+    cache_max_size: int = 5120
+    remote_cache: str = ''
+    remote_cache_upload: bool = True
+    pack: bool = False
+    pack_dir: str = '.packed_assets/'
+    pack_compression: int = 6
+    pack_store_patterns: list[str] = field(default_factory=lambda: [
+        '*.png', '*.jpg', '*.jpeg', '*.ogg', '*.mp3', '*.opus', '*.zip', '*.gz', '*.pz',
+    ])
     streams: list[StreamConfig] = field(default_factory=list)
 
 
@@ -92,11 +195,14 @@ class RunConfig(ConfigBase):
     main_file: str = 'main.py'
     extra_args: str = ''
     auto_build: bool = True
+    auto_build_background: bool = False
+    build_on_demand: bool = False
 
 
 @dataclass
 class DistConfig(ConfigBase):
     build_installers: bool = True
+    jobs: int = 0
 
 
 @dataclass
@@ -123,7 +229,16 @@ class Config(ConfigBase):
     dist: DistConfig = field(default_factory=DistConfig)
     python: PythonConfig = field(default_factory=PythonConfig)
     internal: InternalConfig = field(default_factory=InternalConfig)
-    plugins: dict[str, dict[str, Any]] = field(default_factory=dict)
+    plugins: dict[str, Any] = field(default_factory=PluginConfigs)
+
+    def __getattr__(self, key):
+        # Plugin config sections are available as attributes too
+        if key.startswith('_') or key == 'plugins' or 'plugins' not in self.__dict__:
+            raise AttributeError(key)
+        try:
+            return self.plugins[key]
+        except KeyError:
+            raise AttributeError(key) from None
 
     @classmethod
     def load(cls, startdir: str) -> 'Config':
@@ -155,38 +270,15 @@ class Config(ConfigBase):
             dirs.pop()
 
         if cfgpaths:
-            confs = []
+            signature = []
             for confpath in cfgpaths:
-                with (open(confpath, 'rb')) as conffile:
-                    conf = toml.load(conffile)
-                    if 'tool' in conf and 'pman' in conf['tool']:
-                        conf = conf['tool']['pman']
-                    confs.append(conf)
-
-            confdata = functools.reduce(
-                _merge_dict,
-                [
-                    {},
-                    *confs,
-                    {
-                        'internal': {
-                            'projectdir': os.path.dirname(cfgpaths[0]),
-                        },
-                    },
-                ]
-            )
+                stat = os.stat(confpath)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+
+            # Copy the cached data since configs are modified after loading
+            confdata = copy.deepcopy(_read_config_files(tuple(cfgpaths), tuple(signature)))
             confobj = dataclass_from_dict(cls, confdata)
-            plist = plugins.get_plugins(filter_names=confobj.general.plugins)
-            for pluginobj in plist:
-                if hasattr(pluginobj, 'Config') and hasattr(pluginobj, 'CONFIG_KEY'):
-                    configkey = pluginobj.CONFIG_KEY
-                    configobj = pluginobj.Config
-                    plugconf = dataclass_from_dict(
-                        configobj,
-                        confdata.get(configkey, {})
-                    )
-                    setattr(confobj, configkey, plugconf)
-                    confobj.plugins[configkey] = plugconf
+            confobj.plugins = PluginConfigs(confobj.general.plugins, confdata)
             return confobj
 
         # No config found
@@ -1,5 +1,7 @@
 import argparse
 import os
+import sys
+import threading
 
 import panda3d.core as p3d
 
@@ -10,9 +12,31 @@ bam-texture-mode unchanged
 
 p3d.load_prc_file_data('', CONFIG_DATA)
 
-
-def make_texpath_relative(node, srcdir, converted_textures):
+# Guards the global model path and config changes of retarget_bam_textures()
+_retarget_lock = threading.Lock()
+
+
+def retarget_texture(filename, texture_extensions):
+    '''Swap the extension of a texture filename for the one it is converted to'''
+    filename = str(filename)
+    if os.path.isabs(filename) or filename.startswith('/'):
+        # Only textures from the asset directory are converted
+        return filename
+    dirlen = max(filename.rfind('/'), filename.rfind(os.sep)) + 1
+    basename = filename[dirlen:]
+    if '.' not in basename:
+        return filename
+    stem, ext = basename.split('.', 1)
+    newext = (texture_extensions or {}).get('.' + ext.lower())
+    if newext is None:
+        return filename
+    return filename[:dirlen] + stem + newext
+
+
+def make_texpath_relative(node, srcdir, converted_textures, texture_extensions=None):
+    '''Make texture references relative, returning the paths of the textures'''
     geomnode = node.node()
+    texture_paths = []
     for idx, renderstate in enumerate(geomnode.get_geom_states()):
         texattrib = renderstate.get_attrib(p3d.TextureAttrib)
         if texattrib:
@@ -20,25 +44,28 @@ def make_texpath_relative(node, srcdir, converted_textures):
                 texture = texattrib.get_on_texture(texstage)
                 if texture in converted_textures:
                     continue
-                texture.filename = os.path.relpath(texture.filename, srcdir)
+                if texture.fullpath:
+                    texture_paths.append(texture.fullpath.to_os_specific())
+                texture.filename = retarget_texture(
+                    os.path.relpath(texture.filename, srcdir),
+                    texture_extensions,
+                )
                 converted_textures.add(texture)
             newrenderstate = renderstate.set_attrib(texattrib)
-        geomnode.set_geom_state(idx, newrenderstate)
-
+            geomnode.set_geom_state(idx, newrenderstate)
+    return texture_paths
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='A tool for creating BAM files from Panda3D supported file formats'
-    )
+def convert(src, dst, texture_extensions=None, textures=None):
+    '''Convert a single file to a BAM file, returning True on success
 
-    parser.add_argument('src', type=str, help='source path')
-    parser.add_argument('dst', type=str, help='destination path')
-
-    args = parser.parse_args()
-
-    src = p3d.Filename.from_os_specific(os.path.abspath(args.src))
-    dst = p3d.Filename.from_os_specific(os.path.abspath(args.dst))
+    texture_extensions maps texture extensions (e.g., ".png") to the
+    extension of the converted texture (e.g., ".txo") for references that
+    should point at converted textures. If textures is a list, the paths of
+    the textures the model references are added to it.
+    '''
+    src = p3d.Filename.from_os_specific(os.path.abspath(src))
+    dst = p3d.Filename.from_os_specific(os.path.abspath(dst))
 
     dst.make_dir()
 
@@ -46,14 +73,165 @@ def main():
     options = p3d.LoaderOptions()
     options.flags |= p3d.LoaderOptions.LF_no_cache
 
-    scene = p3d.NodePath(loader.load_sync(src, options))
+    node = loader.load_sync(src, options)
+    if not node:
+        return False
+    scene = p3d.NodePath(node)
 
     # Update texture paths
     converted_textures = set()
     for node in scene.find_all_matches('**/+GeomNode'):
-        make_texpath_relative(node, src.get_dirname(), converted_textures)
+        texture_paths = make_texpath_relative(
+            node,
+            src.get_dirname(),
+            converted_textures,
+            texture_extensions,
+        )
+        if textures is not None:
+            textures.extend(texture_paths)
+
+    return scene.write_bam_file(dst)
+
+
+def convert_files(pairs, texture_extensions=None, textures=None):
+    '''Convert (src, dst) pairs, returning the list of sources that failed
+
+    If textures is a dict, it is filled with the paths of the textures
+    referenced by each source.
+    '''
+    failed = []
+    for src, dst in pairs:
+        src_textures = []
+        if not convert(src, dst, texture_extensions, src_textures):
+            failed.append(src)
+        if textures is not None:
+            textures[src] = src_textures
+    return failed
+
+
+def _load_bam_header_only(path, search_dirs):
+    '''Load a BAM file, only reading the headers of the textures it references'''
+    with _retarget_lock:
+        model_path = p3d.get_model_path()
+        for search_dir in search_dirs:
+            model_path.prepend_directory(
+                p3d.Filename.from_os_specific(os.path.abspath(search_dir))
+            )
+        header_only = p3d.ConfigVariableBool('textures-header-only')
+        header_only_value = header_only.get_value()
+        header_only.set_value(True)
+        try:
+            loader = p3d.Loader.get_global_ptr()
+            options = p3d.LoaderOptions()
+            options.flags |= p3d.LoaderOptions.LF_no_cache
+            return loader.load_sync(path, options)
+        finally:
+            header_only.set_value(header_only_value)
+            model_path.clear_local_value()
+
+
+def get_bam_textures(path, search_dirs):
+    '''Return the paths of the textures referenced by a BAM file
+
+    Textures are found via search_dirs, and ones that cannot be found are
+    left out. Returns None if the file could not be read.
+    '''
+    path = p3d.Filename.from_os_specific(os.path.abspath(path))
+    node = _load_bam_header_only(path, search_dirs)
+    if not node:
+        return None
+    return [
+        texture.fullpath.to_os_specific()
+        for texture in p3d.NodePath(node).find_all_textures()
+        if texture.fullpath
+    ]
+
+
+def retarget_bam_textures(path, search_dirs, texture_extensions, textures=None):
+    '''Point texture references in an existing BAM file at converted textures
+
+    The original textures are found via search_dirs (only their headers are
+    read). If textures is a list, the paths of the original textures are
+    added to it. Returns True on success.
+    '''
+    path = p3d.Filename.from_os_specific(os.path.abspath(path))
+    node = _load_bam_header_only(path, search_dirs)
+    if not node:
+        return False
+
+    scene = p3d.NodePath(node)
+    for texture in scene.find_all_textures():
+        if textures is not None and texture.fullpath:
+            textures.append(texture.fullpath.to_os_specific())
+        texture.filename = retarget_texture(texture.filename, texture_extensions)
+    return scene.write_bam_file(path)
+
+
+def read_manifest(manifest_file):
+    '''Read tab-separated src/dst pairs (one pair per line)'''
+    return [
+        tuple(line.rstrip('\r\n').split('\t', 1))
+        for line in manifest_file
+        if line.strip()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='A tool for creating BAM files from Panda3D supported file formats'
+    )
+
+    parser.add_argument(
+        'paths',
+        type=str,
+        nargs='*',
+        help='source and destination paths (src dst [src dst ...])',
+    )
+    parser.add_argument(
+        '--manifest',
+        type=argparse.FileType('r'),
+        help='read tab-separated source and destination paths from a file ("-" for stdin)',
+    )
+    parser.add_argument(
+        '--texture-extension',
+        action='append',
+        default=[],
+        metavar='SRC=DST',
+        help='reference converted textures (e.g., ".png=.txo") instead of the originals',
+    )
+    parser.add_argument(
+        '--list-textures',
+        action='store_true',
+        help='print the tab-separated source and path of each texture a model references',
+    )
+
+    args = parser.parse_args()
 
-    scene.write_bam_file(dst)
+    if len(args.paths) % 2 != 0:
+        parser.error('paths must be given as source and destination pairs')
+
+    pairs = list(zip(args.paths[::2], args.paths[1::2]))
+    if args.manifest:
+        manifest_pairs = read_manifest(args.manifest)
+        if any(len(i) != 2 for i in manifest_pairs):
+            parser.error('manifest lines must contain a tab-separated source and destination')
+        pairs += manifest_pairs
+
+    if not pairs:
+        parser.error('no files to convert')
+
+    texture_extensions = dict(i.split('=', 1) for i in args.texture_extension)
+    textures = {}
+    failed = convert_files(pairs, texture_extensions, textures)
+    if args.list_textures:
+        for src, texture_paths in textures.items():
+            for path in texture_paths:
+                print(f'{src}\t{path}')
+    for src in failed:
+        print(f'Failed to convert {src}', file=sys.stderr)
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -3,40 +3,49 @@ import functools
 
 
 @functools.lru_cache(maxsize=None)
-def _get_all_plugins():
+def _get_entry_points():
+    '''Index installed plugins by name without importing them'''
     from importlib.metadata import entry_points
 
-    def load_plugin(entrypoint):
-        plugin_class = entrypoint.load()
-        if not hasattr(plugin_class, 'name'):
-            plugin_class.name = entrypoint.name
-        return plugin_class()
-
     eps = entry_points()
-    if isinstance(eps, dict): # Python 3.8 and 3.9 # noqa: SIM108
-        plugins = eps.get('pman.plugins')
+    if isinstance(eps, dict): # Python 3.8 and 3.9
+        plugins = eps.get('pman.plugins', [])
     else:
         plugins = eps.select(group='pman.plugins')
 
-    return [
-        load_plugin(entrypoint)
-        for entrypoint in plugins
-    ]
+    index = {}
+    for entrypoint in plugins:
+        index.setdefault(entrypoint.name, entrypoint)
+    return index
 
 
-def get_plugins(*, filter_names=None, has_attr=None):
-    plugins = _get_all_plugins()
+def get_plugin_names():
+    '''Return the names of all installed plugins without importing any of them'''
+    return list(_get_entry_points())
 
-    def use_plugin(plugin):
-        return (
-            (not has_attr or hasattr(plugin, has_attr))
-            and (not filter_names or plugin.name in filter_names)
-        )
+
+@functools.lru_cache(maxsize=None)
+def load_plugin(name):
+    '''Import and instantiate the plugin registered as name'''
+    entrypoint = _get_entry_points()[name]
+    plugin_class = entrypoint.load()
+    if not hasattr(plugin_class, 'name'):
+        plugin_class.name = entrypoint.name
+    return plugin_class()
+
+
+def get_plugins(*, filter_names=None, has_attr=None):
+    '''Return plugin instances, only importing the plugins named in filter_names'''
+    names = [
+        name
+        for name in _get_entry_points()
+        if not filter_names or name in filter_names
+    ]
 
     return [
         plugin
-        for plugin in plugins
-        if use_plugin(plugin)
+        for plugin in (load_plugin(name) for name in names)
+        if not has_attr or hasattr(plugin, has_attr)
     ]
 
 
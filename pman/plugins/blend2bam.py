@@ -1,6 +1,13 @@
+import atexit
+import concurrent.futures
+import dataclasses
+import json
 import os
+import queue
 import subprocess
 import sys
+import tempfile
+import threading
 from dataclasses import (
     dataclass,
     field,
@@ -11,10 +18,196 @@ from typing import (
     Literal,
 )
 
+from pman._jobserver import current_job
+from pman.exceptions import BuildError
+
 from .common import (
     ConverterInfo,
     ConverterResult,
 )
+from .texture2txo import get_texture_extensions
+
+WORKER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)),
+    'blender_scripts',
+    'blend2bam_worker.py'
+)
+WORKER_RESPONSE_PREFIX = '@@pman-blend2bam@@ '
+
+
+def get_blender_command(blenderdir, blenderbin='blender'):
+    '''Return the command line that starts Blender (same lookup as blend2bam)'''
+    if blenderdir.startswith('flatpak run'):
+        return blenderdir.split()
+    if sys.platform == 'darwin':
+        return [os.path.join(blenderdir, 'Contents', 'MacOS', blenderbin)]
+    binpath = os.path.join(blenderdir, blenderbin)
+    if sys.platform == 'win32' and not binpath.endswith('.exe'):
+        binpath += '.exe'
+    return [binpath]
+
+
+def run_gltf2bam(src, dst, cli_args):
+    '''Convert a glTF file to BAM in a child process
+
+    gltf2bam (as run by blend2bam) rewrites sys.argv, so it must not run
+    in threads of the build process.
+    '''
+    args = [sys.executable, '-m', 'gltf.cli', src, dst]
+    for key, value in cli_args.items():
+        if isinstance(value, str):
+            args += [f'--{key}', value]
+        elif value:
+            args.append(f'--{key}')
+    proc = subprocess.run(
+        args,
+        env=os.environ.copy(),
+        text=True,
+        capture_output=True,
+        check=False,
+    )
+    if proc.returncode != 0:
+        raise BuildError(f'Failed to convert {src} to BAM:\n{proc.stderr}')
+
+
+def get_memory_usage(pid):
+    '''Return the resident memory of a process in bytes (None if unknown)'''
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf8') as statusfile:
+            for line in statusfile:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class BlenderWorker:
+    '''A long-lived Blender process that exports .blend files to .gltf on request'''
+
+    def __init__(self, args):
+        self.proc = subprocess.Popen(
+            args,
+            env=os.environ.copy(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        self.jobs = 0
+        self._read_response()
+
+    def _read_response(self):
+        for line in self.proc.stdout:
+            if line.startswith(WORKER_RESPONSE_PREFIX):
+                return json.loads(line[len(WORKER_RESPONSE_PREFIX):])
+        raise BuildError(
+            f'Blender worker exited unexpectedly (exit code {self.proc.wait()})'
+        )
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def convert(self, settings, src, dst):
+        self.jobs += 1
+        self.proc.stdin.write(json.dumps({
+            'settings': settings,
+            'src': src,
+            'dst': dst,
+        }) + '\n')
+        self.proc.stdin.flush()
+        return self._read_response()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+
+class BlenderWorkerPool:
+    '''Up to size BlenderWorkers, started on demand and shared between threads
+
+    Workers are replaced after max_jobs conversions or once they use more
+    than max_memory bytes (0 disables either limit).
+    '''
+
+    def __init__(self, args, size, max_jobs=0, max_memory=0, worker_type=BlenderWorker):
+        self.args = args
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.worker_type = worker_type
+
+        # None marks a free slot that does not have a running worker yet
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def _acquire(self):
+        worker = self.idle.get()
+        if worker is None:
+            try:
+                worker = self.worker_type(self.args)
+            except BaseException:
+                self.idle.put(None)
+                raise
+        return worker
+
+    def _release(self, worker):
+        retire = (
+            not worker.is_alive()
+            or (self.max_jobs and worker.jobs >= self.max_jobs)
+            or (
+                self.max_memory
+                and (get_memory_usage(worker.proc.pid) or 0) > self.max_memory
+            )
+        )
+        if retire:
+            worker.close()
+            worker = None
+        self.idle.put(worker)
+
+    def convert(self, settings, src, dst):
+        worker = self._acquire()
+        try:
+            return worker.convert(settings, src, dst)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.close()
+
+
+# Pools are shared by every job in the build process, so there are never
+# more than workers Blender processes regardless of build.jobs
+_WORKER_POOLS = {}
+_WORKER_POOLS_LOCK = threading.Lock()
+
+
+def get_worker_pool(args, size, max_jobs, max_memory):
+    key = (tuple(args), size, max_jobs, max_memory)
+    with _WORKER_POOLS_LOCK:
+        if key not in _WORKER_POOLS:
+            if not _WORKER_POOLS:
+                atexit.register(close_worker_pools)
+            _WORKER_POOLS[key] = BlenderWorkerPool(args, size, max_jobs, max_memory)
+        return _WORKER_POOLS[key]
+
+
+def close_worker_pools():
+    with _WORKER_POOLS_LOCK:
+        for pool in _WORKER_POOLS.values():
+            pool.close()
+        _WORKER_POOLS.clear()
 
 
 class Blend2BamPlugin:
@@ -25,9 +218,13 @@ class Blend2BamPlugin:
         )
     ]
 
+    # Blender does the heavy lifting in other processes, and persistent
+    # Blender workers have to be shared by all jobs in the build process
+    EXECUTOR = 'subprocess'
     BATCH_SIZE = 3
 
     CONFIG_KEY='blend2bam'
+    FINGERPRINT_IGNORED_KEYS = ('workers', 'worker_max_jobs', 'worker_max_memory')
     @dataclass
     class Config:
         blender_dir: str = ''
@@ -35,12 +232,27 @@ class Blend2BamPlugin:
         physics_engine: Literal['builtin', 'bullet'] = 'builtin'
         animations: Literal['embed', 'skip'] = 'embed'
         textures: Literal['ref', 'copy', 'embed'] = 'ref'
+        workers: int = 0
+        worker_max_jobs: int = 50
+        worker_max_memory: int = 0
         overrides: dict[str, Any] = field(default_factory=dict)
 
         def __getitem__(self, key):
             return getattr(self, key)
 
+    def get_fingerprint_data(self, config):
+        # Texture references are retargeted when texture2txo is enabled
+        texture_extensions = get_texture_extensions(config)
+        if not texture_extensions:
+            return {}
+        return {'texture_extensions': texture_extensions}
+
     def convert(self, config, converter_config, srcdir, dstdir, assets):
+        if converter_config['workers'] > 0:
+            results = self.convert_with_workers(config, converter_config, srcdir, dstdir, assets)
+            self.update_textures(config, converter_config, srcdir, dstdir, results)
+            return results
+
         verbose = config['general']['verbose']
         assetdir = config['build']['asset_dir']
         results: list[ConverterResult] = []
@@ -96,4 +308,114 @@ class Blend2BamPlugin:
             ))
 
         proc.check_returncode()
+        self.update_textures(config, converter_config, srcdir, dstdir, results)
         return results
+
+    def update_textures(self, config, converter_config, srcdir, dstdir, results):
+        '''Record referenced textures as dependencies and retarget them (if texture2txo is enabled)
+
+        Textures are recorded so they can be found (and built) from the
+        models using them, e.g., when assets are built on demand.
+        '''
+        if converter_config['textures'] != 'ref':
+            return
+
+        from pman import native2bam
+
+        assetdir = config['build']['asset_dir']
+        texture_extensions = get_texture_extensions(config)
+        for result in results:
+            dst = os.path.join(dstdir, result.output_file)
+            search_dirs = [srcdir, os.path.dirname(os.path.join(srcdir, result.input_file))]
+            if texture_extensions:
+                textures = []
+                if not native2bam.retarget_bam_textures(
+                    dst,
+                    search_dirs,
+                    texture_extensions,
+                    textures,
+                ):
+                    raise BuildError(f'Failed to update texture references in {dst}')
+            else:
+                textures = native2bam.get_bam_textures(dst, search_dirs) or []
+            for texture in textures:
+                dependency = os.path.relpath(texture, assetdir)
+                if not dependency.startswith(os.pardir) and dependency not in result.dependencies:
+                    result.dependencies.append(dependency)
+
+    def convert_with_workers(self, config, converter_config, srcdir, dstdir, assets):
+        '''Convert using persistent Blender processes instead of starting Blender per batch
+
+        Blender exports each file to glTF, which is then converted to BAM by
+        a gltf2bam process. Each file beyond the first takes its own jobserver
+        tokens, so limits on blend2bam jobs also limit busy processes.
+        '''
+        import gltf
+        from blend2bam import blenderutils
+        from blend2bam.blend2gltf import ConverterBlend2Gltf28
+        from blend2bam.common import Settings
+        from blend2bam.gltf2bam import ConverterGltf2Bam
+
+        verbose = config['general']['verbose']
+        assetdir = config['build']['asset_dir']
+
+        blenderdir = converter_config['blender_dir']
+        if not blenderdir and not blenderutils.blender_exists():
+            blenderdir = blenderutils.locate_blenderdir()
+
+        settings = Settings(
+            material_mode=converter_config['material_mode'],
+            physics_engine=converter_config['physics_engine'],
+            blender_dir=blenderdir,
+            textures=converter_config['textures'],
+            animations=converter_config['animations'],
+            verbose=verbose,
+        )
+        gltf_settings = dataclasses.asdict(settings)
+        gltf_version = tuple(int(i) for i in gltf.__version__.split('.')[:2])
+        gltf_settings['gltf_lights_lumens'] = gltf_version >= (1, 3)
+
+        args = [
+            *get_blender_command(blenderdir, settings.blender_bin),
+            '--background',
+            '--python-use-system-env',
+            '-P', WORKER_SCRIPT,
+            '--',
+            ConverterBlend2Gltf28.script_file,
+        ]
+        pool = get_worker_pool(
+            args,
+            converter_config['workers'],
+            converter_config['worker_max_jobs'],
+            converter_config['worker_max_memory'] * 1024 * 1024,
+        )
+
+        cli_args = ConverterGltf2Bam(settings).cli_args
+        job = current_job()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def convert_asset(asset):
+                stem = os.path.relpath(asset, srcdir).rsplit('.blend', 1)[0]
+                gltf_file = os.path.join(tmpdir, stem + '.gltf')
+                if verbose:
+                    print(f'Exporting {asset} with a Blender worker')
+                with job.slot():
+                    response = pool.convert(gltf_settings, asset, gltf_file)
+                    if not response['ok']:
+                        raise BuildError(response['error'])
+                    run_gltf2bam(gltf_file, os.path.join(dstdir, stem + '.bam'), cli_args)
+                return response['dependencies']
+
+            with concurrent.futures.ThreadPoolExecutor(pool.size) as threads:
+                exported = list(threads.map(convert_asset, assets))
+
+        return [
+            ConverterResult(
+                input_file=os.path.relpath(asset, assetdir),
+                output_file=os.path.relpath(asset, assetdir).rsplit('.blend', 1)[0] + '.bam',
+                dependencies=[
+                    os.path.relpath(i, assetdir)
+                    for i in dependencies
+                ],
+            )
+            for asset, dependencies in zip(assets, exported)
+        ]
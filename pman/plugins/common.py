@@ -14,3 +14,6 @@ class ConverterResult:
     input_file: str
     output_file: str
     dependencies: list[str] = field(default_factory=list)
+    hashes: dict[str, str] = field(default_factory=dict)
+    duration: float = 0.0
+    config_hash: str = ''
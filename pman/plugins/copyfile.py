@@ -1,9 +1,12 @@
 import os
-import shutil
+from dataclasses import dataclass
 from typing import (
     ClassVar,
+    Literal,
 )
 
+from pman._copy import copy_file, get_strategies
+
 from .common import (
     ConverterInfo,
     ConverterResult,
@@ -19,20 +22,44 @@ class CopyFilePlugin:
         )
     ]
 
-    def convert(self, config, _converter_config, srcdir, dstdir, assets):
+    # Copying is I/O-bound, so files are copied by threads in the build
+    # process in batches sized by the builder
+    EXECUTOR = 'thread'
+    BATCH_SIZE = 0
+
+    # Copying a file again is as cheap as restoring it from a cache
+    CACHEABLE = False
+
+    CONFIG_KEY = 'copyfile'
+    FINGERPRINT_IGNORED_KEYS = ('strategy',)
+    @dataclass
+    class Config:
+        strategy: Literal['auto', 'reflink', 'hardlink', 'copy_file_range', 'copy'] = 'auto'
+
+        def __getitem__(self, key):
+            return getattr(self, key)
+
+    def convert(self, config, converter_config, srcdir, dstdir, assets):
+        verbose = config['general']['verbose']
         results: list[ConverterResult] = []
         assetdir = config['build']['asset_dir']
         exportdir = config['build']['export_dir']
+        strategies = get_strategies(converter_config.get('strategy', 'auto'))
 
+        used_strategies = set()
         for asset in assets:
             src = asset
             dst = src.replace(srcdir, dstdir)
             if not os.path.exists(os.path.dirname(dst)):
                 os.makedirs(os.path.dirname(dst), exist_ok=True)
-            shutil.copyfile(src, dst)
+            used_strategies.add(copy_file(src, dst, strategies))
             results.append(ConverterResult(
                 input_file=os.path.relpath(src, assetdir),
                 output_file=os.path.relpath(dst, exportdir)
             ))
 
+        if verbose:
+            strategy_names = ', '.join(sorted(used_strategies))
+            print(f'copyfile: copied {len(assets)} files using {strategy_names}')
+
         return results
@@ -1,10 +1,57 @@
 import os
 import subprocess
+from dataclasses import dataclass
 from typing import (
     ClassVar,
 )
 
-from .common import ConverterInfo
+from .common import (
+    ConverterInfo,
+    ConverterResult,
+)
+from .texture2txo import get_texture_extensions
+
+
+def get_obj_dependencies(path):
+    '''Find material libraries referenced by an OBJ file'''
+    dependencies = []
+    with open(path, encoding='utf8', errors='replace') as objfile:
+        for line in objfile:
+            if line.startswith('mtllib'):
+                dependencies += [
+                    os.path.join(os.path.dirname(path), i)
+                    for i in line.split()[1:]
+                ]
+    return [
+        i
+        for i in dependencies
+        if os.path.exists(i)
+    ]
+
+
+def add_texture_dependencies(dependencies, textures):
+    '''Add the textures models reference to their dependencies
+
+    This lets textures be found (and built) from the models using them,
+    e.g., when assets are built on demand.
+    '''
+    for src, texture_paths in textures.items():
+        for path in texture_paths:
+            if os.path.exists(path) and path not in dependencies[src]:
+                dependencies[src].append(path)
+
+
+def set_dependencies(results, pairs, dependencies, assetdir):
+    '''Record the dependencies of each source that are inside assetdir
+
+    results and pairs (source/destination pairs) are in the same order.
+    '''
+    for result, (src, _) in zip(results, pairs):
+        result.dependencies = [
+            os.path.relpath(i, assetdir)
+            for i in dependencies[src]
+            if not os.path.relpath(i, assetdir).startswith(os.pardir)
+        ]
 
 
 class Native2BamPlugin:
@@ -20,9 +67,38 @@ class Native2BamPlugin:
         )
     ]
 
-    def convert(self, config, _converter_config, srcdir, dstdir, assets):
+    BATCH_SIZE = 20
+
+    CONFIG_KEY = 'native2bam'
+    FINGERPRINT_IGNORED_KEYS = ('in_process',)
+    @dataclass
+    class Config:
+        in_process: bool = False
+
+        def __getitem__(self, key):
+            return getattr(self, key)
+
+    def get_executor(self, converter_config):
+        if converter_config.get('in_process', False):
+            return 'process'
+        return 'subprocess'
+
+    def get_fingerprint_data(self, config):
+        # Texture references are retargeted when texture2txo is enabled
+        texture_extensions = get_texture_extensions(config)
+        if not texture_extensions:
+            return {}
+        return {'texture_extensions': texture_extensions}
+
+    def convert(self, config, converter_config, srcdir, dstdir, assets):
         verbose = config['general']['verbose']
-        processes = []
+        assetdir = config['build']['asset_dir']
+        exportdir = config['build']['export_dir']
+        results: list[ConverterResult] = []
+        texture_extensions = get_texture_extensions(config)
+
+        pairs = []
+        dependencies = {}
         for asset in assets:
             if asset.endswith('.mtl'):
                 # Handled by obj
@@ -30,17 +106,58 @@ class Native2BamPlugin:
 
             ext = '.' + asset.split('.', 1)[1]
             dst = asset.replace(srcdir, dstdir).replace(ext, '.bam')
-            args = [
-                'native2bam',
-                asset,
-                dst
-            ]
+            pairs.append((asset, dst))
+            dependencies[asset] = get_obj_dependencies(asset) if ext == '.obj' else []
+            results.append(ConverterResult(
+                input_file=os.path.relpath(asset, assetdir),
+                output_file=os.path.relpath(dst, exportdir),
+            ))
+
+        if not pairs:
+            return results
+
+        if converter_config.get('in_process', False):
+            from pman import native2bam
 
             if verbose:
-                print(f'Calling native2bam: {" ".join(args)}')
-            processes.append(
-                subprocess.Popen(args, env=os.environ.copy(), stdout=subprocess.DEVNULL)
-            )
+                print(f'Converting in-process: {", ".join(i[0] for i in pairs)}')
+            textures = {}
+            failed = native2bam.convert_files(pairs, texture_extensions, textures)
+            if failed:
+                raise RuntimeError(f'native2bam failed to convert: {", ".join(failed)}')
+            add_texture_dependencies(dependencies, textures)
+            set_dependencies(results, pairs, dependencies, assetdir)
+            return results
+
+        args = [
+            'native2bam',
+            '--manifest', '-',
+            '--list-textures',
+        ]
+        for src_ext, dst_ext in texture_extensions.items():
+            args += ['--texture-extension', f'{src_ext}={dst_ext}']
+        manifest = ''.join(f'{src}\t{dst}\n' for src, dst in pairs)
+
+        if verbose:
+            print(f'Calling native2bam: {" ".join(args)}\n{manifest}')
+
+        proc = subprocess.run(
+            args,
+            env=os.environ.copy(),
+            input=manifest,
+            text=True,
+            capture_output=True,
+            check=False,
+        )
+        if proc.stderr:
+            print(proc.stderr)
+        proc.check_returncode()
 
-        for proc in processes:
-            proc.wait()
+        textures = {}
+        for line in proc.stdout.splitlines():
+            src, sep, path = line.partition('\t')
+            if sep and src in dependencies:
+                textures.setdefault(src, []).append(path)
+        add_texture_dependencies(dependencies, textures)
+        set_dependencies(results, pairs, dependencies, assetdir)
+        return results
@@ -0,0 +1,146 @@
+import os
+from dataclasses import (
+    dataclass,
+    field,
+)
+from typing import (
+    Any,
+    ClassVar,
+    Literal,
+)
+
+from pman.exceptions import BuildError
+
+from .common import (
+    ConverterInfo,
+    ConverterResult,
+)
+
+TEXTURE_EXTENSIONS = [
+    '.png',
+    '.jpg', '.jpeg',
+    '.tga',
+    '.bmp',
+    '.tif', '.tiff',
+    '.sgi', '.rgb', '.rgba',
+    '.exr',
+    '.hdr',
+]
+
+
+def get_texture_extensions(config):
+    '''Map texture extensions to the extension they are converted to
+
+    This is empty if the texture2txo plugin is not enabled, so model
+    converters can use it to decide if texture references need updating.
+    '''
+    if 'texture2txo' not in config['general']['plugins']:
+        return {}
+    return dict.fromkeys(TEXTURE_EXTENSIONS, '.txo')
+
+
+def load_image(src, max_size, scale):
+    '''Read src into a PNMImage, downscaling it to fit max_size and scale'''
+    import panda3d.core as p3d
+
+    image = p3d.PNMImage()
+    if not image.read(p3d.Filename.from_os_specific(src)):
+        raise BuildError(f'Failed to read texture: {src}')
+
+    xsize = image.get_x_size() * scale
+    ysize = image.get_y_size() * scale
+    if max_size > 0 and max(xsize, ysize) > max_size:
+        ratio = max_size / max(xsize, ysize)
+        xsize *= ratio
+        ysize *= ratio
+    xsize = max(int(xsize), 1)
+    ysize = max(int(ysize), 1)
+
+    if (xsize, ysize) == (image.get_x_size(), image.get_y_size()):
+        return image
+
+    scaled = p3d.PNMImage(
+        xsize,
+        ysize,
+        image.get_num_channels(),
+        image.get_maxval(),
+        image.get_type(),
+    )
+    scaled.gaussian_filter_from(1.0, image)
+    return scaled
+
+
+class Texture2TxoPlugin:
+    converters: ClassVar[list[ConverterInfo]] = [
+        ConverterInfo(
+            name='texture2txo',
+            supported_extensions=TEXTURE_EXTENSIONS,
+            output_extension='.txo',
+        )
+    ]
+
+    EXECUTOR = 'process'
+    BATCH_SIZE = 16
+
+    CONFIG_KEY = 'texture2txo'
+    @dataclass
+    class Config:
+        mipmaps: bool = True
+        compression: Literal[
+            'none', 'default',
+            'dxt1', 'dxt3', 'dxt5',
+            'etc1', 'etc2', 'eac',
+        ] = 'none'
+        max_size: int = 0
+        scale: float = 1.0
+        overrides: list[dict[str, Any]] = field(default_factory=list)
+
+        def __getitem__(self, key):
+            return getattr(self, key)
+
+    def convert(self, config, converter_config, srcdir, dstdir, assets):
+        import panda3d.core as p3d
+
+        verbose = config['general']['verbose']
+        assetdir = config['build']['asset_dir']
+        exportdir = config['build']['export_dir']
+        results: list[ConverterResult] = []
+
+        compression = converter_config.get('compression', 'none')
+        if compression == 'default':
+            compression_mode = p3d.Texture.CM_on
+        elif compression != 'none':
+            compression_mode = getattr(p3d.Texture, f'CM_{compression}')
+
+        for asset in assets:
+            dst = (asset.split('.', 1)[0] + '.txo').replace(srcdir, dstdir)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+            if verbose:
+                print(f'Converting texture {asset} to {dst}')
+
+            image = load_image(
+                asset,
+                converter_config.get('max_size', 0),
+                converter_config.get('scale', 1.0),
+            )
+            texture = p3d.Texture(os.path.basename(dst).split('.', 1)[0])
+            texture.load(image)
+            texture.set_filename(p3d.Filename.from_os_specific(os.path.relpath(dst, dstdir)))
+
+            if converter_config.get('mipmaps', True):
+                texture.set_minfilter(p3d.SamplerState.FT_linear_mipmap_linear)
+                texture.generate_ram_mipmap_images()
+
+            if compression != 'none' and not texture.compress_ram_image(compression_mode):
+                raise BuildError(f'Failed to compress texture ({compression}): {asset}')
+
+            if not texture.write(p3d.Filename.from_os_specific(dst)):
+                raise BuildError(f'Failed to write texture: {dst}')
+
+            results.append(ConverterResult(
+                input_file=os.path.relpath(asset, assetdir),
+                output_file=os.path.relpath(dst, exportdir),
+            ))
+
+        return results
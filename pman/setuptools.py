@@ -26,9 +26,17 @@ def finalize_distribution_options(dist):
 
     cmd = dist.get_command_obj('build_apps')
 
-    # Setup export dir as the new asset dir
-    cmd.include_patterns.append(f'{exportdir}/**')
-    cmd.rename_paths[exportdir] = assertdir
+    if config['build']['pack']:
+        # Ship the archives instead of the loose files, the shim mounts them
+        from ._pack import FROZEN_PACK_DIR
+
+        packdir = config['build']['pack_dir']
+        cmd.include_patterns.append(f'{packdir}/**')
+        cmd.rename_paths[packdir] = f'{FROZEN_PACK_DIR}/'
+    else:
+        # Setup export dir as the new asset dir
+        cmd.include_patterns.append(f'{exportdir}/**')
+        cmd.rename_paths[exportdir] = assertdir
 
     # Add an application if there isn't one defined
     if mainfile not in cmd.gui_apps.values() and projectname not in cmd.gui_apps:
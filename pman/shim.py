@@ -1,22 +1,145 @@
+import functools
+import os
+import threading
+
 import panda3d.core as p3d
 
-from ._build import build
+from ._pack import FROZEN_PACK_DIR, mount_packs
+from ._stamp import is_build_current
 from ._utils import (
     get_config,
+    get_config_plugins,
     is_frozen,
 )
 
 
-def init(_base):
+def _needs_build(config):
+    # Plugins with build hooks may do work the stamp knows nothing about
+    if get_config_plugins(config, 'pre_build') or get_config_plugins(config, 'post_build'):
+        return True
+    return not is_build_current(config)
+
+
+# Loader methods to wrap, with the names of their leading path arguments
+LOADER_METHODS = [
+    ('loadModel', 'load_model', ('modelPath',)),
+    ('loadTexture', 'load_texture', ('texturePath', 'alphaPath')),
+    ('loadFont', 'load_font', ('modelPath',)),
+    ('loadSfx', 'load_sfx', ('soundPath',)),
+    ('loadMusic', 'load_music', ('soundPath',)),
+]
+
+
+def _get_output_files(dstdir, path):
+    '''Return the export directory relative files a loader path could refer to'''
+    path = p3d.Filename(path).to_os_specific()
+    if os.path.isabs(path):
+        path = os.path.relpath(path, dstdir)
+        if path.startswith(os.pardir):
+            return []
+    if '.' not in os.path.basename(path):
+        # The loader tries default extensions, built models end up as .bam
+        return [path + '.bam']
+    return [path]
+
+
+def install_build_on_demand(config, loader=None):
+    '''Wrap loader methods so assets are built as they are loaded
+
+    If loader is None, the methods of the Loader class are wrapped instead,
+    so this also works before ShowBase has created its loader. Returns the
+    OnDemandBuilder used for the builds.
+    '''
+    from ._build import OnDemandBuilder
+
+    ondemand = OnDemandBuilder(config)
+    dstdir = ondemand.builder.dstdir
+
+    def ensure_built(paths):
+        for path in paths:
+            if isinstance(path, (list, tuple, set)):
+                # loadModel also accepts a list of paths
+                ensure_built(path)
+                continue
+            if path is None:
+                continue
+            for output_file in _get_output_files(dstdir, path):
+                if ondemand.ensure_built(output_file):
+                    break
+
+    def wrap(func, path_args, *, is_method=False):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Paths may be passed positionally or by keyword (e.g., modelPath=...)
+            positional = args[1:] if is_method else args
+            ensure_built([
+                *positional[:len(path_args)],
+                *(kwargs[i] for i in path_args if i in kwargs),
+            ])
+            return func(*args, **kwargs)
+        return wrapper
+
+    is_method = loader is None
+    if is_method:
+        from direct.showbase.Loader import Loader
+        loader = Loader
+
+    for camel_name, snake_name, path_args in LOADER_METHODS:
+        wrapped = wrap(getattr(loader, camel_name), path_args, is_method=is_method)
+        setattr(loader, camel_name, wrapped)
+        setattr(loader, snake_name, wrapped)
+    return ondemand
+
+
+def _auto_build(config):
+    if not _needs_build(config):
+        return None
+
+    # Only pull in the build machinery when it is needed
+    from ._build import build
+
+    if not config['run']['auto_build_background']:
+        build(config)
+        return None
+
+    thread = threading.Thread(target=build, args=(config,), name='pman-build', daemon=True)
+    thread.start()
+    return thread
+
+
+def init(base):
+    '''Setup the model path for the project, building assets first if configured to
+
+    Returns the build thread when building in the background, None otherwise.
+    '''
+    maindir = p3d.Filename.expand_from('$MAIN_DIR')
     assetdir_rel = p3d.Filename('assets')
+    packdir = p3d.Filename(maindir, FROZEN_PACK_DIR)
     config = None
+    build_thread = None
 
     if not is_frozen():
         config = get_config()
-        if config['run']['auto_build']:
-            build(config)
+        if config['run']['auto_build'] and config['run']['build_on_demand']:
+            install_build_on_demand(config, getattr(base, 'loader', None))
+        elif config['run']['auto_build']:
+            build_thread = _auto_build(config)
         assetdir_rel = p3d.Filename.from_os_specific(config['build']['export_dir'])
 
+        # Archives would hide assets that are still being built
+        packdir = None
+        if config['build']['pack'] and build_thread is None and not (
+            config['run']['auto_build'] and config['run']['build_on_demand']
+        ):
+            packdir = p3d.Filename(
+                maindir,
+                p3d.Filename.from_os_specific(config['build']['pack_dir'])
+            )
+
     # Add assets directory to model path
-    assetdir = p3d.Filename(p3d.Filename.expand_from('$MAIN_DIR'), assetdir_rel)
+    assetdir = p3d.Filename(maindir, assetdir_rel)
+    if packdir is not None:
+        mount_packs(packdir, assetdir)
     p3d.get_model_path().prepend_directory(assetdir)
+
+    return build_thread
@@ -14,3 +14,9 @@ def projectdir(tmpdir):
 def projectconf(projectdir):
     with open('.pman', 'w') as conffile:
         yield conffile
+
+@pytest.fixture(autouse=True)
+def cachedir(tmp_path_factory, monkeypatch):
+    path = tmp_path_factory.mktemp('pman_cache')
+    monkeypatch.setenv('PMAN_CACHE_DIR', str(path))
+    return path
@@ -0,0 +1,947 @@
+import concurrent.futures
+import errno
+import json
+import os
+import sys
+import threading
+import types
+
+import pytest
+
+import pman
+from pman import _copy
+from pman._build import Builder, OnDemandBuilder, PatternMatcher
+from pman._builddb import JSONBuildDB, SQLiteBuildDB, is_sqlite_file
+from pman._cache import ArtifactCache, RemoteCache
+from pman._jobserver import JOBSERVER_ENV, JobServer, is_jobserver_supported
+from pman._pack import mount_packs
+from pman._scheduler import Job, break_cycles, make_batches
+from pman._stamp import is_build_current
+from pman._watch import InotifyWatcher, PollingWatcher
+from pman.cache_server import CacheServer
+from pman.plugins.common import ConverterResult
+from pman.plugins.copyfile import CopyFilePlugin
+
+
+def write_asset(path, contents):
+    path = os.path.join('assets', path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as assetfile:
+        assetfile.write(contents)
+
+
+def test_build_copyfile(projectdir):
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    with open(os.path.join('.built_assets', 'foo.txt')) as builtfile:
+        assert builtfile.read() == 'foo'
+
+
+def test_build_skip_touched(projectdir):
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    dst = os.path.join('.built_assets', 'foo.txt')
+    os.utime(dst, (0, 0))
+    os.utime(os.path.join('assets', 'foo.txt'))
+    pman.build()
+    assert os.stat(dst).st_mtime == 0
+
+    write_asset('foo.txt', 'bar')
+    pman.build()
+    with open(dst) as builtfile:
+        assert builtfile.read() == 'bar'
+
+
+def test_build_source_changed_during_conversion(projectdir, monkeypatch):
+    write_asset('foo.txt', 'v1')
+
+    convert = CopyFilePlugin.convert
+    def convert_and_edit(self, *args):
+        results = convert(self, *args)
+        # Saved while the (in-process) converter was running
+        write_asset('foo.txt', 'v2')
+        return results
+    monkeypatch.setattr(CopyFilePlugin, 'convert', convert_and_edit)
+    pman.build()
+    monkeypatch.setattr(CopyFilePlugin, 'convert', convert)
+
+    dst = os.path.join('.built_assets', 'foo.txt')
+    with open(dst) as builtfile:
+        assert builtfile.read() == 'v1'
+
+    pman.build()
+    with open(dst) as builtfile:
+        assert builtfile.read() == 'v2'
+
+
+def test_builddb_json_migration(projectdir):
+    write_asset('foo.txt', 'foo')
+    os.makedirs('.built_assets', exist_ok=True)
+    with open(os.path.join('.built_assets', 'foo.txt'), 'w') as builtfile:
+        builtfile.write('foo')
+    with open('.pman_builddb', 'w') as builddb_file:
+        json.dump([{
+            'input_file': 'foo.txt',
+            'output_file': 'foo.txt',
+            'dependencies': [],
+        }], builddb_file)
+
+    pman.build()
+
+    assert is_sqlite_file('.pman_builddb')
+    builddb = SQLiteBuildDB('.pman_builddb', os.path.abspath('assets'))
+    builddb.load()
+    assert builddb['foo.txt'].hashes
+    builddb.close()
+
+
+def test_builddb_backfill(projectdir, monkeypatch):
+    write_asset('foo.txt', 'foo')
+    write_asset('bar.txt', 'bar')
+    pman.build()
+
+    # Entries from before content hashes and config fingerprints were recorded
+    builddb = SQLiteBuildDB('.pman_builddb', os.path.abspath('assets'))
+    builddb.load()
+    builddb.put(ConverterResult(input_file='foo.txt', output_file='foo.txt'))
+    bar = builddb['bar.txt']
+    bar.config_hash = ''
+    builddb.put(bar)
+    builddb.save()
+    builddb.close()
+    pman.build()
+
+    builddb = SQLiteBuildDB('.pman_builddb', os.path.abspath('assets'))
+    builddb.load()
+    for name in ('foo.txt', 'bar.txt'):
+        assert builddb[name].hashes == {name: builddb.get_hash(name)}
+        assert builddb[name].config_hash
+    builddb.close()
+
+    built = []
+    run_jobs = Builder.run_jobs
+    def record_jobs(self, jobs):
+        built.extend(i for job in jobs for i in job.assets)
+        return run_jobs(self, jobs)
+    monkeypatch.setattr(Builder, 'run_jobs', record_jobs)
+    pman.build()
+    assert built == []
+
+
+def test_builddb_sqlite_concurrent(tmp_path):
+    # Two pman processes using the same builddb, e.g., a build and `pman run`
+    path = str(tmp_path / 'builddb')
+    first = SQLiteBuildDB(path, str(tmp_path))
+    first.load()
+    first.put(ConverterResult(input_file='foo.txt', output_file='foo.txt'))
+    first.commit()
+    first.put(ConverterResult(input_file='bar.txt', output_file='bar.txt'))
+
+    # Readers are not blocked by writes in progress
+    second = SQLiteBuildDB(path, str(tmp_path))
+    second.load()
+    assert second.output_files() == ['foo.txt']
+
+    # Writers only wait for the next commit, not for the end of the build
+    first.commit()
+    second.put(ConverterResult(input_file='baz.txt', output_file='baz.txt'))
+    second.save()
+    second.close()
+
+    assert sorted(first.output_files()) == ['bar.txt', 'baz.txt', 'foo.txt']
+    first.close()
+
+
+@pytest.mark.parametrize('backend', [JSONBuildDB, SQLiteBuildDB])
+def test_builddb_get_dependents(tmp_path, backend):
+    builddb = backend(str(tmp_path / 'builddb'), str(tmp_path))
+    builddb.load()
+    builddb.put(ConverterResult(
+        input_file='foo.obj',
+        output_file='foo.bam',
+        dependencies=['foo.mtl', 'foo.obj'],
+    ))
+    builddb.put(ConverterResult(
+        input_file='bar.obj',
+        output_file='bar.bam',
+        dependencies=['foo.mtl', 'foo.obj'],
+    ))
+
+    assert builddb.get_dependents('foo.mtl') == {'foo.obj', 'bar.obj'}
+    assert builddb.get_dependents('foo.obj') == {'bar.obj'}
+    assert builddb.get_dependents('bar.obj') == set()
+    builddb.close()
+
+
+def test_builddb_json_backend(projectdir):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[build]\n')
+        conffile.write('builddb_backend = "json"\n')
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    with open('.pman_builddb') as builddb_file:
+        data = json.load(builddb_file)
+    assert data['results'][0]['output_file'] == 'foo.txt'
+
+
+def test_pattern_matcher():
+    matcher = PatternMatcher(['*.blend1', 'textures/*', 'foo.txt'])
+    assert matcher.match('a/b.blend1') == 0
+    assert matcher.match('textures/wood.png', 'wood.png') == 1
+    assert matcher.match('models/foo.txt', 'foo.txt') == 2
+    assert matcher.match('models/bar.txt', 'bar.txt') is None
+    assert PatternMatcher([]).match('foo') is None
+
+
+def test_build_ignore_dir(projectdir):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[build]\n')
+        conffile.write('ignore_patterns = ["wip/*", "*.blend1"]\n')
+    write_asset('foo.txt', 'foo')
+    write_asset('foo.blend1', 'foo')
+    write_asset(os.path.join('wip', 'bar.txt'), 'bar')
+    pman.build()
+
+    assert os.listdir('.built_assets') == ['foo.txt']
+
+
+def test_build_explicit_streams(projectdir):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[general]\n')
+        conffile.write('plugins = ["DefaultPlugins", "copyfile"]\n')
+        conffile.write('[[build.streams]]\n')
+        conffile.write('plugin = "copyfile"\n')
+        conffile.write('include_patterns = ["*.txt"]\n')
+        conffile.write('exclude_patterns = ["skip/*"]\n')
+    write_asset('foo.txt', 'foo')
+    write_asset('foo.png', 'foo')
+    write_asset(os.path.join('skip', 'bar.txt'), 'bar')
+    pman.build()
+
+    assert os.listdir('.built_assets') == ['foo.txt']
+
+
+def test_build_config_change(projectdir, monkeypatch):
+    def write_config(level):
+        with open('.pman', 'w') as conffile:
+            conffile.write('[general]\n')
+            conffile.write('plugins = ["DefaultPlugins", "copyfile"]\n')
+            conffile.write('[[build.streams]]\n')
+            conffile.write('plugin = "copyfile"\n')
+            conffile.write('include_patterns = ["a/*"]\n')
+            conffile.write(f'options = {{level = {level}}}\n')
+            conffile.write('[[build.streams]]\n')
+            conffile.write('plugin = "copyfile"\n')
+            conffile.write('include_patterns = ["b/*"]\n')
+    write_config(1)
+    write_asset(os.path.join('a', 'foo.txt'), 'foo')
+    write_asset(os.path.join('b', 'bar.txt'), 'bar')
+    pman.build()
+
+    built = []
+    run_jobs = Builder.run_jobs
+    def record_jobs(self, jobs):
+        built.extend(os.path.basename(i) for job in jobs for i in job.assets)
+        return run_jobs(self, jobs)
+    monkeypatch.setattr(Builder, 'run_jobs', record_jobs)
+
+    pman.build()
+    assert built == []
+
+    write_config(2)
+    pman.build()
+    assert built == ['foo.txt']
+
+
+def test_build_runtime_option_change(projectdir, monkeypatch):
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    built = []
+    run_jobs = Builder.run_jobs
+    def record_jobs(self, jobs):
+        built.extend(os.path.basename(i) for job in jobs for i in job.assets)
+        return run_jobs(self, jobs)
+    monkeypatch.setattr(Builder, 'run_jobs', record_jobs)
+
+    # How files are copied does not change the output
+    with open('.pman', 'w') as conffile:
+        conffile.write('[copyfile]\n')
+        conffile.write('strategy = "copy"\n')
+    pman.build()
+    assert built == []
+
+
+def test_builder_rebuild_dependents(projectdir):
+    write_asset('a.txt', 'a')
+    write_asset('lib.txt', 'lib')
+    config = pman.get_config()
+    with Builder(config) as builder:
+        builder.build()
+        builder.builddb.add_result(ConverterResult(
+            input_file='a.txt',
+            output_file='a.txt',
+            dependencies=['lib.txt'],
+        ))
+
+        dst = os.path.join('.built_assets', 'a.txt')
+        os.utime(dst, (0, 0))
+        write_asset('lib.txt', 'changed')
+        builder.build([os.path.abspath(os.path.join('assets', 'lib.txt'))])
+        assert os.stat(dst).st_mtime != 0
+
+    with open(os.path.join('.built_assets', 'lib.txt')) as builtfile:
+        assert builtfile.read() == 'changed'
+
+
+@pytest.mark.parametrize('watcher_type', ['polling', 'inotify'])
+def test_watcher(tmpdir, watcher_type):
+    if watcher_type == 'inotify':
+        if not sys.platform.startswith('linux'):
+            pytest.skip('inotify is only available on Linux')
+        watcher = InotifyWatcher(tmpdir.strpath)
+    else:
+        watcher = PollingWatcher(tmpdir.strpath, interval=0.01)
+
+    with watcher:
+        path = os.path.join(tmpdir.strpath, 'foo.txt')
+        with open(path, 'w') as assetfile:
+            assetfile.write('foo')
+        assert watcher.wait_for_changes(0.05) == {path}
+
+
+class FakeWatcher:
+    '''Run each of steps (a function returning the changed paths) and then stop watching'''
+    name = 'fake'
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def wait_for_changes(self, _debounce):
+        if not self.steps:
+            raise KeyboardInterrupt
+        return self.steps.pop(0)()
+
+
+def test_watch_build_error(projectdir, monkeypatch):
+    convert = CopyFilePlugin.convert
+    def convert_or_fail(self, config, converter_config, srcdir, dstdir, assets):
+        if any(i.endswith('bad.txt') for i in assets):
+            raise RuntimeError('bad asset')
+        return convert(self, config, converter_config, srcdir, dstdir, assets)
+    monkeypatch.setattr(CopyFilePlugin, 'convert', convert_or_fail)
+
+    def change(path, contents):
+        write_asset(path, contents)
+        return {os.path.abspath(os.path.join('assets', path))}
+    steps = [
+        lambda: change('bad.txt', 'still bad'),
+        lambda: change('good.txt', 'v2'),
+    ]
+    monkeypatch.setattr('pman._build.get_watcher', lambda _srcdir: FakeWatcher(steps))
+
+    write_asset('good.txt', 'v1')
+    write_asset('bad.txt', 'bad')
+    with pytest.raises(KeyboardInterrupt):
+        pman.watch()
+
+    with open(os.path.join('.built_assets', 'good.txt')) as builtfile:
+        assert builtfile.read() == 'v2'
+    assert not os.path.exists(os.path.join('.built_assets', 'bad.txt'))
+
+
+EGG_TRIANGLE = """
+<CoordinateSystem> { Z-up }
+<VertexPool> vpool {
+  <Vertex> 0 { 0 0 0 }
+  <Vertex> 1 { 1 0 0 }
+  <Vertex> 2 { 0 0 1 }
+}
+<Group> tri {
+  <Polygon> { <VertexRef> { 0 1 2 <Ref> { vpool } } }
+}
+"""
+
+@pytest.mark.parametrize('in_process', [False, True])
+def test_build_native2bam(projectdir, in_process):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[native2bam]\n')
+        conffile.write(f'in_process = {"true" if in_process else "false"}\n')
+    write_asset('tri.egg', EGG_TRIANGLE)
+    write_asset(os.path.join('models', 'tri.egg'), EGG_TRIANGLE)
+    pman.build()
+
+    assert os.path.exists(os.path.join('.built_assets', 'tri.bam'))
+    assert os.path.exists(os.path.join('.built_assets', 'models', 'tri.bam'))
+
+
+EGG_TEXTURED = """
+<CoordinateSystem> { Z-up }
+<Texture> tex { "textures/red.png" }
+<VertexPool> vpool {
+  <Vertex> 0 { 0 0 0 <UV> { 0 0 } }
+  <Vertex> 1 { 1 0 0 <UV> { 1 0 } }
+  <Vertex> 2 { 0 0 1 <UV> { 0 1 } }
+}
+<Group> tri {
+  <Polygon> { <TRef> { tex } <VertexRef> { 0 1 2 <Ref> { vpool } } }
+}
+"""
+
+@pytest.mark.parametrize('in_process', [False, True])
+def test_build_texture2txo(projectdir, in_process):
+    import panda3d.core as p3d
+
+    with open('.pman', 'w') as conffile:
+        conffile.write('[general]\n')
+        conffile.write('plugins = ["DefaultPlugins", "texture2txo"]\n')
+        conffile.write('[native2bam]\n')
+        conffile.write(f'in_process = {"true" if in_process else "false"}\n')
+        conffile.write('[texture2txo]\n')
+        conffile.write('overrides = [{pattern = "small.png", max_size = 16}]\n')
+    # Panda does not follow os.chdir(), so only use absolute paths with it
+    texturedir = os.path.abspath(os.path.join('assets', 'textures'))
+    os.makedirs(texturedir)
+    image = p3d.PNMImage(64, 64, 3)
+    image.fill(1, 0, 0)
+    image.write(p3d.Filename.from_os_specific(os.path.join(texturedir, 'red.png')))
+    image.write(p3d.Filename.from_os_specific(os.path.join(texturedir, 'small.png')))
+    write_asset('tri.egg', EGG_TEXTURED)
+    pman.build()
+
+    builtdir = os.path.abspath('.built_assets')
+    red = p3d.TexturePool.load_texture(
+        p3d.Filename.from_os_specific(os.path.join(builtdir, 'textures', 'red.txo'))
+    )
+    assert red.x_size == 64
+    assert red.get_num_ram_mipmap_images() > 1
+    small = p3d.TexturePool.load_texture(
+        p3d.Filename.from_os_specific(os.path.join(builtdir, 'textures', 'small.txo'))
+    )
+    assert small.x_size == 16
+    assert not os.path.exists(os.path.join(builtdir, 'textures', 'red.png'))
+
+    loader = p3d.Loader.get_global_ptr()
+    options = p3d.LoaderOptions(p3d.LoaderOptions.LF_no_cache)
+    model = p3d.NodePath(loader.load_sync(
+        p3d.Filename.from_os_specific(os.path.join(builtdir, 'tri.bam')),
+        options,
+    ))
+    assert [i.filename.get_basename() for i in model.find_all_textures()] == ['red.txo']
+
+    # Referenced textures are recorded, so they can be built with the model
+    builddb = SQLiteBuildDB('.pman_builddb', os.path.abspath('assets'))
+    builddb.load()
+    assert builddb['tri.bam'].dependencies == [os.path.join('textures', 'red.png')]
+    builddb.close()
+
+
+def test_build_texture2txo_enabled_later(projectdir):
+    import panda3d.core as p3d
+
+    texturedir = os.path.abspath(os.path.join('assets', 'textures'))
+    os.makedirs(texturedir)
+    image = p3d.PNMImage(4, 4, 3)
+    image.write(p3d.Filename.from_os_specific(os.path.join(texturedir, 'red.png')))
+    write_asset('tri.egg', EGG_TEXTURED)
+    pman.build()
+
+    with open('.pman', 'w') as conffile:
+        conffile.write('[general]\n')
+        conffile.write('plugins = ["DefaultPlugins", "texture2txo"]\n')
+    pman.build()
+
+    # Models are rebuilt to reference the converted textures
+    bampath = os.path.abspath(os.path.join('.built_assets', 'tri.bam'))
+    model = p3d.NodePath(p3d.Loader.get_global_ptr().load_sync(
+        p3d.Filename.from_os_specific(bampath),
+        p3d.LoaderOptions(p3d.LoaderOptions.LF_no_cache),
+    ))
+    assert [i.filename.get_basename() for i in model.find_all_textures()] == ['red.txo']
+
+
+def make_jobs(convert, count):
+    converter = types.SimpleNamespace(name='fake', function=convert, plugin=None)
+    return [
+        Job(
+            converter=converter,
+            converter_config={},
+            assets=(f'asset{idx}',),
+            description=f'job {idx}',
+        )
+        for idx in range(count)
+    ]
+
+
+def test_run_jobs_errors(projectdir):
+    def convert(_config, _converter_config, _srcdir, _dstdir, assets):
+        if assets == ('asset1',):
+            raise RuntimeError('conversion failed')
+        return [ConverterResult(input_file=assets[0], output_file=assets[0])]
+
+    jobs = make_jobs(convert, 20)
+    config = pman.get_config()
+    with Builder(config) as builder:
+        builder.pools['process'] = concurrent.futures.ThreadPoolExecutor(2)
+        with pytest.raises(RuntimeError, match='conversion failed'):
+            builder.run_jobs(jobs)
+
+        assert all(job.future.done() for job in jobs)
+        assert 'asset0' in builder.builddb
+
+
+@pytest.mark.skipif(not is_jobserver_supported(), reason='the jobserver needs named pipes')
+def test_jobserver():
+    with JobServer(2, limits={'blend2bam': 1}) as jobserver:
+        client = jobserver.client()
+        assert client.get_pools('copyfile', use_global=False) == []
+        pools = client.get_pools('blend2bam')
+        assert pools == ['blend2bam', 'jobs']
+
+        with client.job(pools) as job:
+            assert not client.try_acquire('blend2bam')
+
+            started = threading.Event()
+            def run_slot():
+                with job.slot():
+                    started.set()
+
+            # The first slot uses the tokens of the job, so a second one has
+            # to wait for the blend2bam limit
+            with job.slot():
+                thread = threading.Thread(target=run_slot)
+                thread.start()
+                assert not started.wait(0.3)
+            thread.join(5)
+            assert started.is_set()
+
+        # All tokens were returned
+        assert client.try_acquire()
+        assert client.try_acquire()
+        assert not client.try_acquire()
+
+
+@pytest.mark.skipif(not is_jobserver_supported(), reason='the jobserver needs named pipes')
+def test_build_converter_jobs(projectdir):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[build]\n')
+        conffile.write('converter_jobs = {copyfile = 1}\n')
+    write_asset('foo.txt', 'foo')
+    write_asset('bar.txt', 'bar')
+
+    config = pman.get_config()
+    with Builder(config) as builder:
+        builder.build()
+        assert builder.jobserver.limits == {'jobs': builder.get_worker_count(), 'copyfile': 1}
+        assert os.environ[JOBSERVER_ENV] == builder.jobserver.path
+    assert JOBSERVER_ENV not in os.environ
+    assert sorted(os.listdir('.built_assets')) == ['bar.txt', 'foo.txt']
+
+
+def test_run_jobs_dependencies(projectdir):
+    finished = []
+    def convert(_config, _converter_config, _srcdir, _dstdir, assets):
+        if assets == ('asset3',):
+            raise RuntimeError('conversion failed')
+        finished.append(assets[0])
+        return []
+
+    jobs = make_jobs(convert, 6)
+    jobs[0].add_prerequisite(jobs[1])
+    jobs[1].add_prerequisite(jobs[2])
+    jobs[4].add_prerequisite(jobs[3])
+    jobs[5].add_prerequisite(jobs[4])
+
+    config = pman.get_config()
+    with Builder(config) as builder:
+        builder.pools['process'] = concurrent.futures.ThreadPoolExecutor(4)
+        with pytest.raises(RuntimeError, match='conversion failed'):
+            builder.run_jobs(jobs)
+
+    assert finished.index('asset2') < finished.index('asset1') < finished.index('asset0')
+    assert 'asset4' not in finished
+    assert 'asset5' not in finished
+    assert jobs[5].future is None
+
+
+def test_break_cycles():
+    jobs = make_jobs(None, 3)
+    jobs[0].add_prerequisite(jobs[1])
+    jobs[1].add_prerequisite(jobs[0])
+    jobs[2].add_prerequisite(jobs[0])
+
+    assert set(break_cycles(jobs)) == {jobs[0], jobs[1]}
+    assert not jobs[0].prerequisites
+    assert not jobs[1].prerequisites
+    assert jobs[2].prerequisites == {jobs[0]}
+
+
+def test_make_batches():
+    costs = {
+        'huge1': 100,
+        'huge2': 90,
+        'huge3': 80,
+        **{f'tiny{i}': 1 for i in range(30)},
+    }
+    batches = make_batches(list(costs), costs, max_size=3, workers=4)
+
+    # Expensive assets get their own batch and come first
+    assert batches[:3] == [('huge1',), ('huge2',), ('huge3',)]
+    assert all(len(i) <= 3 for i in batches)
+    assert sorted(i for batch in batches for i in batch) == sorted(costs)
+
+
+def test_make_batches_tiny():
+    costs = {f'tiny{i}': 0.001 for i in range(100)}
+
+    # Tiny assets are grouped up to min_cost instead of being spread across workers
+    batches = make_batches(list(costs), costs, max_size=0, workers=4, min_cost=0.05)
+    assert [len(i) for i in batches] == [50, 50]
+
+    # max_size is still respected
+    batches = make_batches(list(costs), costs, max_size=20, workers=4, min_cost=0.05)
+    assert [len(i) for i in batches] == [20] * 5
+
+
+def test_build_records_duration(projectdir):
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    builddb = SQLiteBuildDB('.pman_builddb', os.path.abspath('assets'))
+    builddb.load()
+    assert builddb['foo.txt'].duration > 0
+    builddb.close()
+
+
+def test_build_profile(projectdir):
+    write_asset('foo.txt', 'foo')
+    write_asset('bar.txt', 'bar')
+    pman.build(profile='profile.json')
+
+    with open('profile.json') as trace_file:
+        events = json.load(trace_file)['traceEvents']
+
+    jobs = [i for i in events if i.get('cat') == 'job']
+    assert sorted(asset for i in jobs for asset in i['args']['assets']) == ['bar.txt', 'foo.txt']
+    # copyfile jobs run in threads of the build process
+    assert all(i['pid'] == os.getpid() and i['dur'] >= 0 for i in jobs)
+    assert {'scan assets', 'check assets', 'run jobs'} <= {i['name'] for i in events}
+
+
+
+def test_build_cache_restore(projectdir, monkeypatch):
+    monkeypatch.setattr(CopyFilePlugin, 'CACHEABLE', True)
+    write_asset('foo.txt', 'foo')
+    write_asset('bar.txt', 'bar')
+    pman.build()
+    pman.clean()
+    write_asset('bar.txt', 'baz')
+
+    built = []
+    run_jobs = Builder.run_jobs
+    def record_jobs(self, jobs):
+        built.extend(os.path.basename(i) for job in jobs for i in job.assets)
+        return run_jobs(self, jobs)
+    monkeypatch.setattr(Builder, 'run_jobs', record_jobs)
+    pman.build()
+
+    assert built == ['bar.txt']
+    with open(os.path.join('.built_assets', 'foo.txt')) as builtfile:
+        assert builtfile.read() == 'foo'
+
+
+def test_build_cache_not_cacheable(projectdir, monkeypatch):
+    write_asset('foo.txt', 'foo')
+    put = ArtifactCache.put
+    stored = []
+    def record_put(self, key, *args):
+        stored.append(key)
+        return put(self, key, *args)
+    monkeypatch.setattr(ArtifactCache, 'put', record_put)
+    pman.build()
+    pman.clean()
+    pman.build()
+
+    assert stored == []
+    with open(os.path.join('.built_assets', 'foo.txt')) as builtfile:
+        assert builtfile.read() == 'foo'
+
+
+def test_artifact_cache_lru(tmp_path):
+    dstdir = tmp_path / 'built'
+    dstdir.mkdir()
+    cache = ArtifactCache(str(tmp_path / 'cache'), max_size=250)
+    for name in ('a', 'b', 'c'):
+        (dstdir / name).write_bytes(b'x' * 100)
+        result = ConverterResult(input_file=name, output_file=name)
+        cache.put(name, {}, [result], str(dstdir))
+        if name == 'b':
+            # Using 'a' makes 'b' the least recently used entry
+            assert cache.get('a', lambda _: None) is not None
+
+    cache.trim()
+    assert cache.get('a', lambda _: None) is not None
+    assert cache.get('b', lambda _: None) is None
+    assert cache.get('c', lambda _: None) is not None
+    assert cache.get_size() == 200
+    cache.close()
+
+
+@pytest.fixture()
+def cache_server(tmp_path):
+    server = CacheServer(('127.0.0.1', 0), str(tmp_path / 'remote'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_build_remote_cache(projectdir, cache_server, monkeypatch):
+    monkeypatch.setattr(CopyFilePlugin, 'CACHEABLE', True)
+    with open('.pman', 'w') as conffile:
+        conffile.write('[build]\n')
+        conffile.write('cache = false\n')
+        conffile.write(f'remote_cache = "{cache_server.url}"\n')
+    write_asset('foo.txt', 'foo')
+    write_asset('sub/bar.txt', 'bar')
+    pman.build()
+    pman.clean()
+
+    built = []
+    run_jobs = Builder.run_jobs
+    def record_jobs(self, jobs):
+        built.extend(i for job in jobs for i in job.assets)
+        return run_jobs(self, jobs)
+    monkeypatch.setattr(Builder, 'run_jobs', record_jobs)
+    pman.build()
+
+    assert built == []
+    with open(os.path.join('.built_assets', 'sub', 'bar.txt')) as builtfile:
+        assert builtfile.read() == 'bar'
+
+
+def test_build_remote_cache_malicious(projectdir, cache_server, monkeypatch):
+    monkeypatch.setattr(CopyFilePlugin, 'CACHEABLE', True)
+    with open('.pman', 'w') as conffile:
+        conffile.write('[build]\n')
+        conffile.write('cache = false\n')
+        conffile.write(f'remote_cache = "{cache_server.url}"\n')
+    write_asset('foo.txt', 'foo')
+
+    objid = '0' * 40
+    result = {'input_file': 'foo.txt', 'output_file': 'foo.txt', 'dependencies': []}
+    variants = [
+        'not a variant',
+        {'object': objid, 'dependencies': {}, 'results': [{**result, 'output_file': '../evil'}]},
+        {'object': objid, 'dependencies': {}, 'results': [{**result, 'output_file': '/tmp/evil'}]},
+        {'object': objid, 'dependencies': {'../secret': 'x'}, 'results': [result]},
+        {'object': objid, 'dependencies': {}, 'results': [{**result, 'dependencies': ['/etc']}]},
+        {'object': objid, 'dependencies': {}, 'results': [{**result, 'dependencies': 'foo.mtl'}]},
+        {'object': objid, 'dependencies': {}, 'results': [{'input_file': 'foo.txt'}]},
+        {'object': objid, 'dependencies': {}, 'results': [{**result, 'input_file': 'bar.txt'}]},
+        {'object': '../' + objid, 'dependencies': {}, 'results': [result]},
+    ]
+    monkeypatch.setattr(
+        RemoteCache,
+        'get_variants',
+        lambda _self, keys: dict.fromkeys(keys, variants),
+    )
+    downloads = []
+    def record_downloads(_self, objects):
+        downloads.append(objects)
+        return set()
+    monkeypatch.setattr(RemoteCache, 'download_objects', record_downloads)
+    pman.build()
+
+    assert downloads == [{}]
+    with open(os.path.join('.built_assets', 'foo.txt')) as builtfile:
+        assert builtfile.read() == 'foo'
+
+
+def test_build_remote_cache_not_cacheable(projectdir, cache_server, monkeypatch):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[build]\n')
+        conffile.write('cache = false\n')
+        conffile.write(f'remote_cache = "{cache_server.url}"\n')
+    write_asset('foo.txt', 'foo')
+    requests = []
+    for name in ('get_variants', 'download_objects', 'put'):
+        method = getattr(RemoteCache, name)
+        def record_request(self, *args, name=name, method=method):
+            requests.append(name)
+            return method(self, *args)
+        monkeypatch.setattr(RemoteCache, name, record_request)
+    pman.build()
+    pman.clean()
+    pman.build()
+
+    assert requests == []
+    with open(os.path.join('.built_assets', 'foo.txt')) as builtfile:
+        assert builtfile.read() == 'foo'
+
+
+def test_build_prune(projectdir):
+    write_asset('foo.txt', 'foo')
+    write_asset(os.path.join('sub', 'bar.txt'), 'bar')
+    pman.build()
+
+    os.unlink(os.path.join('assets', 'sub', 'bar.txt'))
+    assert pman.prune(dry_run=True) == [os.path.join('sub', 'bar.txt')]
+    assert os.path.exists(os.path.join('.built_assets', 'sub', 'bar.txt'))
+
+    pman.build()
+    assert os.listdir('.built_assets') == ['foo.txt']
+    assert pman.prune(dry_run=True) == []
+
+
+def test_build_stamp(projectdir):
+    config = pman.get_config()
+    write_asset('foo.txt', 'foo')
+    assert not is_build_current(config)
+
+    pman.build(config)
+    assert is_build_current(config)
+
+    os.utime(os.path.join('assets', 'foo.txt'), ns=(0, 0))
+    assert not is_build_current(config)
+    pman.build(config)
+    assert is_build_current(config)
+
+    write_asset('bar.txt', 'bar')
+    assert not is_build_current(config)
+    pman.build(config)
+
+    pman.clean(config)
+    assert not is_build_current(config)
+
+
+def test_on_demand_find_assets(projectdir):
+    write_asset(os.path.join('models', 'foo.egg'), '')
+    write_asset('bar.txt', 'bar')
+    config = pman.get_config()
+    config['general']['plugins'] = ['native2bam']
+
+    with OnDemandBuilder(config) as ondemand:
+        srcdir = ondemand.builder.srcdir
+        assert ondemand.find_assets(os.path.join('models', 'foo.bam')) == [
+            os.path.join(srcdir, 'models', 'foo.egg'),
+        ]
+        assert ondemand.find_assets('bar.txt') == [os.path.join(srcdir, 'bar.txt')]
+        assert ondemand.find_assets('baz.bam') == []
+
+
+def test_on_demand_up_to_date(projectdir, monkeypatch):
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    calls = []
+    monkeypatch.setattr(SQLiteBuildDB, 'save', lambda *_args, **_kwargs: calls.append('save'))
+    monkeypatch.setattr(ArtifactCache, 'trim', lambda _self: calls.append('trim'))
+    with OnDemandBuilder(pman.get_config()) as ondemand:
+        assert ondemand.ensure_built('foo.txt')
+
+    # Whole-table cleanups are left to full builds
+    assert calls == []
+
+
+def test_on_demand_threads(projectdir):
+    write_asset('foo.txt', 'foo')
+    write_asset('bar.txt', 'bar')
+
+    with OnDemandBuilder(pman.get_config()) as ondemand:
+        assert ondemand.ensure_built('foo.txt')
+        # e.g., models loaded asynchronously
+        with concurrent.futures.ThreadPoolExecutor(2) as threads:
+            assert all(threads.map(ondemand.ensure_built, ['bar.txt', 'foo.txt']))
+
+    for name in ('foo.txt', 'bar.txt'):
+        with open(os.path.join('.built_assets', name)) as builtfile:
+            assert builtfile.read() == name.split('.')[0]
+
+
+def test_build_pack(projectdir):
+    import panda3d.core as p3d
+
+    config = pman.get_config()
+    config['build']['pack'] = True
+    write_asset('foo.txt', 'foo')
+    write_asset(os.path.join('sub', 'bar.txt'), 'bar')
+    write_asset(os.path.join('other', 'baz.txt'), 'baz')
+    pman.build(config)
+
+    packdir = os.path.abspath('.packed_assets')
+    assert sorted(os.listdir(packdir)) == ['__root__.mf', 'index.json', 'other.mf', 'sub.mf']
+    assert pman.pack(config) == []
+
+    write_asset(os.path.join('sub', 'bar.txt'), 'bar2')
+    os.unlink(os.path.join('assets', 'foo.txt'))
+    write_asset(os.path.join('sub', 'new.txt'), 'new')
+    pman.build(config)
+    assert sorted(os.listdir(packdir)) == ['index.json', 'other.mf', 'sub.mf']
+
+    # Only the sub archive changed, so the others should not be rewritten
+    write_asset(os.path.join('sub', 'bar.txt'), 'bar3')
+    config['build']['pack'] = False
+    pman.build(config)
+    assert pman.pack(config) == ['sub']
+
+    mount_point = p3d.Filename.from_os_specific(os.path.abspath('mounted'))
+    assert mount_packs(p3d.Filename.from_os_specific(packdir), mount_point) == 2
+    vfs = p3d.VirtualFileSystem.get_global_ptr()
+    try:
+        assert vfs.read_file(p3d.Filename(mount_point, 'sub/bar.txt'), auto_unwrap=True) == b'bar3'
+        assert vfs.read_file(p3d.Filename(mount_point, 'sub/new.txt'), auto_unwrap=True) == b'new'
+        assert vfs.read_file(p3d.Filename(mount_point, 'other/baz.txt'), auto_unwrap=True) == b'baz'
+    finally:
+        vfs.unmount_point(mount_point)
+
+    pman.clean(config)
+    assert not os.path.exists(packdir)
+
+
+def test_copy_file_strategies(tmp_path, monkeypatch):
+    src = tmp_path / 'src.txt'
+    src.write_text('foo')
+
+    dst = tmp_path / 'auto.txt'
+    strategy = _copy.copy_file(str(src), str(dst))
+    assert strategy in _copy.AUTO_STRATEGIES
+    assert dst.read_text() == 'foo'
+    assert dst.stat().st_ino != src.stat().st_ino
+
+    dst = tmp_path / 'link.txt'
+    assert _copy.copy_file(str(src), str(dst), _copy.get_strategies('hardlink')) == 'hardlink'
+    assert dst.stat().st_ino == src.stat().st_ino
+
+    # Unsupported strategies fall back and are not tried again
+    attempts = []
+    def unsupported(_src, _dst):
+        attempts.append(_src)
+        raise OSError(errno.EXDEV, 'not supported')
+    monkeypatch.setitem(_copy._COPY_FUNCS, 'reflink', unsupported) # noqa: SLF001
+    monkeypatch.setattr(_copy, '_detected', {})
+    for idx in range(3):
+        dst = tmp_path / f'fallback{idx}.txt'
+        assert _copy.copy_file(str(src), str(dst)) != 'reflink'
+        assert dst.read_text() == 'foo'
+    assert len(attempts) == 1
+
+
+def test_build_copyfile_hardlink(projectdir):
+    with open('.pman', 'w') as conffile:
+        conffile.write('[copyfile]\nstrategy = "hardlink"\n')
+    write_asset('foo.txt', 'foo')
+    pman.build()
+
+    src = os.stat(os.path.join('assets', 'foo.txt'))
+    assert os.stat(os.path.join('.built_assets', 'foo.txt')).st_ino == src.st_ino
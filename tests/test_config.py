@@ -1,4 +1,6 @@
 import os
+import subprocess
+import sys
 
 import pman
 import pman.config
@@ -92,3 +94,14 @@ def test_dataclass_from_dict():
 
     assert conf.general.verbose
     assert conf.run.main_file == 'foo.py'
+
+def test_conf_lazy_plugins(projectdir):
+    script = (
+        'import sys, pman\n'
+        'config = pman.get_config()\n'
+        'assert "pman.plugins.blend2bam" not in sys.modules\n'
+        'assert config.blend2bam\n'
+        'assert "pman.plugins.blend2bam" in sys.modules\n'
+        'assert "pman.plugins.native2bam" not in sys.modules\n'
+    )
+    subprocess.check_call([sys.executable, '-c', script])
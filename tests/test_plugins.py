@@ -0,0 +1,106 @@
+import concurrent.futures
+import json
+import os
+import sys
+
+from pman.plugins import blend2bam
+from pman.plugins.blend2bam import BlenderWorkerPool
+
+FAKE_BLENDER_WORKER = """
+import json, os, sys
+PREFIX = '@@pman-blend2bam@@ '
+print('Blender startup noise')
+print(PREFIX + json.dumps({'ok': True, 'ready': True}), flush=True)
+for line in sys.stdin:
+    request = json.loads(line)
+    print(PREFIX + json.dumps({'ok': True, 'dependencies': [str(os.getpid())]}), flush=True)
+"""
+
+
+def test_blender_worker_pool(tmpdir):
+    script = tmpdir.join('fake_worker.py')
+    script.write(FAKE_BLENDER_WORKER)
+
+    pool = BlenderWorkerPool([sys.executable, script.strpath], size=1, max_jobs=2)
+    try:
+        pids = [
+            pool.convert({}, 'foo.blend', 'foo.gltf')['dependencies'][0]
+            for _ in range(3)
+        ]
+    finally:
+        pool.close()
+
+    # Worker is re-used until it hits max_jobs
+    assert pids[0] == pids[1]
+    assert pids[1] != pids[2]
+
+
+def test_blender_worker_pool_shared(tmpdir):
+    script = tmpdir.join('fake_worker.py')
+    script.write(FAKE_BLENDER_WORKER)
+
+    # Jobs run in threads of the build process, so they all share one pool
+    assert blend2bam.Blend2BamPlugin.EXECUTOR == 'subprocess'
+    def convert(i):
+        pool = blend2bam.get_worker_pool([sys.executable, script.strpath], 2, 0, 0)
+        return pool.convert({}, f'{i}.blend', f'{i}.gltf')['dependencies'][0]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(8) as threads:
+            pids = set(threads.map(convert, range(32)))
+    finally:
+        blend2bam.close_worker_pools()
+
+    assert len(pids) <= 2
+
+
+class FakeGltfPool:
+    '''Stands in for Blender workers, exporting a glTF scene named after the .blend'''
+
+    size = 2
+
+    def convert(self, _settings, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        name = os.path.basename(src).split('.')[0]
+        with open(dst, 'w') as gltf_file:
+            json.dump({
+                'asset': {'version': '2.0'},
+                'scene': 0,
+                'scenes': [{'nodes': [0]}],
+                'nodes': [{'name': name}],
+            }, gltf_file)
+        return {'ok': True, 'dependencies': []}
+
+
+def test_blend2bam_workers_concurrent_batches(tmp_path, monkeypatch):
+    import panda3d.core as p3d
+    from blend2bam import blenderutils
+
+    monkeypatch.setattr(blenderutils, 'blender_exists', lambda *_args: True)
+    monkeypatch.setattr(blend2bam, 'get_worker_pool', lambda *_args: FakeGltfPool())
+    srcdir = tmp_path / 'assets'
+    dstdir = tmp_path / 'built'
+    config = {'general': {'verbose': False}, 'build': {'asset_dir': str(srcdir)}}
+    converter_config = blend2bam.Blend2BamPlugin.Config(workers=2)
+    plugin = blend2bam.Blend2BamPlugin()
+    batches = [['a', 'b', 'c'], ['d', 'e', 'f']]
+
+    # blend2bam jobs run in threads of the build process
+    def convert(batch):
+        return plugin.convert_with_workers(
+            config,
+            converter_config,
+            str(srcdir),
+            str(dstdir),
+            [str(srcdir / f'{name}.blend') for name in batch],
+        )
+    with concurrent.futures.ThreadPoolExecutor(len(batches)) as threads:
+        results = list(threads.map(convert, batches))
+
+    loader = p3d.Loader.get_global_ptr()
+    options = p3d.LoaderOptions(p3d.LoaderOptions.LF_no_cache)
+    for batch, batch_results in zip(batches, results):
+        assert [i.output_file for i in batch_results] == [f'{name}.bam' for name in batch]
+        for name in batch:
+            bampath = p3d.Filename.from_os_specific(str(dstdir / f'{name}.bam'))
+            model = p3d.NodePath(loader.load_sync(bampath, options))
+            assert model.find(f'**/{name}')
@@ -1,3 +1,10 @@
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
 import pman
 import pman.shim
 
@@ -42,3 +49,207 @@ def test_run_args(projectdir):
 
 def test_shim(projectdir):
     pman.shim.init(None)
+
+
+def test_python_program_cached(projectdir, cachedir, monkeypatch):
+    pyprog = pman.get_python_program()
+    assert (cachedir / 'python_programs.json').exists()
+
+    def fail_probe(*_args, **_kwargs):
+        raise AssertionError('interpreter probed again')
+    monkeypatch.setattr(pman._utils.subprocess, 'run', fail_probe) # noqa: SLF001
+    assert pman.get_python_program() == pyprog
+
+
+IMPORT_TIME_BUDGET_US = 100_000
+
+
+HEAVY_MODULES = [
+    'rich',
+    'concurrent.futures',
+    'pman._build',
+    'tomli',
+    'importlib.metadata',
+    'sqlite3',
+    'http.client',
+]
+
+
+def get_import_time(module):
+    '''Import module in a new interpreter, returning its import time in microseconds'''
+    script = (
+        f'import sys, {module}\n'
+        f'print(",".join(i for i in {HEAVY_MODULES!r} if i in sys.modules))\n'
+    )
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert proc.stdout.strip() == ''
+    return next(
+        int(line.split('|')[1])
+        for line in proc.stderr.splitlines()
+        if line.split('|')[-1].strip() == module
+    )
+
+
+# pman.cli covers the CLI and pman._core the run and clean commands
+@pytest.mark.parametrize('module', ['pman.cli', 'pman._core'])
+def test_cli_import_time(module):
+    # Use the best of a few runs to avoid flakiness on busy machines
+    assert min(get_import_time(module) for _ in range(3)) < IMPORT_TIME_BUDGET_US
+
+
+def test_shim_imports():
+    # The shim pulls in Panda3D, so only check it leaves the builder alone
+    get_import_time('pman.shim')
+
+
+def test_shim_skips_current_build(projectdir, monkeypatch):
+    pman.build()
+
+    def fail_build(*_args, **_kwargs):
+        raise AssertionError('build ran')
+    monkeypatch.setattr(pman._build, 'build', fail_build) # noqa: SLF001
+    assert pman.shim.init(None) is None
+
+
+def test_shim_background_build(projectdir):
+    config = pman.get_config()
+    config['run']['auto_build_background'] = True
+    with open(os.path.join('assets', 'foo.txt'), 'w') as assetfile:
+        assetfile.write('foo')
+
+    thread = pman.shim._auto_build(config) # noqa: SLF001
+    thread.join()
+    assert os.path.exists(os.path.join('.built_assets', 'foo.txt'))
+
+
+def test_shim_build_on_demand(projectdir):
+    config = pman.get_config()
+    config['run']['build_on_demand'] = True
+    for name in ('foo.txt', 'bar.txt'):
+        with open(os.path.join('assets', name), 'w') as assetfile:
+            assetfile.write(name)
+
+    loaded = []
+    def load(path, *_args, **_kwargs):
+        loaded.append(path)
+    loader = types.SimpleNamespace(**{
+        name: load
+        for *names, _ in pman.shim.LOADER_METHODS
+        for name in names
+    })
+    pman.shim.install_build_on_demand(config, loader)
+
+    loader.load_model('foo.txt')
+    assert loaded == ['foo.txt']
+    assert os.path.exists(os.path.join('.built_assets', 'foo.txt'))
+    assert not os.path.exists(os.path.join('.built_assets', 'bar.txt'))
+
+    # Missing assets are left for the loader to report
+    loader.loadTexture('missing.png')
+    assert loaded == ['foo.txt', 'missing.png']
+
+
+EGG_TEXTURED = """
+<Texture> tex { "textures/red.png" }
+<VertexPool> vpool {
+  <Vertex> 0 { 0 0 0 <UV> { 0 0 } }
+  <Vertex> 1 { 1 0 0 <UV> { 1 0 } }
+  <Vertex> 2 { 0 0 1 <UV> { 0 1 } }
+}
+<Group> tri {
+  <Polygon> { <TRef> { tex } <VertexRef> { 0 1 2 <Ref> { vpool } } }
+}
+"""
+def test_shim_build_on_demand_textures(projectdir):
+    import panda3d.core as p3d
+
+    config = pman.get_config()
+    config['run']['build_on_demand'] = True
+    # Panda does not follow os.chdir(), so only use absolute paths with it
+    texturedir = os.path.abspath(os.path.join('assets', 'textures'))
+    os.makedirs(texturedir)
+    p3d.PNMImage(4, 4, 3).write(p3d.Filename.from_os_specific(os.path.join(texturedir, 'red.png')))
+    with open(os.path.join('assets', 'tri.egg'), 'w') as assetfile:
+        assetfile.write(EGG_TEXTURED)
+
+    loaded = []
+    def load_model(*args, **kwargs):
+        loaded.append((args, kwargs))
+    loader = types.SimpleNamespace(loadModel=load_model, **{
+        name: None
+        for *names, _ in pman.shim.LOADER_METHODS[1:]
+        for name in names
+    })
+    pman.shim.install_build_on_demand(config, loader)
+
+    # Textures the model references are built with it
+    loader.load_model(modelPath='tri', noCache=True)
+    assert loaded == [((), {'modelPath': 'tri', 'noCache': True})]
+    assert os.path.exists(os.path.join('.built_assets', 'tri.bam'))
+    assert os.path.exists(os.path.join('.built_assets', 'textures', 'red.png'))
+
+
+FAKE_SETUP_PY = """
+import os, sys
+platform = sys.argv[sys.argv.index('-p') + 1]
+if platform == 'broken':
+    sys.exit(1)
+os.makedirs(os.path.join('build', platform))
+with open(os.path.join('build', platform, 'cmd'), 'w') as f:
+    f.write(sys.argv[1])
+"""
+def test_dist_platforms(projectdir):
+    with open('setup.py', 'w') as setupfile:
+        setupfile.write(FAKE_SETUP_PY)
+    config = pman.get_config()
+
+    pman.dist(config, build_installers=False, platforms=['win_amd64', 'manylinux2014_x86_64'])
+    for platform in ('win_amd64', 'manylinux2014_x86_64'):
+        with open(os.path.join('build', platform, 'cmd')) as cmdfile:
+            assert cmdfile.read() == 'build_apps'
+        assert os.path.exists(os.path.join('build', f'pman_dist_{platform}.log'))
+
+    with pytest.raises(pman.BuildError, match='broken'):
+        pman.dist(config, build_installers=False, platforms=['broken', 'macosx_10_9_x86_64'])
+
+    # A single platform is built directly, and fails the same way
+    with pytest.raises(pman.BuildError, match='exit code 1'):
+        pman.dist(config, build_installers=False, platforms=['broken'])
+
+
+def test_dist_setup_cfg_platforms(projectdir):
+    with open('setup.py', 'w') as setupfile:
+        setupfile.write(FAKE_SETUP_PY)
+    with open('setup.cfg', 'w') as setupcfg:
+        setupcfg.write('[build_apps]\nplatforms =\n    win_amd64\n    manylinux2014_x86_64\n')
+    config = pman.get_config()
+
+    pman.dist(config, build_installers=False)
+    for platform in ('win_amd64', 'manylinux2014_x86_64'):
+        assert os.path.exists(os.path.join('build', platform, 'cmd'))
+        assert os.path.exists(os.path.join('build', f'pman_dist_{platform}.log'))
+
+
+def test_shim_build_on_demand_before_showbase(projectdir, monkeypatch):
+    from direct.showbase.Loader import Loader
+
+    config = pman.get_config()
+    with open(os.path.join('assets', 'foo.txt'), 'w') as assetfile:
+        assetfile.write('foo')
+
+    loaded = []
+    def load(_self, path, *_args, **_kwargs):
+        loaded.append(path)
+    for *names, _ in pman.shim.LOADER_METHODS:
+        for name in names:
+            monkeypatch.setattr(Loader, name, load)
+    pman.shim.install_build_on_demand(config)
+
+    Loader.loadModel(None, 'foo.txt')
+    assert loaded == ['foo.txt']
+    assert os.path.exists(os.path.join('.built_assets', 'foo.txt'))